@@ -12,18 +12,20 @@ def read_csv_files(directory):
     Selects only y columns and excludes the rightmost y column if there are 6 or more y columns."""
     file_paths = glob.glob(os.path.join(directory, '*.csv'))
     file_paths.sort()  # Sort the file paths alphabetically
-    data = []
-    for file in file_paths:
-        df = pd.read_csv(file, header=0)
-        y_data_columns = [col for col in df.columns if col.startswith('y')]
-        # Exclude the last 'y' column only if there are 6 or more y columns
-        if len(y_data_columns) >= 6:
-            df = df[y_data_columns[:-1]]
-        else:
-            df = df[y_data_columns]
-        data.append(df)
+    data = [read_csv_file(file) for file in file_paths]
     return data, file_paths
 
+def read_csv_file(file):
+    """Reads a single CSV file, keeping only the y columns as in read_csv_files."""
+    df = pd.read_csv(file, header=0)
+    y_data_columns = [col for col in df.columns if col.startswith('y')]
+    # Exclude the last 'y' column only if there are 6 or more y columns
+    if len(y_data_columns) >= 6:
+        df = df[y_data_columns[:-1]]
+    else:
+        df = df[y_data_columns]
+    return df
+
 def apply_scaling_factor(data):
     """Applies a scaling factor to the data columns."""
     num_y_data_columns = data.shape[1]
@@ -57,6 +59,13 @@ def transpose_and_save_data(data, file_paths):
         new_filename = os.path.splitext(path)[0] + '_normalized.csv'
         transposed_df.to_csv(new_filename, index=False, header=False)
 
+def process_file(file_path):
+    """Normalizes a single raw CSV file and saves it as <name>_normalized.csv."""
+    scaled_data = apply_scaling_factor(read_csv_file(file_path))
+    baseline = sliding_window_baseline(scaled_data)
+    normalized_data = normalize_data(scaled_data, baseline)
+    transpose_and_save_data([normalized_data], [file_path])
+
 def process_fluorescence_data(directory):
     """Main function to process fluorescence data from CSV files."""
     try:
@@ -18,6 +18,9 @@ def calculate_auc_rowwise(row):
 
 def process_file(filepath):
     data = pd.read_csv(filepath, header=None)
+    return process_data(data, filepath)
+
+def process_data(data, filepath):
     smoothed_data = smooth_data_rowwise(data)
     auc_values = smoothed_data.apply(calculate_auc_rowwise, axis=1)
 
@@ -26,6 +29,17 @@ def process_file(filepath):
 
     return len(auc_values)
 
+def save_summary(summary, directory):
+    summary_df = pd.DataFrame(list(summary.items()), columns=['File', 'Number of Traces'])
+    summary_df.to_csv(os.path.join(directory, 'CellCountsNeurons.csv'), index=False)
+
+def count_traces(directory):
+    """Writes the cell count summary from existing _AUC.csv files (one row per trace) without recomputing the AUC."""
+    summary = {}
+    for auc_file in sorted(glob.glob(os.path.join(directory, '*_normalized_AUC.csv'))):
+        summary[os.path.basename(auc_file).replace('_AUC.csv', '.csv')] = len(pd.read_csv(auc_file))
+    save_summary(summary, directory)
+
 def main(directory):
     files = glob.glob(os.path.join(directory, '*_normalized.csv'))
     files.sort()  # This will sort the files alphabetically
@@ -35,8 +49,7 @@ def main(directory):
         n_traces = process_file(file)
         summary[os.path.basename(file)] = n_traces
 
-    summary_df = pd.DataFrame(list(summary.items()), columns=['File', 'Number of Traces'])
-    summary_df.to_csv(os.path.join(directory, 'CellCountsNeurons.csv'), index=False)
+    save_summary(summary, directory)
 
     print("Processing complete.")
 
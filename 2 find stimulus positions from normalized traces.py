@@ -1,7 +1,6 @@
 import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 from scipy.signal import find_peaks, argrelextrema
 
 # === Configuration Parameters ===
@@ -10,6 +9,7 @@ NUMBER_OF_STIMULI = 14  # Total number of stimuli presented
 INTER_STIMULUS_INTERVAL = 290  # Fixed distance between stimuli in data points
 SMOOTHING_WINDOW = 15  # Size of the moving average window for smoothing
 PEAKS_START_WINDOW = 200  # Timepoints to skip at the start for peak detection
+SAVE_VISUALIZATIONS = True  # Save the trace figures; matplotlib is only imported when this is on
 
 def read_csv(file_path):
     """Reads a CSV file and returns its data."""
@@ -51,6 +51,7 @@ def find_stimulus_peaks_and_onsets(signal, num_stimuli, isi):
 
 def visualize_traces(data, stimulus_peaks, stimulus_onsets, file_name):
     """Visualizes all traces, peaks, and onsets in subplots, splitting into multiple figures if necessary."""
+    import matplotlib.pyplot as plt
     num_traces = len(data)
     max_traces_per_fig = 10  # Set a limit for traces per figure
     num_figs = (num_traces - 1) // max_traces_per_fig + 1  # Calculate the number of figures needed
@@ -80,23 +81,28 @@ def visualize_traces(data, stimulus_peaks, stimulus_onsets, file_name):
 def process_file(file_path):
     """Processes a single file to find stimulus peaks, onsets, visualizes the traces, and saves them to CSV files."""
     data = read_csv(file_path)
+    if data is not None:
+        process_data(data, file_path)
+
+def process_data(data, file_path):
+    """Finds stimulus peaks and onsets in already loaded data, visualizes the traces, and saves them to CSV files."""
     stimulus_peaks = {}
     stimulus_onsets = {}
-    if data is not None:
-        for idx, row in data.iterrows():
-            signal = smooth_signal(row)
-            peaks, onsets = find_stimulus_peaks_and_onsets(signal, NUMBER_OF_STIMULI, INTER_STIMULUS_INTERVAL)
-            stimulus_peaks[idx] = peaks
-            stimulus_onsets[idx] = onsets
+    for idx, row in data.iterrows():
+        signal = smooth_signal(row)
+        peaks, onsets = find_stimulus_peaks_and_onsets(signal, NUMBER_OF_STIMULI, INTER_STIMULUS_INTERVAL)
+        stimulus_peaks[idx] = peaks
+        stimulus_onsets[idx] = onsets
+    if SAVE_VISUALIZATIONS:
         visualize_traces(data, stimulus_peaks, stimulus_onsets, os.path.basename(file_path))
-        
-        # Save onsets to CSV
-        onsets_df = pd.DataFrame.from_dict(stimulus_onsets, orient='index')
-        onsets_df.to_csv(os.path.join(DATA_DIRECTORY, f'{os.path.splitext(file_path)[0]}_stimulus_onsets.csv'))
-        
-        # Save peaks to CSV
-        peaks_df = pd.DataFrame.from_dict(stimulus_peaks, orient='index')
-        peaks_df.to_csv(os.path.join(DATA_DIRECTORY, f'{os.path.splitext(file_path)[0]}_stimulus_peaks.csv'))
+    
+    # Save onsets to CSV
+    onsets_df = pd.DataFrame.from_dict(stimulus_onsets, orient='index')
+    onsets_df.to_csv(os.path.join(DATA_DIRECTORY, f'{os.path.splitext(file_path)[0]}_stimulus_onsets.csv'))
+    
+    # Save peaks to CSV
+    peaks_df = pd.DataFrame.from_dict(stimulus_peaks, orient='index')
+    peaks_df.to_csv(os.path.join(DATA_DIRECTORY, f'{os.path.splitext(file_path)[0]}_stimulus_peaks.csv'))
 
 def process_all_files(directory):
     """Processes all files in the given directory that end with '_normalized.csv', in alphabetical order."""
@@ -0,0 +1,43 @@
+import os
+import glob
+import pandas as pd
+import instrumentation
+from pipeline_scripts import load_script
+
+# === Configuration Parameters ===
+DATA_DIRECTORY = '/Users/nbenfey/Desktop/PythonProcessing'  # Update with your directory path
+AUC_SCRIPT = '2 count traces AUC tectal neurons.py'  # Use '2 count traces AUC radial astrocytes.py' for glia
+RUN_AUC = True
+RUN_HEATMAPS = True
+RUN_STIMULUS_POSITIONS = True
+
+def process_all_files(directory):
+    """Reads each _normalized.csv once and passes the same data to the AUC, heatmap and stimulus position steps.
+    The outputs are the same files the three stage 2 scripts write when run separately."""
+    # The script functions are only wrapped for timing when PIPELINE_PROFILE is set
+    auc = instrumentation.instrument(load_script(AUC_SCRIPT))
+    heatmaps = instrumentation.instrument(load_script('2 heatmaps of normalized traces.py'))
+    stimulus_positions = instrumentation.instrument(load_script('2 find stimulus positions from normalized traces.py'))
+    # The stimulus position script saves its figures to its own DATA_DIRECTORY
+    stimulus_positions.DATA_DIRECTORY = directory
+
+    summary = {}
+    for file_path in sorted(glob.glob(os.path.join(directory, '*_normalized.csv'))):
+        with instrumentation.stage('read_csv', file_path, script=os.path.basename(__file__)):
+            data = pd.read_csv(file_path, header=None)
+        if RUN_AUC:
+            summary[os.path.basename(file_path)] = auc.process_data(data, file_path)
+        if RUN_HEATMAPS:
+            heatmaps.generate_heatmap(data, file_path)
+        if RUN_STIMULUS_POSITIONS:
+            stimulus_positions.process_data(data, file_path)
+        print(f"Processed file: {os.path.basename(file_path)}")
+
+    if RUN_AUC:
+        auc.save_summary(summary, directory)
+    print("Stage 2 processing complete.")
+    if instrumentation.ENABLED:
+        instrumentation.write_report(instrumentation.report_base(directory))
+
+if __name__ == "__main__":
+    process_all_files(DATA_DIRECTORY)
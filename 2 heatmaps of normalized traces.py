@@ -1,8 +1,11 @@
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
 import os
 import glob
+import json
+import struct
+import zlib
+from pipeline_scripts import load_script
 
 # Configuration
 directory = '/Users/nbenfey/Desktop/PythonProcessing'
@@ -15,6 +18,23 @@ row_height_inches = 0.1  # Height of each row in inches
 BOTTOM = 0
 TOP = 0.05
 
+# Row order: None keeps the recorded order, or a sort column such as 'Avg Peak Loom' to order rows with the
+# <name>_sort_index.csv permutation written by the sort script (no sorted copy of the data is needed)
+sort_by = None
+SORT_SCRIPT = '4 sort normalized traces by average neuronal properties.py'
+
+# Renderer: 'matplotlib' saves the SVG with imshow, 'direct' maps the data through the colormap with NumPy
+# and writes a PNG plus a multi-resolution tile pyramid without rasterizing through matplotlib
+renderer = 'matplotlib'
+output_width_px = 2000  # Width of the direct PNG; timepoints are pooled (or repeated) to fit
+row_height_px = 3  # Pixel height of each row in the direct PNG and at full tile resolution
+max_output_height_px = 4000  # Rows are pooled when the direct PNG would be taller than this
+pooling = 'max'  # 'max', 'min' or 'mean' pooling when several data points fall into one pixel; NaN values are ignored
+missing_color = (255, 255, 255)  # RGB of NaN cells (the padding of shorter rows), which imshow leaves blank
+write_tile_pyramid = True  # Also write <name>_heatmap_tiles/<level>/<row>_<column>.png for zoomable browsing
+tile_size = 256
+png_compression_level = 1  # zlib level for direct PNGs: 1 is fastest, 9 gives the smallest files
+
 # Timepoint range to plot
 start_timepoint = 0
 end_timepoint = 4500  # Adjust this value as needed
@@ -30,16 +50,94 @@ def process_data(data, smoothing_enabled, window_size):
     else:
         return data
 
-# Sort and loop over each CSV file in the directory alphabetically
-for filepath in sorted(glob.glob(os.path.join(directory, '*_normalized.csv'))):
-    # Read the CSV file into a DataFrame
-    df = pd.read_csv(filepath, header=None)
+# Function to build the output file name, including the sort column when rows are reordered
+def heatmap_path(filepath, suffix):
+    sort_suffix = f"_sorted_by_{sort_by.replace(' ', '_')}" if sort_by else ''
+    return os.path.join(os.path.dirname(filepath), os.path.basename(filepath).replace('.csv', f'_heatmap{sort_suffix}{suffix}'))
 
-    # Select the range of timepoints
-    df = df.iloc[:, start_timepoint:end_timepoint]
+# Function to pool (when shrinking) or repeat (when growing) one axis to a given number of pixels
+def pool_axis(data, size, axis, method=pooling):
+    n = data.shape[axis]
+    starts = (np.arange(size) * n) // size
+    if size >= n:
+        return np.take(data, starts, axis=axis)
+    if method == 'mean':
+        # Mean of the values that are not NaN; a pixel with only NaN values stays NaN
+        present = ~np.isnan(data)
+        counts = np.add.reduceat(present, starts, axis=axis)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.add.reduceat(np.where(present, data, 0), starts, axis=axis) / counts
+    # fmax/fmin skip NaN values unless all values of a pixel are NaN
+    reducers = {'max': np.fmax, 'min': np.fmin}
+    return reducers[method].reduceat(data, starts, axis=axis)
 
-    # Apply optional smoothing to each row (neuron trace)
-    df_processed = process_data(df, smoothing_enabled, smoothing_window_size)
+# Function to look up the colormap once as a 256-entry RGB table
+def colormap_table(name):
+    from matplotlib import colormaps
+    return (colormaps[name](np.linspace(0, 1, 256))[:, :3] * 255).round().astype(np.uint8)
+
+# Function to map values to RGB pixels with BOTTOM/TOP clipping, like imshow's vmin/vmax, and NaN to missing_color
+def apply_colormap(data, table):
+    missing = np.isnan(data)
+    scaled = (np.clip(np.where(missing, BOTTOM, data), BOTTOM, TOP) - BOTTOM) / (TOP - BOTTOM)
+    rgb = table[np.minimum((scaled * len(table)).astype(np.intp), len(table) - 1)]
+    rgb[missing] = missing_color
+    return rgb
+
+# Function to write an (height, width, 3) uint8 array as an 8-bit RGB PNG
+def write_png(path, rgb):
+    height, width, _ = rgb.shape
+    # Each scanline is prefixed with filter type 0 (none)
+    raw = np.concatenate([np.zeros((height, 1), np.uint8), rgb.reshape(height, -1)], axis=1).tobytes()
+
+    def chunk(kind, payload):
+        return struct.pack('>I', len(payload)) + kind + payload + struct.pack('>I', zlib.crc32(kind + payload) & 0xffffffff)
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', zlib.compress(raw, png_compression_level)))
+        f.write(chunk(b'IEND', b''))
+
+# Function to write a tile pyramid: the last level has one pixel per timepoint and row_height_px per row,
+# each level above it halves both dimensions, and level 0 fits in a single tile
+def write_tiles(data, table, tiles_directory):
+    levels = [pool_axis(data, data.shape[0] * row_height_px, axis=0)]
+    while max(levels[0].shape) > tile_size:
+        level = levels[0]
+        level = pool_axis(level, (level.shape[0] + 1) // 2, axis=0)
+        levels.insert(0, pool_axis(level, (level.shape[1] + 1) // 2, axis=1))
+
+    metadata = {'tile_size': tile_size, 'colormap': heatmap_colormap, 'vmin': BOTTOM, 'vmax': TOP, 'pooling': pooling, 'levels': []}
+    for z, level in enumerate(levels):
+        os.makedirs(os.path.join(tiles_directory, str(z)), exist_ok=True)
+        height, width = level.shape
+        for y in range(0, height, tile_size):
+            for x in range(0, width, tile_size):
+                tile = apply_colormap(level[y:y + tile_size, x:x + tile_size], table)
+                write_png(os.path.join(tiles_directory, str(z), f'{y // tile_size}_{x // tile_size}.png'), tile)
+        metadata['levels'].append({'level': z, 'width': width, 'height': height,
+                                   'columns': -(-width // tile_size), 'rows': -(-height // tile_size)})
+
+    with open(os.path.join(tiles_directory, 'tiles.json'), 'w') as f:
+        json.dump(metadata, f, indent=2)
+
+# Function to render the heatmap directly from the data matrix
+def render_heatmap_direct(df_processed, filepath):
+    data = df_processed.to_numpy(dtype=np.float32)
+    table = colormap_table(heatmap_colormap)
+
+    height = min(data.shape[0] * row_height_px, max_output_height_px)
+    image = pool_axis(pool_axis(data, height, axis=0), output_width_px, axis=1)
+    write_png(heatmap_path(filepath, '.png'), apply_colormap(image, table))
+
+    if write_tile_pyramid:
+        write_tiles(data, table, heatmap_path(filepath, '_tiles'))
+
+# Function to render the heatmap as an SVG with matplotlib
+def render_heatmap_matplotlib(df_processed, filepath):
+    # Imported here so the direct renderer never loads matplotlib.pyplot
+    import matplotlib.pyplot as plt
 
     # Determine figure height based on number of rows
     fig_height = df_processed.shape[0] * row_height_inches
@@ -62,9 +160,43 @@ for filepath in sorted(glob.glob(os.path.join(directory, '*_normalized.csv'))):
         fig.colorbar(cax)
 
     # Save the heatmap to file
-    output_filename_heatmap = os.path.basename(filepath).replace('.csv', '_heatmap.svg')
-    output_filepath_heatmap = os.path.join(directory, output_filename_heatmap)
-    fig.savefig(output_filepath_heatmap, dpi=high_resolution_dpi, format='svg', bbox_inches='tight', pad_inches=0, transparent=True)
+    fig.savefig(heatmap_path(filepath, '.svg'), dpi=high_resolution_dpi, format='svg', bbox_inches='tight', pad_inches=0, transparent=True)
     plt.close(fig)
 
-print("Heatmaps have been generated and saved to", directory)
+# Function to generate the heatmap of one recording from its normalized data
+def generate_heatmap(df, filepath):
+    # Select the range of timepoints
+    df = df.iloc[:, start_timepoint:end_timepoint]
+
+    # Apply optional smoothing to each row (neuron trace)
+    df_processed = process_data(df, smoothing_enabled, smoothing_window_size)
+
+    # Optionally reorder the rows by a response property, with the sort script's load_sorted
+    if sort_by:
+        try:
+            df_processed = load_script(SORT_SCRIPT).load_sorted(filepath, sort_by, df_processed)
+        except (FileNotFoundError, ValueError) as e:
+            # No sort index for this recording, or none for the sort_by column
+            print(f"Warning: skipping {os.path.basename(filepath)}, it cannot be sorted by '{sort_by}': {e}")
+            return
+
+    if renderer == 'direct':
+        render_heatmap_direct(df_processed, filepath)
+    else:
+        render_heatmap_matplotlib(df_processed, filepath)
+
+# Function to generate the heatmap of one _normalized.csv file
+def process_file(filepath):
+    # Read the CSV file into a DataFrame
+    df = pd.read_csv(filepath, header=None)
+    generate_heatmap(df, filepath)
+
+def main(directory):
+    # Sort and loop over each CSV file in the directory alphabetically
+    for filepath in sorted(glob.glob(os.path.join(directory, '*_normalized.csv'))):
+        process_file(filepath)
+
+    print("Heatmaps have been generated and saved to", directory)
+
+if __name__ == '__main__':
+    main(directory)
@@ -1,9 +1,6 @@
 import os
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.cluster import KMeans
 
 # Configuration Parameters
 NUMBER_OF_CLUSTERS = 1  # Easily configurable number of clusters
@@ -11,6 +8,8 @@ SMOOTHING_WINDOW = 1
 ENABLE_SMOOTHING = True  # Toggle for smoothing
 COLOURMAP = 'inferno'  # Configurable colourmap for the plots
 CENTRE_RANGE = 0.4  # Centre of the colour range for the heatmap
+SAVE_HEATMAPS = True  # Save the sorted correlation heatmaps; matplotlib and seaborn are only imported when this is on
+FOLDER_PATH = '/Users/nbenfey/Desktop/PythonProcessing'
 
 def load_and_smooth_data(folder_path):
     data_dict = {}
@@ -30,30 +29,51 @@ def calculate_neuron_correlations_and_visualize(data_dict, output_folder):
     cluster_labels_dict = {}
 
     for file_name, data in data_dict.items():
-        corr_matrix_df = data.T.corr()
-        avg_corr = corr_matrix_df.values[np.triu_indices_from(corr_matrix_df, 1)].mean()
+        avg_corr, corr_matrix_df, cluster_labels = correlate_recording(file_name, data, output_folder)
         average_correlations[file_name] = avg_corr
         correlation_matrices[file_name] = corr_matrix_df
+        cluster_labels_dict[file_name] = cluster_labels
+
+    return average_correlations, correlation_matrices, cluster_labels_dict
+
+def neuron_correlation_matrix(data):
+    # Pearson correlation between every pair of neurons (rows)
+    return data.T.corr()
+
+def correlate_recording(file_name, data, output_folder):
+    corr_matrix_df = neuron_correlation_matrix(data)
+    avg_corr = corr_matrix_df.values[np.triu_indices_from(corr_matrix_df, 1)].mean()
 
+    if NUMBER_OF_CLUSTERS > 1:
+        from sklearn.cluster import KMeans
         kmeans = KMeans(n_clusters=NUMBER_OF_CLUSTERS, n_init=10, random_state=0)
         cluster_labels = kmeans.fit_predict(corr_matrix_df)
-        cluster_labels_dict[file_name] = cluster_labels
+    else:
+        # A single cluster holds every neuron, as K-means would return; scikit-learn is not needed
+        cluster_labels = np.zeros(len(corr_matrix_df), dtype=np.int32)
 
-        sorted_indices = np.argsort(cluster_labels)
-        sorted_corr_matrix = corr_matrix_df.iloc[sorted_indices, sorted_indices]
+    sorted_indices = np.argsort(cluster_labels)
+    sorted_corr_matrix = corr_matrix_df.iloc[sorted_indices, sorted_indices]
 
-        plt.figure(figsize=(10, 8))
-        sns.heatmap(sorted_corr_matrix, annot=False, cmap=COLOURMAP, center=CENTRE_RANGE, vmin=0, vmax=1)
-        plt.title(f"Sorted Neuron-to-Neuron Correlation for {file_name}")
-        sorted_heatmap_path = os.path.join(output_folder, f"{file_name}_neuron_corr_heatmap_sorted.png")
-        plt.savefig(sorted_heatmap_path, dpi=300)
-        plt.close()
+    if SAVE_HEATMAPS:
+        save_correlation_heatmap(sorted_corr_matrix, file_name, output_folder)
 
-        # Save sorted matrix as CSV
-        sorted_csv_path = os.path.join(output_folder, f"{file_name}_neuron_corr_sorted.csv")
-        sorted_corr_matrix.to_csv(sorted_csv_path, index=False)
+    # Save sorted matrix as CSV
+    sorted_csv_path = os.path.join(output_folder, f"{file_name}_neuron_corr_sorted.csv")
+    sorted_corr_matrix.to_csv(sorted_csv_path, index=False)
 
-    return average_correlations, correlation_matrices, cluster_labels_dict
+    return avg_corr, corr_matrix_df, cluster_labels
+
+def save_correlation_heatmap(sorted_corr_matrix, file_name, output_folder):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    plt.figure(figsize=(10, 8))
+    sns.heatmap(sorted_corr_matrix, annot=False, cmap=COLOURMAP, center=CENTRE_RANGE, vmin=0, vmax=1)
+    plt.title(f"Sorted Neuron-to-Neuron Correlation for {file_name}")
+    sorted_heatmap_path = os.path.join(output_folder, f"{file_name}_neuron_corr_heatmap_sorted.png")
+    plt.savefig(sorted_heatmap_path, dpi=300)
+    plt.close()
 
 def save_average_correlations_and_clusters(average_correlations, correlation_matrices, clustered_data, output_folder):
     average_correlations_df = pd.DataFrame(list(average_correlations.items()), columns=['File', 'Average_Correlation'])
@@ -79,8 +99,7 @@ def save_average_correlations_and_clusters(average_correlations, correlation_mat
         cluster_avg_corr_output_path = os.path.join(output_folder, f"{file_name}_cluster_avg_correlations.csv")
         cluster_avg_corr_df.to_csv(cluster_avg_corr_output_path, index=False)
 
-def main():
-    folder_path = '/Users/nbenfey/Desktop/PythonProcessing'
+def main(folder_path=FOLDER_PATH):
     output_folder = os.path.join(folder_path, 'CorrelationsNeurons')
     os.makedirs(output_folder, exist_ok=True)
 
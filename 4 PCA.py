@@ -1,18 +1,17 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
+# The pool workers run functions from an importable module (see cluster_scoring.py)
+from cluster_scoring import limit_worker_threads, score_cluster_count
 
 # Path to the directory containing your files
 directory = '/Users/nbenfey/Desktop/PythonProcessing'
 
-# Styling for plots
-sns.set(style='whitegrid')
-plt.rcParams['figure.figsize'] = (18, 6)
-
 # Configurable axes limits for the plots
 ORIGINAL_AXES_LIMITS = {'x': (-150, 150), 'y': (-100, 100)}
 TRANSPOSED_AXES_LIMITS = {'x': (-5, 30), 'y': (-6, 12)}
@@ -32,9 +31,24 @@ SMOOTHING_ENABLED = True
 # Number of clusters for K-means
 NUM_CLUSTERS = 5
 
+# Automatic cluster count: evaluate every k in CLUSTER_RANGE in parallel and pick one per recording
+AUTO_CLUSTERS = False
+CLUSTER_RANGE = range(2, 11)
+CLUSTER_SELECTION_METHOD = 'silhouette'  # 'silhouette' (highest score) or 'elbow' (inertia curve)
+CLUSTER_WORKERS = None  # Number of worker processes, None uses all CPUs
+RANDOM_SEED = 0  # Seed shared by every K-means fit so results are reproducible
+
 # Number of principal components
 N_COMPONENTS = 5
 
+# Pooled mode: build one shared PCA basis from all recordings instead of one basis per recording
+POOLED_PCA = False
+# Minimum number of rows passed to each IncrementalPCA.partial_fit call in pooled mode
+POOLED_BATCH_SIZE = 500
+# Also fit a shared transposed basis, with cells as features. Cell i is then taken to be the same neuron in every
+# recording, which only holds when the same field of view was re-imaged; every recording needs the same number of cells
+POOLED_TRANSPOSED_PCA = False
+
 # Display settings for plots
 SHOW_AXES = True
 SHOW_LABELS = True
@@ -48,17 +62,123 @@ STIMULI_WINDOWS = {
 }
 WINDOW_LENGTH = 150
 
+# Save trial-averaged stimulus trajectories and their metrics for the transposed PCA
+TRAJECTORY_METRICS_ENABLED = True
+
+@lru_cache(maxsize=None)
+def pyplot():
+    # matplotlib and seaborn are imported and styled on first use; pooled runs draw no figures and never load them
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    sns.set(style='whitegrid')
+    plt.rcParams['figure.figsize'] = (18, 6)
+    return plt
+
 def smooth_data(data, window):
     return data.rolling(window=window, min_periods=1, center=True).mean()
 
-def run_pca(data, suffix, ax, smoothing_enabled, n_components=N_COMPONENTS, window_length=WINDOW_LENGTH, stimuli_windows=STIMULI_WINDOWS, axes_limits=None, label_points=False):
+def gather_stimulus_trajectories(pca_df, onsets, window_length=WINDOW_LENGTH):
+    """Gathers the PC values following every onset in one indexing operation.
+    Returns an (n_trials, window_length + 1, n_components) array and the onsets whose window fits in the recording."""
+    values = pca_df.filter(regex=r'^PC\d+$').to_numpy()
+    onsets = np.asarray(onsets, dtype=int)
+    onsets = onsets[(onsets >= 0) & (onsets + window_length < len(values))]
+    return values[onsets[:, None] + np.arange(window_length + 1)], onsets
+
+def trajectory_metrics(trajectories):
+    """Path length and peak distance from the onset position for each trajectory in an (n, length, n_components) array."""
+    path_length = np.linalg.norm(np.diff(trajectories, axis=1), axis=2).sum(axis=1)
+    peak_distance = np.linalg.norm(trajectories - trajectories[:, :1], axis=2).max(axis=1)
+    return path_length, peak_distance
+
+def compute_stimulus_trajectories(pca_df, stimuli_windows=STIMULI_WINDOWS, window_length=WINDOW_LENGTH):
+    """Computes per-trial and trial-averaged trajectories in PC space for each stimulus type.
+    Returns a long table of the trajectories and a table of path length, peak distance from the onset position
+    and the separation between the trial-averaged trajectories of each pair of stimuli."""
+    pc_columns = list(pca_df.filter(regex=r'^PC\d+$').columns)
+    offsets = np.arange(window_length + 1)
+    trajectory_frames = []
+    metric_rows = []
+    averages = {}
+
+    for stimulus, onsets in stimuli_windows.items():
+        trials, onsets = gather_stimulus_trajectories(pca_df, onsets, window_length)
+        if len(trials) == 0:
+            continue
+        averages[stimulus] = trials.mean(axis=0)
+        stacked = np.concatenate([averages[stimulus][None], trials])
+        labels = ['Mean'] + [str(i + 1) for i in range(len(trials))]
+
+        frame = pd.DataFrame(stacked.reshape(-1, len(pc_columns)), columns=pc_columns)
+        frame.insert(0, 'Offset', np.tile(offsets, len(stacked)))
+        frame.insert(0, 'Trial', np.repeat(labels, len(offsets)))
+        frame.insert(0, 'Stimulus', stimulus)
+        trajectory_frames.append(frame)
+
+        path_length, peak_distance = trajectory_metrics(stacked)
+        onset_labels = [np.nan] + list(onsets)
+        for label, onset, length, distance in zip(labels, onset_labels, path_length, peak_distance):
+            metric_rows.append({'Stimulus': stimulus, 'Trial': label, 'Onset': onset,
+                                'Path Length': length, 'Peak Distance From Baseline': distance})
+
+    stimuli = list(averages)
+    for i, first in enumerate(stimuli):
+        for second in stimuli[i + 1:]:
+            separation = np.linalg.norm(averages[first] - averages[second], axis=1)
+            metric_rows.append({'Stimulus': f'{second} vs {first}', 'Trial': 'Mean',
+                                'Mean Separation': separation.mean(), 'Max Separation': separation.max()})
+
+    trajectories_df = pd.concat(trajectory_frames, ignore_index=True) if trajectory_frames else pd.DataFrame()
+    return trajectories_df, pd.DataFrame(metric_rows)
+
+def save_stimulus_trajectories(pca_df, file_path, suffix):
+    trajectories_df, metrics_df = compute_stimulus_trajectories(pca_df)
+    trajectories_df.to_csv(file_path.replace('_normalized.csv', f'_{suffix}_trajectories.csv'), index=False)
+    metrics_df.to_csv(file_path.replace('_normalized.csv', f'_{suffix}_trajectory_metrics.csv'), index=False)
+
+def elbow_index(inertias):
+    """Index of the inertia point farthest from the straight line joining the first and last points."""
+    if len(inertias) < 3:
+        return 0
+    x = np.linspace(0, 1, len(inertias))
+    y = (inertias - inertias.min()) / (np.ptp(inertias) or 1)
+    # Line from (0, y[0]) to (1, y[-1]); distance is proportional to the cross product
+    return int(np.argmax(np.abs((y[-1] - y[0]) * x - (y - y[0]))))
+
+def select_num_clusters(data, executor=None, cluster_range=CLUSTER_RANGE, method=CLUSTER_SELECTION_METHOD, seed=RANDOM_SEED):
+    """Scores every k in cluster_range (in parallel when an executor is given) and returns (best k, score table)."""
+    data = np.asarray(data)
+    ks = [k for k in cluster_range if 2 <= k < len(data)]
+    if not ks:
+        return min(NUM_CLUSTERS, len(data)), pd.DataFrame(columns=['k', 'Inertia', 'Silhouette', 'Selected'])
+
+    jobs = [(data, k, seed) for k in ks]
+    results = list(executor.map(score_cluster_count, jobs)) if executor else [score_cluster_count(job) for job in jobs]
+    scores = pd.DataFrame(results, columns=['k', 'Inertia', 'Silhouette'])
+
+    if method == 'silhouette':
+        best = scores['k'].iloc[scores['Silhouette'].values.argmax()]
+    elif method == 'elbow':
+        best = scores['k'].iloc[elbow_index(scores['Inertia'].values)]
+    else:
+        raise ValueError(f"Unknown cluster selection method: {method}")
+    scores['Selected'] = scores['k'] == best
+    return int(best), scores
+
+def run_pca(data, suffix, ax, smoothing_enabled, n_components=N_COMPONENTS, window_length=WINDOW_LENGTH, stimuli_windows=STIMULI_WINDOWS, axes_limits=None, label_points=False, executor=None, cluster_scores_path=None):
     data = StandardScaler().fit_transform(data)
-    pca = PCA(n_components=n_components)
+    pca = PCA(n_components=n_components, random_state=RANDOM_SEED)
     principal_components = pca.fit_transform(data)
     pca_df = pd.DataFrame(data=principal_components, columns=[f'PC{i+1}' for i in range(n_components)])
 
     if suffix.startswith('original'):
-        kmeans = KMeans(n_clusters=NUM_CLUSTERS, random_state=0, n_init='auto').fit(pca_df)
+        from sklearn.cluster import KMeans
+        num_clusters = NUM_CLUSTERS
+        if AUTO_CLUSTERS:
+            num_clusters, cluster_scores = select_num_clusters(pca_df, executor)
+            if cluster_scores_path:
+                cluster_scores.to_csv(cluster_scores_path, index=False)
+        kmeans = KMeans(n_clusters=num_clusters, random_state=RANDOM_SEED, n_init='auto').fit(pca_df)
         pca_df['cluster'] = kmeans.labels_
         scatter = ax.scatter(pca_df[f'PC{PC_X}'], pca_df[f'PC{PC_Y}'], c=pca_df['cluster'], cmap='viridis', s=100, alpha=0.7)
         
@@ -66,9 +186,9 @@ def run_pca(data, suffix, ax, smoothing_enabled, n_components=N_COMPONENTS, wind
             for i, point in pca_df.iterrows():
                 ax.annotate(str(i), (point[f'PC{PC_X}'], point[f'PC{PC_Y}']), textcoords="offset points", xytext=(0,10), ha='center')
         
-        cbar = plt.colorbar(scatter, ax=ax, ticks=range(NUM_CLUSTERS))
+        cbar = pyplot().colorbar(scatter, ax=ax, ticks=range(num_clusters))
         cbar.set_label('')
-        cbar.ax.set_yticklabels([f'Cluster {i}' for i in range(NUM_CLUSTERS)])
+        cbar.ax.set_yticklabels([f'Cluster {i}' for i in range(num_clusters)])
         
         if SHOW_TITLES:
             ax.set_title(f'PCA of Data with K-means Clustering - {suffix}')
@@ -79,9 +199,9 @@ def run_pca(data, suffix, ax, smoothing_enabled, n_components=N_COMPONENTS, wind
 
         for stimulus, onsets in stimuli_windows.items():
             color = (0.5, 0.5, 0.5) if stimulus == 'Dots' else (0.2, 0.2, 0.2)
-            for onset in onsets:
-                start, end = onset, onset + window_length
-                ax.plot(pca_df.loc[start:end, 'PC1'], pca_df.loc[start:end, 'PC2'], color=color, linestyle='-')
+            trials, _ = gather_stimulus_trajectories(pca_df, onsets, window_length)
+            for trial in trials:
+                ax.plot(trial[:, 0], trial[:, 1], color=color, linestyle='-')
 
         if SHOW_TITLES:
             ax.set_title(f'PCA of Data - {suffix}')
@@ -100,6 +220,7 @@ def run_pca(data, suffix, ax, smoothing_enabled, n_components=N_COMPONENTS, wind
     return pca_df, pca.explained_variance_ratio_
 
 def plot_time_series(pca_df, n_components, axes_limits=TIMESERIES_AXES_LIMITS):
+    plt = pyplot()
     fig, axs = plt.subplots(n_components, 1, figsize=(18, 6 * n_components))
     
     for i in range(n_components):
@@ -120,10 +241,8 @@ def plot_time_series(pca_df, n_components, axes_limits=TIMESERIES_AXES_LIMITS):
     plt.tight_layout()
     return fig
 
-def process_all_files(directory, start_timepoint, end_timepoint, smoothing_enabled=SMOOTHING_ENABLED, n_components=N_COMPONENTS):
-    variance_original = []
-    variance_transposed = []
-    
+def iter_recordings(directory, start_timepoint, end_timepoint, smoothing_enabled=SMOOTHING_ENABLED):
+    """Yields (name, file_path, data, data_transposed) for each _normalized.csv file, one recording in memory at a time."""
     # Process files in alphabetical order
     for file in sorted(os.listdir(directory)):
         if file.endswith('_normalized.csv'):
@@ -137,19 +256,32 @@ def process_all_files(directory, start_timepoint, end_timepoint, smoothing_enabl
             data_smoothed = smooth_data(data_original, SMOOTHING_WINDOW) if smoothing_enabled else data_original
             data_transposed = data_original.T
             data_transposed_smoothed = smooth_data(data_transposed, SMOOTHING_WINDOW) if smoothing_enabled else data_transposed
-            
+
+            yield file.replace('_normalized.csv', ''), file_path, data_smoothed, data_transposed_smoothed
+
+def process_all_files(directory, start_timepoint, end_timepoint, smoothing_enabled=SMOOTHING_ENABLED, n_components=N_COMPONENTS):
+    plt = pyplot()
+    variance_original = []
+    variance_transposed = []
+    # The worker pool is created once and reused for the cluster-count search of every recording; it is shut down on errors too
+    with ProcessPoolExecutor(max_workers=CLUSTER_WORKERS, initializer=limit_worker_threads) if AUTO_CLUSTERS else nullcontext() as executor:
+        for name, file_path, data_smoothed, data_transposed_smoothed in iter_recordings(directory, start_timepoint, end_timepoint, smoothing_enabled):
             fig, axs = plt.subplots(1, 2, figsize=(18, 6))
-            
-            pca_df_orig, variance_orig = run_pca(data_smoothed, 'original_smoothed', axs[0], smoothing_enabled, n_components, axes_limits=ORIGINAL_AXES_LIMITS)
+        
+            cluster_scores_path = file_path.replace('_normalized.csv', '_cluster_scores.csv')
+            pca_df_orig, variance_orig = run_pca(data_smoothed, 'original_smoothed', axs[0], smoothing_enabled, n_components, axes_limits=ORIGINAL_AXES_LIMITS, executor=executor, cluster_scores_path=cluster_scores_path)
             pca_csv_path_orig = file_path.replace('_normalized.csv', '_pca_original.csv')
             pca_df_orig.to_csv(pca_csv_path_orig, index=False)
-            variance_original.append([file.replace('_normalized.csv', ''), *variance_orig])
-            
+            variance_original.append([name, *variance_orig])
+        
             pca_df_trans, variance_trans = run_pca(data_transposed_smoothed, 'transposed_smoothed', axs[1], smoothing_enabled, n_components, axes_limits=TRANSPOSED_AXES_LIMITS)
             pca_csv_path_trans = file_path.replace('_normalized.csv', '_pca_transposed.csv')
             pca_df_trans.to_csv(pca_csv_path_trans, index=False)
-            variance_transposed.append([file.replace('_normalized.csv', ''), *variance_trans])
-            
+            variance_transposed.append([name, *variance_trans])
+
+            if TRAJECTORY_METRICS_ENABLED:
+                save_stimulus_trajectories(pca_df_trans, file_path, 'pca')
+        
             plt.tight_layout()
             plt.savefig(file_path.replace('_normalized.csv', '_pca_analysis.png'), transparent=False, dpi=300)
             plt.close()
@@ -158,10 +290,84 @@ def process_all_files(directory, start_timepoint, end_timepoint, smoothing_enabl
             time_series_fig.savefig(file_path.replace('_normalized.csv', '_transposed_plot.png'), transparent=False, dpi=300)
             plt.close(time_series_fig)
 
-            print(f'Processed file: {file} - PCA data saved to: {pca_csv_path_orig}, {pca_csv_path_trans}')
+            print(f'Processed file: {os.path.basename(file_path)} - PCA data saved to: {pca_csv_path_orig}, {pca_csv_path_trans}')
 
     pd.DataFrame(variance_original, columns=['File'] + [f'PC{i+1}' for i in range(n_components)]).to_csv(os.path.join(directory, 'PCAVariance_original.csv'), index=False)
     pd.DataFrame(variance_transposed, columns=['File'] + [f'PC{i+1}' for i in range(n_components)]).to_csv(os.path.join(directory, 'PCAVariance_transposed.csv'), index=False)
 
+def feed_incremental_pca(pca, pending, block, batch_size, final=False):
+    """Buffers rows and calls partial_fit once at least batch_size rows are available.
+    The last n_components rows are held back so the final batch is never too small to fit."""
+    if block is not None:
+        pending.append(np.asarray(block))
+    rows = sum(len(b) for b in pending)
+    reserve = 0 if final else pca.n_components
+    if rows > 0 and (final or rows >= batch_size + reserve):
+        if rows < pca.n_components:
+            raise ValueError(f"Pooled PCA needs at least {pca.n_components} rows, got {rows}.")
+        stacked = np.vstack(pending)
+        pca.partial_fit(stacked[:rows - reserve])
+        pending[:] = [stacked[rows - reserve:]] if reserve else []
+    return pending
+
+def process_all_files_pooled(directory, start_timepoint, end_timepoint, smoothing_enabled=SMOOTHING_ENABLED, n_components=N_COMPONENTS, batch_size=POOLED_BATCH_SIZE, transposed=POOLED_TRANSPOSED_PCA):
+    """Fits one shared PCA basis across all recordings and projects every recording into it, and with transposed
+    a shared basis with the cells as features too. Files are streamed three times (scaling, fitting, projection)
+    so memory stays bounded by a single recording."""
+    def recordings():
+        return iter_recordings(directory, start_timepoint, end_timepoint, smoothing_enabled)
+
+    # Pass 1: shared standardization statistics
+    scalers = {'original': StandardScaler()}
+    if transposed:
+        scalers['transposed'] = StandardScaler()
+    cell_counts = set()
+    for name, file_path, data_original, data_transposed in recordings():
+        scalers['original'].partial_fit(data_original.values)
+        cell_counts.add(data_original.shape[0])
+        if transposed and len(cell_counts) == 1:
+            scalers['transposed'].partial_fit(data_transposed.values)
+
+    if not cell_counts:
+        print(f'No _normalized.csv files found in {directory}')
+        return
+    if transposed and len(cell_counts) > 1:
+        # Cells are the features of the transposed basis, so it only exists when every recording has the same cells
+        print(f'Recordings have different numbers of cells {sorted(cell_counts)} - skipping the shared transposed basis.')
+        del scalers['transposed']
+
+    # Pass 2: incremental fit of the shared bases
+    batch_size = max(batch_size, n_components)
+    pcas = {basis: IncrementalPCA(n_components=n_components) for basis in scalers}
+    pending = {basis: [] for basis in scalers}
+    for name, file_path, data_original, data_transposed in recordings():
+        blocks = {'original': data_original, 'transposed': data_transposed}
+        for basis, scaler in scalers.items():
+            feed_incremental_pca(pcas[basis], pending[basis], scaler.transform(blocks[basis].values), batch_size)
+    for basis in pcas:
+        feed_incremental_pca(pcas[basis], pending[basis], None, batch_size, final=True)
+
+    # Pass 3: project every recording into the shared bases
+    columns = [f'PC{i+1}' for i in range(n_components)]
+    for name, file_path, data_original, data_transposed in recordings():
+        blocks = {'original': data_original, 'transposed': data_transposed}
+        for basis, scaler in scalers.items():
+            pca_df = pd.DataFrame(pcas[basis].transform(scaler.transform(blocks[basis].values)), columns=columns)
+            pca_df.to_csv(file_path.replace('_normalized.csv', f'_pca_pooled_{basis}.csv'), index=False)
+            if basis == 'transposed' and TRAJECTORY_METRICS_ENABLED:
+                # Trajectories in the shared basis are directly comparable between sessions
+                trajectory_df = smooth_data(pca_df, LINE_SMOOTHING_WINDOW) if smoothing_enabled else pca_df
+                save_stimulus_trajectories(trajectory_df, file_path, 'pca_pooled')
+        print(f'Processed file: {os.path.basename(file_path)} - projected into shared basis ({", ".join(scalers)})')
+
+    variance = [[basis, *pca.explained_variance_ratio_] for basis, pca in pcas.items()]
+    pd.DataFrame(variance, columns=['Basis'] + columns).to_csv(os.path.join(directory, 'PCAVariance_pooled.csv'), index=False)
+
+def main(directory, start_timepoint=0, end_timepoint=4500):
+    if POOLED_PCA:
+        process_all_files_pooled(directory, start_timepoint, end_timepoint)
+    else:
+        process_all_files(directory, start_timepoint, end_timepoint)
+
 if __name__ == '__main__':
-    process_all_files(directory, 0, 4500)
+    main(directory)
@@ -1,7 +1,7 @@
 import pandas as pd
 import numpy as np
 import os
-import csv
+from pipeline_scripts import load_script
 
 # Define the path to the directory containing the files
 path = '/Users/nbenfey/Desktop/PythonProcessing'
@@ -10,26 +10,81 @@ path = '/Users/nbenfey/Desktop/PythonProcessing'
 bins = [0, 0.01, 0.02, 0.03, 0.04, 0.05, 0.06, 0.07, 0.08, 0.09, 0.10, np.inf]
 bin_labels = ["'0-1'", "'1-2'", "'2-3'", "'3-4'", "'4-5'", "'5-6'", "'6-7'", "'7-8'", "'8-9'", "'9-10'", "'10+'"]
 
-# Prepare the results file, adjust the path to your preferred location
-output_filename = '/Users/nbenfey/Desktop/PythonProcessing/ResponseAmplitudesNeurons.csv'
-with open(output_filename, mode='w', newline='') as file:
-    writer = csv.writer(file)
-    writer.writerow(['Filename', 'Stimulus', 'Bin', 'Count'])
+# Columns to bin, in output order
+HISTOGRAM_COLUMNS = ['Avg Peak Loom', 'Avg Peak Dots']
 
+# Optional histograms pooled over all files of a condition or of an animal
+PER_CONDITION_HISTOGRAMS = False
+PER_ANIMAL_HISTOGRAMS = False
+
+# Conditions and file name pattern used for the pooled histograms are those of the grouping script, which also parses the file names
+grouping = load_script('4 group average neuronal properties by animal.py')
+CONDITIONS = grouping.CONDITIONS
+FILENAME_PATTERN = grouping.FILENAME_PATTERN
+
+# Name of the results file, saved in the data directory unless main is given another path
+output_name = 'ResponseAmplitudesNeurons.csv'
+
+def load_amplitudes(path, filenames, columns=HISTOGRAM_COLUMNS):
+    """Loads the histogram columns of every file into one table with a categorical Filename column."""
+    frames = []
+    for filename in filenames:
+        df = pd.read_csv(os.path.join(path, filename), usecols=columns)
+        df.insert(0, 'Filename', filename)
+        frames.append(df)
+    table = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=['Filename', *columns])
+    table['Filename'] = pd.Categorical(table['Filename'], categories=filenames)
+    return table
+
+def add_metadata(table, conditions=CONDITIONS, pattern=FILENAME_PATTERN):
+    """Adds categorical Animal and Condition columns parsed once per file name."""
+    pattern = grouping.compile_pattern(pattern, conditions)
+    metadata = {filename: grouping.parse_metadata(filename, pattern, conditions) for filename in table['Filename'].cat.categories}
+    files = table['Filename'].astype(object)
+    table['Animal'] = files.map(lambda f: metadata[f]['Animal']).astype('category')
+    table['Condition'] = pd.Categorical(files.map(lambda f: metadata[f]['Condition']), categories=conditions)
+    return table
+
+def histogram_table(table, group_column, columns=HISTOGRAM_COLUMNS, edges=bins, labels=bin_labels):
+    """Long-format bin counts of every column per group.
+    All values are binned with one searchsorted over the fixed edges and counted with one bincount."""
+    groups = table[group_column].cat.codes.to_numpy()
+    categories = table[group_column].cat.categories
+    n_bins = len(edges) - 1
+
+    values = table[columns].to_numpy(dtype=float)
+    # Bins are closed on the left like pd.cut(..., right=False); values outside the edges or NaN are not counted
+    codes = np.searchsorted(edges, values, side='right') - 1
+    valid = (codes >= 0) & (codes < n_bins) & ~np.isnan(values) & (groups >= 0)[:, None]
+
+    column_index = np.broadcast_to(np.arange(len(columns)), values.shape)
+    keys = (groups[:, None] * len(columns) + column_index) * n_bins + codes
+    counts = np.bincount(keys[valid], minlength=len(categories) * len(columns) * n_bins)
+
+    return pd.DataFrame({
+        group_column: np.repeat(np.asarray(categories), len(columns) * n_bins),
+        'Stimulus': np.tile(np.repeat(columns, n_bins), len(categories)),
+        'Bin': np.tile(labels, len(categories) * len(columns)),
+        'Count': counts,
+    })
+
+def main(path, output_filename=None):
+    if output_filename is None:
+        output_filename = os.path.join(path, output_name)
     # Get all files that end with 'average_neuronal_properties.csv' and sort them alphabetically
     filenames = sorted([f for f in os.listdir(path) if f.endswith('average_neuronal_properties.csv')])
+    table = load_amplitudes(path, filenames)
 
-    # Process each file in alphabetical order
-    for filename in filenames:
-        full_path = os.path.join(path, filename)
-        df = pd.read_csv(full_path)
+    histogram_table(table, 'Filename').to_csv(output_filename, index=False)
 
-        for column in ['Avg Peak Loom', 'Avg Peak Dots']:
-            # Count values in each bin
-            counts = pd.cut(df[column], bins=bins, labels=bin_labels, right=False).value_counts().sort_index()
+    if PER_CONDITION_HISTOGRAMS or PER_ANIMAL_HISTOGRAMS:
+        table = add_metadata(table)
+    if PER_CONDITION_HISTOGRAMS:
+        histogram_table(table, 'Condition').to_csv(output_filename.replace('.csv', 'ByCondition.csv'), index=False)
+    if PER_ANIMAL_HISTOGRAMS:
+        histogram_table(table, 'Animal').to_csv(output_filename.replace('.csv', 'ByAnimal.csv'), index=False)
 
-            # Write results to the CSV
-            for bin_label, count in counts.items():
-                writer.writerow([filename, column, bin_label, count])
+    print(f"Processing complete. Results are saved in {output_filename}")
 
-print(f"Processing complete. Results are saved in {output_filename}")
+if __name__ == '__main__':
+    main(path)
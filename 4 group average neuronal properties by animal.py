@@ -1,86 +1,245 @@
+import numpy as np
 import pandas as pd
 import glob
 import os
+import re
 
 # Define the directory where the files are located
 directory = "/Users/nbenfey/Desktop/PythonProcessing"
 
-# Pattern to match files ending with _average_neuronal_properties.csv
-file_pattern = os.path.join(directory, "*_average_neuronal_properties.csv")
-
-# Find all files in the directory matching the pattern
-csv_files = glob.glob(file_pattern)
-
-# Sort the file paths alphabetically
-csv_files = sorted(csv_files)
-
-# Prepare a list to store the averages for each file
-averages_list = []
-
-# Prepare lists to store the Selectivity Index (Peak) values for Baseline and Norepinephrine
-selectivity_index_baseline = []
-selectivity_index_norepinephrine = []
-
-# Loop through each file
-for file_path in csv_files:
-    try:
-        # Read the CSV file into a DataFrame
-        df = pd.read_csv(file_path)
-
-        # Ensure there are at least 7 columns
-        if df.shape[1] >= 7:
-            # Get the column names based on their indices
-            col_names = df.columns[[4, 5, 6]]
-
-            # Calculate the average for the specified columns by their indices
-            averages = df.iloc[:, [4, 5, 6]].mean()
-
-            # Append the averages and the file name (for identification) to the list
-            averages_list.append({
-                "File Name": os.path.basename(file_path),
-                col_names[0] + " Average": averages[0],
-                col_names[1] + " Average": averages[1],
-                col_names[2] + " Average": averages[2]
-            })
-            
-            # Extract Selectivity Index (Peak) values based on file name
-            selectivity_index_values = df.iloc[:, 4].values
-            if "Baseline" in file_path:
-                selectivity_index_baseline.extend(selectivity_index_values)
-            elif "Norepinephrine" in file_path:
-                selectivity_index_norepinephrine.extend(selectivity_index_values)
-        else:
-            print(f"Warning: File '{file_path}' does not have enough columns.")
-
-    except Exception as e:
-        print(f"Error processing file '{file_path}': {e}")
-
-# Convert the list of averages into a DataFrame
-averages_df = pd.DataFrame(averages_list)
-
-# Define the output file path for the first CSV
-output_file_path_averages = os.path.join(directory, "AveragesPerAnimal.csv")
-
-# Save the averages DataFrame to a CSV file
-averages_df.to_csv(output_file_path_averages, index=False)
-
-print(f"Output CSV file has been saved to '{output_file_path_averages}'.")
-
-# Prepare a DataFrame for the Selectivity Index (Peak) values
-# The lengths of the two lists may differ, so we'll fill the shorter list with NaNs
-max_length = max(len(selectivity_index_baseline), len(selectivity_index_norepinephrine))
-selectivity_index_baseline.extend([float('nan')] * (max_length - len(selectivity_index_baseline)))
-selectivity_index_norepinephrine.extend([float('nan')] * (max_length - len(selectivity_index_norepinephrine)))
-
-selectivity_df = pd.DataFrame({
-    "Baseline Selectivity Index (Peak)": selectivity_index_baseline,
-    "Norepinephrine Selectivity Index (Peak)": selectivity_index_norepinephrine
-})
-
-# Define the output file path for the second CSV
-output_file_path_selectivity = os.path.join(directory, "CumulativeProbability.csv")
-
-# Save the selectivity index DataFrame to a CSV file
-selectivity_df.to_csv(output_file_path_selectivity, index=False)
-
-print(f"Output CSV file for Selectivity Index (Peak) has been saved to '{output_file_path_selectivity}'.")
+# Conditions to compare, in output order. Any number of conditions can be listed.
+CONDITIONS = ["Baseline", "Norepinephrine"]
+
+# Regular expression used to read metadata from each file name. The named groups 'animal', 'timepoint' and
+# 'condition' are used when present; '{conditions}' is replaced by the names in CONDITIONS.
+# The default reads Animal_Timepoint_Condition_... names, and Animal_Condition_... names without a timepoint.
+# A file the pattern finds no condition in gets the first name of CONDITIONS found anywhere in its file name.
+FILENAME_PATTERN = r"^(?P<animal>[^_]+)_(?:(?P<timepoint>[^_]+)_)?.*?(?P<condition>{conditions})"
+
+# Columns averaged per file, animal and condition
+AVERAGE_COLUMNS = ["Selectivity Index (Peak)", "Avg Peak Loom", "Avg Peak Dots"]
+
+# Column compiled for the cumulative probability comparison between conditions
+SELECTIVITY_COLUMN = "Selectivity Index (Peak)"
+
+# Number of points in the common grid on which the empirical CDFs are evaluated
+ECDF_GRID_POINTS = 500
+
+# Hierarchical bootstrap of condition differences: animals are resampled, then cells within each resampled animal
+BOOTSTRAP_RESAMPLES = 10000
+BOOTSTRAP_SEED = 0
+CONFIDENCE_LEVEL = 0.95
+BOOTSTRAP_MAX_ELEMENTS = 5_000_000  # Upper bound on resamples x animals x cells held in memory at once
+
+METADATA_COLUMNS = ["Animal", "Timepoint", "Condition"]
+
+def compile_pattern(pattern, conditions):
+    """Substitutes the configured condition names into the file name pattern."""
+    return re.compile(pattern.replace("{conditions}", "|".join(re.escape(c) for c in conditions)))
+
+def parse_metadata(file_name, pattern, conditions=CONDITIONS):
+    """Returns the animal, timepoint and condition encoded in a file name (None where not found)."""
+    match = pattern.search(file_name)
+    groups = match.groupdict() if match else {}
+    metadata = {column: groups.get(column.lower()) for column in METADATA_COLUMNS}
+    if metadata["Condition"] is None:
+        metadata["Condition"] = next((condition for condition in conditions if condition in file_name), None)
+    return metadata
+
+def load_properties_table(csv_files, conditions=CONDITIONS, pattern=FILENAME_PATTERN, columns=AVERAGE_COLUMNS):
+    """Reads every properties file once and concatenates them into one table with one row per cell.
+    Metadata parsed from the file names is stored as categorical columns next to the float value columns."""
+    pattern = compile_pattern(pattern, conditions)
+    frames = []
+    for file_path in csv_files:
+        try:
+            # Parsing the values as floats here reports a file with non-numeric values and skips it
+            df = pd.read_csv(file_path, usecols=lambda column: column in columns, dtype="float64")
+        except Exception as e:
+            print(f"Error processing file '{file_path}': {e}")
+            continue
+
+        missing = [column for column in columns if column not in df.columns]
+        if missing:
+            print(f"Warning: File '{file_path}' does not have the columns {missing}.")
+            continue
+
+        file_name = os.path.basename(file_path)
+        df = df[columns]
+        df.insert(0, "File Name", file_name)
+        metadata = parse_metadata(file_name, pattern, conditions)
+        if metadata["Condition"] is None:
+            print(f"Warning: No condition of {conditions} found in '{file_name}'; its cells are left out of the condition summaries.")
+        for column, value in metadata.items():
+            df[column] = value
+        frames.append(df)
+
+    if not frames:
+        return pd.DataFrame(columns=["File Name", *columns, *METADATA_COLUMNS])
+
+    table = pd.concat(frames, ignore_index=True)
+    table["File Name"] = pd.Categorical(table["File Name"], categories=[os.path.basename(f) for f in csv_files])
+    table["Animal"] = table["Animal"].astype("category")
+    table["Timepoint"] = table["Timepoint"].astype("category")
+    table["Condition"] = pd.Categorical(table["Condition"], categories=conditions, ordered=True)
+    return table
+
+def average_per_file(table, columns=AVERAGE_COLUMNS):
+    """Averages each column per file, keeping the parsed metadata of the file."""
+    grouped = table.groupby("File Name", observed=True, sort=True)
+    averages = grouped[columns].mean().add_suffix(" Average")
+    metadata = grouped[METADATA_COLUMNS].first()
+    return averages.join(metadata).reset_index()
+
+def average_per_animal(table, columns=AVERAGE_COLUMNS):
+    """Averages each column over all cells of an animal in each condition and timepoint."""
+    keys = ["Animal", "Condition", "Timepoint"]
+    grouped = table.groupby(keys, observed=True, dropna=False)
+    summary = grouped[columns].mean().add_suffix(" Average")
+    summary["Number of Files"] = grouped["File Name"].nunique()
+    summary["Number of Cells"] = grouped.size()
+    return summary.reset_index()
+
+def average_per_condition(per_animal, columns=AVERAGE_COLUMNS):
+    """Averages the per-animal values in each condition, so every animal carries the same weight."""
+    average_columns = [f"{column} Average" for column in columns]
+    grouped = per_animal.dropna(subset=["Condition"]).groupby("Condition", observed=True)
+    summary = grouped[average_columns].mean()
+    summary = summary.join(grouped[average_columns].sem().rename(columns=lambda c: c.replace(" Average", " SEM")))
+    summary["Number of Animals"] = grouped["Animal"].nunique()
+    summary["Number of Cells"] = grouped["Number of Cells"].sum()
+    return summary.reset_index()
+
+def compile_selectivity(table, conditions=CONDITIONS, column=SELECTIVITY_COLUMN):
+    """One column of per-cell values for each condition; shorter columns are padded with NaN."""
+    values = {
+        f"{condition} {column}": group[column].reset_index(drop=True)
+        for condition, group in table.groupby("Condition", observed=True)
+    }
+    return pd.DataFrame(values).reindex(columns=[f"{condition} {column}" for condition in conditions])
+
+def finite_values(table, condition, column=SELECTIVITY_COLUMN):
+    """Values of one condition with NaN and infinite selectivity indices removed."""
+    values = table.loc[table["Condition"] == condition, column].to_numpy()
+    return values[np.isfinite(values)]
+
+def compute_ecdfs(table, conditions=CONDITIONS, column=SELECTIVITY_COLUMN, grid_points=ECDF_GRID_POINTS):
+    """Evaluates the empirical CDF of every condition on one common grid spanning all finite values."""
+    samples = {condition: np.sort(finite_values(table, condition, column)) for condition in conditions}
+    pooled = np.concatenate(list(samples.values()))
+    grid = np.linspace(pooled.min(), pooled.max(), grid_points) if len(pooled) else np.array([])
+    ecdfs = pd.DataFrame({column: grid})
+    for condition, values in samples.items():
+        ecdfs[condition] = np.searchsorted(values, grid, side="right") / len(values) if len(values) else np.nan
+    return ecdfs
+
+def pack_by_animal(table, condition, animals, column=SELECTIVITY_COLUMN):
+    """Packs the finite values of one condition into an (animals, cells) array padded with NaN, plus the cell count per animal."""
+    subset = table.loc[table["Condition"] == condition, ["Animal", column]]
+    subset = subset[np.isfinite(subset[column].to_numpy())]
+    codes = pd.Categorical(subset["Animal"], categories=animals).codes
+    values = subset[column].to_numpy()[codes >= 0]
+    codes = codes[codes >= 0]
+
+    counts = np.bincount(codes, minlength=len(animals))
+    order = np.argsort(codes, kind="stable")
+    positions = np.arange(len(codes)) - np.repeat(np.cumsum(counts) - counts, counts)
+    packed = np.full((len(animals), max(counts.max(initial=0), 1)), np.nan)
+    packed[codes[order], positions] = values[order]
+    return packed, counts
+
+def resampled_means(packed, counts, drawn, rng):
+    """Mean over all cells of each resample, where drawn holds the animals of each resample (resamples, animals)."""
+    cells_per_draw = counts[drawn][..., None]
+    cells = (rng.random(drawn.shape + (packed.shape[1],), dtype=np.float32) * cells_per_draw).astype(np.intp)
+    valid = np.arange(packed.shape[1]) < cells_per_draw
+    sampled = np.where(valid, packed[drawn[..., None], cells], 0.0)
+    totals = sampled.sum(axis=(1, 2))
+    n = valid.sum(axis=(1, 2))
+    return np.divide(totals, n, out=np.full(len(totals), np.nan), where=n > 0)
+
+def hierarchical_bootstrap(table, condition, reference, column=SELECTIVITY_COLUMN, resamples=BOOTSTRAP_RESAMPLES, seed=BOOTSTRAP_SEED):
+    """Bootstrap distribution of the difference in mean between a condition and the reference condition.
+    The same animals are drawn for both conditions in each resample, so animals recorded in both stay paired."""
+    rng = np.random.default_rng(seed)
+    subset = table[table["Condition"].isin([condition, reference])]
+    animals = sorted(subset["Animal"].dropna().unique())
+    if not animals:
+        print(f"Warning: No animal metadata in the file names, skipping the bootstrap for {condition}.")
+        return np.array([])
+    packed_condition, counts_condition = pack_by_animal(table, condition, animals, column)
+    packed_reference, counts_reference = pack_by_animal(table, reference, animals, column)
+
+    # Evaluate resamples in chunks so memory stays bounded however many cells and animals there are
+    cells = max(packed_condition.shape[1], packed_reference.shape[1])
+    chunk_size = max(1, BOOTSTRAP_MAX_ELEMENTS // (len(animals) * cells))
+    differences = []
+    for start in range(0, resamples, chunk_size):
+        drawn = rng.integers(0, len(animals), size=(min(chunk_size, resamples - start), len(animals)))
+        differences.append(resampled_means(packed_condition, counts_condition, drawn, rng)
+                           - resampled_means(packed_reference, counts_reference, drawn, rng))
+    return np.concatenate(differences)
+
+def compare_conditions(table, conditions=CONDITIONS, column=SELECTIVITY_COLUMN):
+    """KS statistic and hierarchical bootstrap confidence interval for each condition against the first one."""
+    # scipy.stats is slow to import and only needed here
+    from scipy.stats import ks_2samp
+    reference = conditions[0]
+    reference_values = finite_values(table, reference, column)
+    rows = []
+    for condition in conditions[1:]:
+        values = finite_values(table, condition, column)
+        if len(values) == 0 or len(reference_values) == 0:
+            print(f"Warning: No finite {column} values to compare {condition} with {reference}.")
+            continue
+
+        ks = ks_2samp(values, reference_values)
+        differences = hierarchical_bootstrap(table, condition, reference, column)
+        differences = differences[np.isfinite(differences)]
+        tail = (1 - CONFIDENCE_LEVEL) / 2
+        ci_low, ci_high = np.quantile(differences, [tail, 1 - tail]) if len(differences) else (np.nan, np.nan)
+        bootstrap_p = min(1.0, 2 * min((differences <= 0).mean(), (differences >= 0).mean())) if len(differences) else np.nan
+        rows.append({
+            "Condition": condition,
+            "Reference": reference,
+            "Number of Animals": table.loc[table["Condition"] == condition, "Animal"].nunique(),
+            "Number of Cells": len(values),
+            "KS Statistic": ks.statistic,
+            "KS p-value": ks.pvalue,
+            "Mean Difference": values.mean() - reference_values.mean(),
+            "Bootstrap CI Low": ci_low,
+            "Bootstrap CI High": ci_high,
+            "Bootstrap p-value": bootstrap_p,
+        })
+    return pd.DataFrame(rows)
+
+def main(directory, conditions=CONDITIONS, pattern=FILENAME_PATTERN):
+    # Find all files ending with _average_neuronal_properties.csv, sorted alphabetically
+    csv_files = sorted(glob.glob(os.path.join(directory, "*_average_neuronal_properties.csv")))
+    table = load_properties_table(csv_files, conditions, pattern)
+
+    output_file_path_averages = os.path.join(directory, "AveragesPerAnimal.csv")
+    average_per_file(table).to_csv(output_file_path_averages, index=False)
+    print(f"Output CSV file has been saved to '{output_file_path_averages}'.")
+
+    per_animal = average_per_animal(table)
+    output_file_path_animal = os.path.join(directory, "AveragesPerAnimalCondition.csv")
+    per_animal.to_csv(output_file_path_animal, index=False)
+
+    output_file_path_condition = os.path.join(directory, "AveragesPerCondition.csv")
+    average_per_condition(per_animal).to_csv(output_file_path_condition, index=False)
+    print(f"Per-animal and per-condition summaries have been saved to '{output_file_path_animal}' and '{output_file_path_condition}'.")
+
+    output_file_path_selectivity = os.path.join(directory, "CumulativeProbability.csv")
+    compile_selectivity(table, conditions).to_csv(output_file_path_selectivity, index=False)
+    print(f"Output CSV file for {SELECTIVITY_COLUMN} has been saved to '{output_file_path_selectivity}'.")
+
+    output_file_path_ecdf = os.path.join(directory, "CumulativeProbabilityECDF.csv")
+    compute_ecdfs(table, conditions).to_csv(output_file_path_ecdf, index=False)
+
+    output_file_path_statistics = os.path.join(directory, "SelectivityStatistics.csv")
+    compare_conditions(table, conditions).to_csv(output_file_path_statistics, index=False)
+    print(f"Empirical CDFs and condition statistics have been saved to '{output_file_path_ecdf}' and '{output_file_path_statistics}'.")
+
+if __name__ == "__main__":
+    main(directory)
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import os
 
@@ -11,50 +12,81 @@ sort_options = {
     '3': 'Avg Peak Dots'
 }
 
+# A permutation index for every sort option is always saved to <name>_sort_index.csv.
+# Set WRITE_SORTED_COPIES to True to also write a full _sorted_by_*.csv copy for sort_option.
+WRITE_SORTED_COPIES = False
+
 # Set your sorting option here: '1' for Selectivity Index (Peak), '2' for Avg Peak Loom, '3' for Avg Peak Dots
 sort_option = '3'
 
-# Function to sort and save the normalized data based on the specified column in the smoothed file
-def sort_and_save(normalized_file, smoothed_file, column):
-    # Load the normalized data
-    normalized_data = pd.read_csv(normalized_file, header=None)
-    
-    # Load the smoothed data
+def sort_index_path(normalized_file):
+    return normalized_file.replace("_normalized.csv", "_sort_index.csv")
+
+def sort_permutation(values):
+    """Row order that sorts the values in descending order, with NaN rows last."""
+    order = np.argsort(values, kind='stable')[::-1]
+    is_nan = np.isnan(values[order])
+    return np.concatenate([order[~is_nan], order[is_nan]])
+
+# Function to save the row order of the normalized data for every sort column of the smoothed file
+def save_sort_index(normalized_file, smoothed_file, columns):
+    # Only the properties are read; the normalized traces are never loaded or rewritten
     smoothed_data = pd.read_csv(smoothed_file)
-    
-    # Get the sort column index
-    sort_column_index = smoothed_data.columns.get_loc(column)
-    
-    # Sort the normalized data based on the smoothed data column
-    sorted_data = normalized_data.iloc[smoothed_data.iloc[:, sort_column_index].argsort()[::-1]]
-    
+    missing = [column for column in columns if column not in smoothed_data.columns]
+    if missing:
+        print(f"Columns for sorting not found in {smoothed_file}: {missing}")
+
+    permutations = pd.DataFrame({
+        column: sort_permutation(smoothed_data[column].to_numpy(dtype=float))
+        for column in columns if column in smoothed_data.columns
+    })
+    index_filename = sort_index_path(normalized_file)
+    permutations.to_csv(index_filename, index=False)
+    print(f"Sort index saved as: {index_filename}")
+
+def load_sorted(normalized_file, column, data=None):
+    """Returns the normalized traces in the order of one sort column, using the saved permutation index.
+    Pass already loaded data to avoid reading the normalized file again. Nothing is written to disk."""
+    order = pd.read_csv(sort_index_path(normalized_file), usecols=[column])[column].to_numpy()
+    if data is None:
+        data = pd.read_csv(normalized_file, header=None)
+    return data.iloc[order]
+
+# Function to save a full sorted copy of the normalized data based on the specified column
+def sort_and_save(normalized_file, column):
+    sorted_data = load_sorted(normalized_file, column)
+
     # Save the sorted normalized data
     sorted_filename = normalized_file.replace("_normalized.csv", f"_sorted_by_{column.replace(' ', '_')}.csv")
     sorted_data.to_csv(sorted_filename, index=False, header=False)
     print(f"Sorted file saved as: {sorted_filename}")
 
-# List all csv files in the directory
-files = os.listdir(directory)
-
-# Process each pair of files
-for file in files:
-    if file.endswith('_normalized.csv'):
-        base_name = file.replace('_normalized.csv', '')
-        smoothed_file = f"{base_name}_normalized_smoothed.csv"
-
-        normalized_file_path = os.path.join(directory, file)
-        smoothed_file_path = os.path.join(directory, smoothed_file)
-        
-        if smoothed_file in files:
-            print(f"Processing: {normalized_file_path} and {smoothed_file_path}")
-            
-            # Check if the selected sort option is valid
-            try:
-                # Proceed with sorting if the column is in the smoothed file
-                sort_and_save(normalized_file_path, smoothed_file_path, sort_options[sort_option])
-            except KeyError:
-                print(f"Column for sorting not found in {smoothed_file_path}.")
-            except Exception as e:
-                print(f"An error occurred: {e}")
-        else:
-            print(f"No matching smoothed file found for {file}")
+def main(directory):
+    # List all csv files in the directory
+    files = sorted(os.listdir(directory))
+
+    # Process each pair of files
+    for file in files:
+        if file.endswith('_normalized.csv'):
+            base_name = file.replace('_normalized.csv', '')
+            smoothed_file = f"{base_name}_normalized_smoothed.csv"
+
+            normalized_file_path = os.path.join(directory, file)
+            smoothed_file_path = os.path.join(directory, smoothed_file)
+
+            if smoothed_file in files:
+                print(f"Processing: {normalized_file_path} and {smoothed_file_path}")
+
+                try:
+                    save_sort_index(normalized_file_path, smoothed_file_path, list(sort_options.values()))
+                    if WRITE_SORTED_COPIES:
+                        sort_and_save(normalized_file_path, sort_options[sort_option])
+                except KeyError:
+                    print(f"Column for sorting not found in {smoothed_file_path}.")
+                except Exception as e:
+                    print(f"An error occurred: {e}")
+            else:
+                print(f"No matching smoothed file found for {file}")
+
+if __name__ == '__main__':
+    main(directory)
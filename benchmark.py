@@ -0,0 +1,189 @@
+"""Benchmarks every pipeline stage on synthetic recordings of increasing size.
+
+For each cell count a synthetic dataset is generated once (synthetic_data.py) and kept for later
+runs. The stages of pipeline_runner.py are then run in order, each in a fresh Python process, so
+the peak memory of every stage is measured on its own. Each result row records the wall time of
+the process (including interpreter start-up and imports), the time spent in the stage itself,
+the peak RSS, and the throughput in cells x frames per second.
+
+Results are appended to benchmark_results.csv under a label. Compare two labels to catch
+regressions, or benchmark an alternative engine by overriding script settings of a stage:
+
+    python benchmark.py --cells 50 500 5000 --label before
+    python benchmark.py --cells 50 500 5000 --label direct-heatmaps --set "heatmap:renderer='direct'"
+    python benchmark.py --compare before --label after
+"""
+import argparse
+import ast
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+import pipeline_runner
+from synthetic_data import generate_dataset
+
+# === Configuration Parameters ===
+BENCHMARK_DIRECTORY = os.path.join(tempfile.gettempdir(), 'pipeline_benchmark')  # Datasets and results
+CELL_COUNTS = [50, 500, 5000]  # Use e.g. --cells 20000 for the largest recordings
+FRAMES = 4500
+ANIMALS = 2  # Two animals x two conditions = four recordings per dataset
+SEED = 0
+STAGE_TIMEOUT = 3600  # Seconds before a stage is stopped and recorded as timed out
+REGRESSION_THRESHOLD = 1.2  # A stage is flagged when it is this many times slower than the baseline
+# Sorting needs hand-made smoothed property files, which the synthetic datasets do not have
+STAGES = [stage for stage in pipeline_runner.STAGES if stage != 'sorting']
+
+def dataset_directory(n_cells, n_frames=FRAMES, seed=SEED):
+    return os.path.join(BENCHMARK_DIRECTORY, f'cells{n_cells}_frames{n_frames}_seed{seed}')
+
+def prepare_dataset(n_cells, n_frames=FRAMES, animals=ANIMALS, seed=SEED):
+    """Generates the raw recordings of a dataset, or reuses them from an earlier run.
+    Outputs of earlier benchmark runs are removed so every run starts from the raw files."""
+    directory = dataset_directory(n_cells, n_frames, seed)
+    raw_directory = os.path.join(directory, 'raw')
+    if not os.path.exists(os.path.join(raw_directory, '.complete')):
+        shutil.rmtree(directory, ignore_errors=True)
+        generate_dataset(raw_directory, n_cells, n_frames, animals, seed=seed)
+        open(os.path.join(raw_directory, '.complete'), 'w').close()
+
+    work_directory = os.path.join(directory, 'work')
+    shutil.rmtree(work_directory, ignore_errors=True)
+    os.makedirs(work_directory)
+    for file_name in os.listdir(raw_directory):
+        if file_name.endswith('.csv'):
+            # Hard links avoid copying gigabytes of raw data; the stages never modify their inputs
+            try:
+                os.link(os.path.join(raw_directory, file_name), os.path.join(work_directory, file_name))
+            except OSError:
+                shutil.copy(os.path.join(raw_directory, file_name), work_directory)
+    return work_directory
+
+def run_stage(directory, stage, settings, timing_file):
+    """Runs the tasks of one stage in this process (called in the child process)."""
+    start = time.perf_counter()
+    pipeline_runner.initialize_worker(directory)
+    tasks = [task for task in pipeline_runner.build_tasks(directory) if task.stage == stage]
+    for task in tasks:
+        pipeline_runner.run_task(task.script, task.function, task.args, {**task.settings, **settings})
+    with open(timing_file, 'w') as f:
+        json.dump({'run_s': time.perf_counter() - start, 'tasks': len(tasks)}, f)
+
+def measure_stage(directory, stage, settings, timeout=STAGE_TIMEOUT):
+    """Runs one stage in a fresh Python process and returns its timings, peak RSS and status."""
+    timing_file = os.path.join(directory, f'.timing_{stage}.json')
+    log_file = os.path.join(directory, f'benchmark_{stage}.log')
+    command = [sys.executable, os.path.abspath(__file__), '--run-stage', stage, directory, '--settings', json.dumps(settings), '--timing-file', timing_file]
+    start = time.perf_counter()
+    with open(log_file, 'w') as log:
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(os.path.abspath(__file__)))
+        # os.wait4 reports the resource use of this child alone, unlike getrusage(RUSAGE_CHILDREN)
+        status = 'timeout'
+        while time.perf_counter() - start < timeout:
+            pid, exit_status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                status = 'ok' if os.waitstatus_to_exitcode(exit_status) == 0 else 'failed'
+                break
+            time.sleep(0.05)
+        else:
+            process.send_signal(signal.SIGKILL)
+            _, _, usage = os.wait4(process.pid, 0)
+        process.returncode = 0  # Already reaped by os.wait4
+    wall = time.perf_counter() - start
+
+    timing = {'run_s': float('nan'), 'tasks': 0}
+    if status == 'ok' and os.path.exists(timing_file):
+        with open(timing_file) as f:
+            timing = json.load(f)
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    peak_rss = usage.ru_maxrss / (2**20 if sys.platform == 'darwin' else 2**10)
+    return {'status': status, 'wall_s': wall, 'run_s': timing['run_s'], 'tasks': timing['tasks'], 'peak_rss_mb': peak_rss, 'log': log_file}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+def parse_settings(assignments):
+    """Turns ["heatmap:renderer='direct'", ...] into {'heatmap': {'renderer': 'direct'}}."""
+    settings = {}
+    for assignment in assignments:
+        target, value = assignment.split('=', 1)
+        stage, name = target.split(':', 1)
+        settings.setdefault(stage, {})[name] = ast.literal_eval(value)
+    return settings
+
+def run_benchmark(cell_counts=CELL_COUNTS, n_frames=FRAMES, animals=ANIMALS, stages=STAGES, settings=None, label='current', results_file=None):
+    """Benchmarks the stages on every dataset size and appends the rows to the results file."""
+    settings = settings or {}
+    results_file = results_file or os.path.join(BENCHMARK_DIRECTORY, 'benchmark_results.csv')
+    commit = git_commit()
+    rows = []
+    for n_cells in cell_counts:
+        directory = prepare_dataset(n_cells, n_frames, animals)
+        recordings = len(pipeline_runner.find_recordings(directory))
+        for stage in stages:
+            result = measure_stage(directory, stage, settings.get(stage, {}))
+            cells_x_frames = n_cells * n_frames * recordings
+            row = {
+                'label': label, 'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'), 'commit': commit,
+                'stage': stage, 'cells': n_cells, 'frames': n_frames, 'recordings': recordings,
+                'settings': json.dumps(settings.get(stage, {})), 'status': result['status'],
+                'wall_s': result['wall_s'], 'run_s': result['run_s'], 'peak_rss_mb': result['peak_rss_mb'],
+                'throughput_mcells_frames_s': cells_x_frames / result['run_s'] / 1e6 if result['run_s'] > 0 else float('nan'),
+            }
+            rows.append(row)
+            print(f"{n_cells:>6} cells  {stage:<12} {result['status']:<8} run {result['run_s']:8.2f} s  wall {result['wall_s']:8.2f} s  "
+                  f"peak RSS {result['peak_rss_mb']:8.0f} MB  {row['throughput_mcells_frames_s']:8.2f} Mcells*frames/s")
+            if result['status'] != 'ok':
+                print(f"    see {result['log']}")
+
+    results = pd.DataFrame(rows)
+    results.to_csv(results_file, mode='a', header=not os.path.exists(results_file), index=False)
+    print(f"Results appended to {results_file}")
+    return results
+
+def compare(results_file, baseline, label, threshold=REGRESSION_THRESHOLD):
+    """Compares the latest run of two labels per stage and size. Returns the number of regressions."""
+    results = pd.read_csv(results_file)
+    results = results[results['status'] == 'ok']
+    latest = lambda name: results[results['label'] == name].drop_duplicates(['stage', 'cells', 'frames'], keep='last')
+    merged = latest(baseline).merge(latest(label), on=['stage', 'cells', 'frames'], suffixes=('_baseline', ''))
+    merged['ratio'] = merged['run_s'] / merged['run_s_baseline']
+    merged['memory_ratio'] = merged['peak_rss_mb'] / merged['peak_rss_mb_baseline']
+    merged['flag'] = ['REGRESSION' if ratio > threshold else ('faster' if ratio < 1 / threshold else '') for ratio in merged['ratio']]
+    print(merged[['stage', 'cells', 'run_s_baseline', 'run_s', 'ratio', 'peak_rss_mb_baseline', 'peak_rss_mb', 'memory_ratio', 'flag']]
+          .to_string(index=False, float_format=lambda value: f'{value:.2f}'))
+    return int((merged['flag'] == 'REGRESSION').sum())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the pipeline stages on synthetic data.')
+    parser.add_argument('--cells', type=int, nargs='+', default=CELL_COUNTS)
+    parser.add_argument('--frames', type=int, default=FRAMES)
+    parser.add_argument('--animals', type=int, default=ANIMALS)
+    parser.add_argument('--stages', default=','.join(STAGES))
+    parser.add_argument('--label', default='current', help='Name under which the results are stored')
+    parser.add_argument('--set', action='append', default=[], metavar="STAGE:NAME=VALUE", help='Override a script setting for one stage')
+    parser.add_argument('--results', default=None, help='Results CSV (default: benchmark_results.csv in the benchmark directory)')
+    parser.add_argument('--compare', metavar='BASELINE', help='Compare the latest results of --label with this label instead of running')
+    parser.add_argument('--run-stage', nargs=2, metavar=('STAGE', 'DIRECTORY'), help=argparse.SUPPRESS)
+    parser.add_argument('--settings', default='{}', help=argparse.SUPPRESS)
+    parser.add_argument('--timing-file', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.run_stage:
+        run_stage(options.run_stage[1], options.run_stage[0], json.loads(options.settings), options.timing_file)
+    elif options.compare:
+        results_file = options.results or os.path.join(BENCHMARK_DIRECTORY, 'benchmark_results.csv')
+        raise SystemExit(1 if compare(results_file, options.compare, options.label) else 0)
+    else:
+        run_benchmark(options.cells, options.frames, options.animals, options.stages.split(','), parse_settings(options.set),
+                      options.label, options.results)
@@ -0,0 +1,19 @@
+"""K-means scoring for the cluster-count search of 4 PCA.py.
+
+The functions run in worker processes, so they live in this importable module: a process started with
+spawn (the default on macOS and Windows) cannot import a script that was loaded by file name.
+"""
+
+def limit_worker_threads():
+    # One OpenMP/BLAS thread per worker so the pool does not oversubscribe the CPUs
+    from threadpoolctl import threadpool_limits
+    global _worker_thread_limits
+    _worker_thread_limits = threadpool_limits(limits=1)
+
+def score_cluster_count(args):
+    """Fits K-means for a single k and returns (k, inertia, silhouette score)."""
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import silhouette_score
+    data, k, seed = args
+    kmeans = KMeans(n_clusters=k, random_state=seed, n_init='auto').fit(data)
+    return k, kmeans.inertia_, silhouette_score(data, kmeans.labels_)
@@ -0,0 +1,214 @@
+"""Checks that an alternative engine reproduces the outputs of the current scripts.
+
+The reference (the pipeline stages with their default settings) and the alternative engine run on
+hard-linked copies of the same input files, each in a fresh Python process. Every CSV either of
+them writes is then compared column by column. Numeric columns must agree within the tolerance
+of the first matching entry in TOLERANCES (|alternative - reference| <= atol + rtol * |reference|).
+Text columns must match exactly. The report lists the maximum absolute and relative error per
+column, and the run times and speedup of the two engines.
+
+An alternative engine is either the same stages with some script settings overridden, or a
+different function that processes the whole directory:
+
+    python equivalence_harness.py <inputs> --stages heatmap,auc --set "auc:SOME_SETTING=True"
+    python equivalence_harness.py <inputs> --comparison fused-stage2
+
+The exit status is 1 when any output differs beyond its tolerance or is missing.
+"""
+import argparse
+import fnmatch
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import pipeline_runner
+from benchmark import parse_settings
+
+# === Configuration Parameters ===
+WORK_DIRECTORY = os.path.join(tempfile.gettempdir(), 'pipeline_equivalence')
+REPORT_FILE = 'equivalence_report.csv'
+
+# (file pattern, column pattern, absolute tolerance, relative tolerance, compare up to sign); first match wins
+TOLERANCES = [
+    # Principal components are only defined up to their sign
+    ('*_pca_*.csv', 'PC*', 1e-6, 1e-4, True),
+    ('*_pca_*.csv', '*', 1e-6, 1e-4, False),
+    ('PCAVariance_*.csv', '*', 1e-6, 1e-4, False),
+    ('*', '*', 1e-9, 1e-6, False),
+]
+
+# Named comparisons: the reference stages and the alternative engine that should reproduce them
+COMPARISONS = {
+    'fused-stage2': {
+        'reference': {'stages': ['auc', 'heatmap', 'stimulus', 'cell_counts']},
+        'alternative': {'script': '2 fused single-read runner.py', 'function': 'process_all_files'},
+    },
+}
+
+def run_engine(directory, engine, timing_file):
+    """Runs an engine in this process (called in the child process).
+    An engine is {'stages': [...], 'settings': {stage: {name: value}}} or {'script': ..., 'function': ...}."""
+    pipeline_runner.initialize_worker(directory)
+    start = time.perf_counter()
+    if 'script' in engine:
+        pipeline_runner.run_task(engine['script'], engine['function'], (directory,), engine.get('settings', {}))
+    else:
+        tasks = pipeline_runner.build_tasks(directory)
+        for stage in engine['stages']:
+            for task in tasks:
+                if task.stage == stage:
+                    settings = {**task.settings, **engine.get('settings', {}).get(stage, {})}
+                    pipeline_runner.run_task(task.script, task.function, task.args, settings)
+    with open(timing_file, 'w') as f:
+        json.dump({'run_s': time.perf_counter() - start}, f)
+
+def prepare_directory(inputs, directory):
+    """Links the input CSV files into an empty work directory and returns their names."""
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    names = sorted(name for name in os.listdir(inputs) if name.endswith('.csv'))
+    for name in names:
+        try:
+            os.link(os.path.join(inputs, name), os.path.join(directory, name))
+        except OSError:
+            shutil.copy(os.path.join(inputs, name), directory)
+    return set(names)
+
+def execute(directory, engine):
+    """Runs an engine in a fresh Python process and returns its run time in seconds."""
+    timing_file = os.path.join(directory, '.timing.json')
+    command = [sys.executable, os.path.abspath(__file__), '--run-engine', directory, json.dumps(engine), timing_file]
+    with open(os.path.join(directory, 'engine.log'), 'w') as log:
+        subprocess.run(command, stdout=log, stderr=subprocess.STDOUT, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    with open(timing_file) as f:
+        return json.load(f)['run_s']
+
+def output_files(directory, inputs):
+    outputs = set()
+    for root, _, files in os.walk(directory):
+        for name in files:
+            relative_path = os.path.relpath(os.path.join(root, name), directory)
+            if name.endswith('.csv') and relative_path not in inputs:
+                outputs.add(relative_path)
+    return outputs
+
+def read_table(file_path):
+    """Reads a CSV as text cells. The first row is taken as a header when it holds text above numbers."""
+    table = pd.read_csv(file_path, header=None, dtype=str, keep_default_na=False)
+    if len(table) > 1:
+        first, second = (pd.to_numeric(table.iloc[row], errors='coerce') for row in (0, 1))
+        if (first.isna() & second.notna()).any():
+            table.columns = table.iloc[0].astype(str)
+            return table.iloc[1:].reset_index(drop=True)
+    table.columns = [str(column) for column in table.columns]
+    return table
+
+def tolerance_for(file_name, column):
+    for file_pattern, column_pattern, atol, rtol, sign_invariant in TOLERANCES:
+        if fnmatch.fnmatch(os.path.basename(file_name), file_pattern) and fnmatch.fnmatch(column, column_pattern):
+            return atol, rtol, sign_invariant
+    return 0.0, 0.0, False
+
+def compare_column(reference, alternative, atol, rtol, sign_invariant):
+    """Returns (max absolute error, max relative error, number of values outside the tolerance)."""
+    ref_numbers = pd.to_numeric(reference, errors='coerce').to_numpy(dtype=float)
+    alt_numbers = pd.to_numeric(alternative, errors='coerce').to_numpy(dtype=float)
+    is_text = np.isnan(ref_numbers) & (reference.to_numpy() != '') & ~reference.str.lower().isin(['nan', 'inf', '-inf']).to_numpy()
+    text_mismatches = int((reference.to_numpy()[is_text] != alternative.to_numpy()[is_text]).sum())
+
+    numeric = ~is_text
+    ref_values, alt_values = ref_numbers[numeric], alt_numbers[numeric]
+    if sign_invariant and len(ref_values) and np.nansum(ref_values * alt_values) < 0:
+        alt_values = -alt_values
+    with np.errstate(invalid='ignore', divide='ignore'):
+        error = np.abs(alt_values - ref_values)
+        # Matching NaN and infinite values count as equal, a NaN on one side only as an infinite error
+        same = (ref_values == alt_values) | (np.isnan(ref_values) & np.isnan(alt_values))
+        error[same] = 0.0
+        error[np.isnan(ref_values) != np.isnan(alt_values)] = np.inf
+        relative = np.where(ref_values != 0, error / np.abs(ref_values), np.where(error > 0, np.inf, 0.0))
+        outside = error > atol + rtol * np.where(np.isfinite(ref_values), np.abs(ref_values), 0.0)
+    max_abs = float(np.nanmax(error)) if len(error) else 0.0
+    max_rel = float(np.nanmax(relative)) if len(relative) else 0.0
+    return max_abs, max_rel, int(outside.sum()) + text_mismatches
+
+def compare_outputs(reference_directory, alternative_directory, inputs):
+    """One report row per column of every output file of either engine."""
+    reference_files = output_files(reference_directory, inputs)
+    alternative_files = output_files(alternative_directory, inputs)
+    rows = []
+    for file_name in sorted(reference_files | alternative_files):
+        if file_name not in alternative_files or file_name not in reference_files:
+            rows.append({'file': file_name, 'column': '', 'status': 'missing in ' + ('alternative' if file_name in reference_files else 'reference')})
+            continue
+        reference = read_table(os.path.join(reference_directory, file_name))
+        alternative = read_table(os.path.join(alternative_directory, file_name))
+        if reference.shape != alternative.shape or list(reference.columns) != list(alternative.columns):
+            rows.append({'file': file_name, 'column': '', 'status': f'shape or columns differ: {reference.shape} vs {alternative.shape}'})
+            continue
+        for position, column in enumerate(reference.columns):
+            atol, rtol, sign_invariant = tolerance_for(file_name, column)
+            max_abs, max_rel, mismatches = compare_column(reference.iloc[:, position], alternative.iloc[:, position], atol, rtol, sign_invariant)
+            rows.append({'file': file_name, 'column': column, 'values': len(reference), 'max_abs_error': max_abs,
+                         'max_rel_error': max_rel, 'atol': atol, 'rtol': rtol, 'mismatches': mismatches,
+                         'status': 'ok' if mismatches == 0 else 'differs'})
+    return pd.DataFrame(rows, columns=['file', 'column', 'values', 'max_abs_error', 'max_rel_error', 'atol', 'rtol', 'mismatches', 'status'])
+
+def run_harness(inputs, reference, alternative, work_directory=WORK_DIRECTORY):
+    """Runs both engines on the inputs, compares their outputs and prints a summary. Returns the report."""
+    inputs = os.path.abspath(inputs)
+    reference_directory = os.path.join(work_directory, 'reference')
+    alternative_directory = os.path.join(work_directory, 'alternative')
+    input_names = prepare_directory(inputs, reference_directory)
+    prepare_directory(inputs, alternative_directory)
+
+    reference_time = execute(reference_directory, reference)
+    alternative_time = execute(alternative_directory, alternative)
+    report = compare_outputs(reference_directory, alternative_directory, input_names)
+    report_path = os.path.join(work_directory, REPORT_FILE)
+    report.to_csv(report_path, index=False)
+
+    failures = report[report['status'] != 'ok']
+    for _, row in failures.iterrows():
+        print(f"{row['file']} {row['column']}: {row['status']}"
+              + (f" (max abs {row['max_abs_error']:.3g}, max rel {row['max_rel_error']:.3g}, {row['mismatches']} values)" if row['status'] == 'differs' else ''))
+    compared = report[report['status'].isin(['ok', 'differs'])]
+    print(f"{report['file'].nunique()} files, {len(compared)} columns compared, {len(failures)} failures")
+    if len(compared):
+        print(f"Largest errors: {compared['max_abs_error'].max():.3g} absolute, {compared['max_rel_error'].max():.3g} relative")
+    print(f"Reference {reference_time:.2f} s, alternative {alternative_time:.2f} s, speedup {reference_time / alternative_time:.2f}x")
+    print(f"Report saved to {report_path}")
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the outputs of an alternative engine with the current scripts.')
+    parser.add_argument('inputs', nargs='?', help='Directory with the input CSV files (raw or _normalized.csv)')
+    parser.add_argument('--comparison', choices=sorted(COMPARISONS), help='Run a named comparison')
+    parser.add_argument('--stages', help='Stages to run for both engines, e.g. normalize,auc')
+    parser.add_argument('--set', action='append', default=[], metavar="STAGE:NAME=VALUE", help='Script setting of the alternative engine')
+    parser.add_argument('--work-directory', default=WORK_DIRECTORY)
+    parser.add_argument('--run-engine', nargs=3, metavar=('DIRECTORY', 'ENGINE', 'TIMING_FILE'), help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.run_engine:
+        run_engine(options.run_engine[0], json.loads(options.run_engine[1]), options.run_engine[2])
+        raise SystemExit(0)
+    # inputs is optional only for the internal --run-engine call
+    if options.inputs is None:
+        parser.error('the inputs directory is required')
+    if options.comparison:
+        reference, alternative = COMPARISONS[options.comparison]['reference'], COMPARISONS[options.comparison]['alternative']
+    elif options.stages:
+        stages = options.stages.split(',')
+        reference, alternative = {'stages': stages}, {'stages': stages, 'settings': parse_settings(options.set)}
+    else:
+        parser.error('give --comparison or --stages')
+    report = run_harness(options.inputs, reference, alternative, options.work_directory)
+    raise SystemExit(0 if (report['status'] == 'ok').all() else 1)
@@ -0,0 +1,263 @@
+"""Opt-in timing and resource report for the analysis scripts.
+
+Set the PIPELINE_PROFILE environment variable to turn it on for pipeline_runner.py, job_queue.py and
+the fused stage 2 runner, or run any single script through this module:
+
+    PIPELINE_PROFILE=1 python pipeline_runner.py <directory>
+    python instrumentation.py "2 count traces AUC tectal neurons.py" [--report <path>]
+    python instrumentation.py worker1.json --merge worker2.json ... [--report <path>]
+
+Every function defined in a script is wrapped. For each script function and recording it records
+the number of calls, wall time, CPU time, peak RSS, bytes read and written (Linux only) and the
+cells x frames passed in as its first array argument. Times and bytes include nested calls.
+
+A call that receives a recording's CSV path makes that recording the current one for the calls
+that follow it in the same parent call, so loops that read a file and then process its traces are
+attributed to the right recording. Calls made outside any recording are reported with an empty
+recording name.
+
+The report is written to <base>.json and <base>.csv, where <base> is the value of PIPELINE_PROFILE
+(or pipeline_profile when it is set to 1), and a summary per function is printed.
+"""
+import argparse
+import ast
+import functools
+import inspect
+import json
+import os
+import sys
+import threading
+import time
+import types
+
+ENABLED = os.environ.get('PIPELINE_PROFILE', '') not in ('', '0')
+DEFAULT_REPORT = 'pipeline_profile'
+SUMMARY_ROWS = 25  # Functions shown in the printed summary, by total wall time
+
+FIELDS = ['script', 'function', 'recording', 'calls', 'wall_s', 'cpu_s', 'peak_rss_mb', 'read_mb', 'written_mb', 'cells_x_frames']
+
+_records = {}
+_lock = threading.Lock()
+_context = threading.local()
+
+def report_base(directory=None):
+    base = os.environ.get('PIPELINE_PROFILE', '')
+    if base in ('', '0', '1'):
+        base = DEFAULT_REPORT
+    return os.path.join(directory, base) if directory and not os.path.isabs(base) else base
+
+def io_counters():
+    """Bytes read and written by this process so far, or None where /proc/self/io is not available."""
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far, or 0 where the resource module is not available (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+def recording_name(value):
+    """Recording a CSV path belongs to, e.g. A1_T1_Baseline for .../A1_T1_Baseline_normalized_AUC.csv."""
+    if not (isinstance(value, str) and value.endswith('.csv')):
+        return None
+    from pipeline_runner import DERIVED_FILE_PATTERN
+    name = DERIVED_FILE_PATTERN.split(os.path.splitext(os.path.basename(value))[0])[0]
+    return name or None
+
+def find_recording(values):
+    for value in values:
+        name = recording_name(value)
+        if name:
+            return name
+    return None
+
+def array_size(values):
+    for value in values:
+        shape = getattr(value, 'shape', None)
+        if shape is not None and len(shape) in (1, 2):
+            size = 1
+            for length in shape:
+                size *= length
+            return size
+    return 0
+
+def current_frames():
+    if not hasattr(_context, 'frames'):
+        # The bottom frame holds the recording of calls made outside any instrumented function
+        _context.frames = [{'recording': None}]
+    return _context.frames
+
+def set_recording(name):
+    # The recording applies to this call and to the following calls of its caller, if that is a script function too
+    frames = current_frames()
+    frames[-1]['recording'] = name
+    if len(frames) > 2:
+        frames[-2]['recording'] = name
+
+class measure:
+    """Context manager adding one call of a stage to the report."""
+    def __init__(self, script, function, recording=None, size=0):
+        self.script, self.function, self.recording, self.size = script, function, recording, size
+
+    def __enter__(self):
+        frames = current_frames()
+        frames.append({'recording': frames[-1]['recording']})
+        if self.recording:
+            set_recording(self.recording)
+        # Calls are attributed to the recording current when they start, not to the last one they touched
+        self.recording = frames[-1]['recording']
+        self.io = io_counters()
+        self.cpu = time.process_time()
+        self.wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.wall
+        cpu = time.process_time() - self.cpu
+        io = io_counters()
+        read, written = (io[0] - self.io[0], io[1] - self.io[1]) if io and self.io else (0, 0)
+        current_frames().pop()
+        with _lock:
+            record = _records.setdefault((self.script, self.function, self.recording or ''), dict.fromkeys(FIELDS[3:], 0))
+            record['calls'] += 1
+            record['wall_s'] += wall
+            record['cpu_s'] += cpu
+            record['peak_rss_mb'] = max(record['peak_rss_mb'], peak_rss_mb())
+            record['read_mb'] += read / 2**20
+            record['written_mb'] += written / 2**20
+            record['cells_x_frames'] += self.size
+        return False
+
+def stage(function, recording=None, data=None, script=''):
+    """Measures a block of code as a stage: `with stage('data.T.corr()', recording, data): ...`."""
+    return measure(script, function, recording, array_size([data]))
+
+def wrap(function, script):
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def generator_wrapper(*args, **kwargs):
+            # Every step of the generator is one call; a yielded recording path becomes the current recording
+            iterator = function(*args, **kwargs)
+            while True:
+                with measure(script, function.__name__, find_recording([*args, *kwargs.values()])) as step:
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                    values = item if isinstance(item, tuple) else (item,)
+                    step.size = array_size(values)
+                    recording = find_recording(values)
+                    if recording:
+                        set_recording(recording)
+                        step.recording = recording
+                yield item
+        return generator_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        values = [*args, *kwargs.values()]
+        with measure(script, function.__name__, find_recording(values), array_size(values)):
+            return function(*args, **kwargs)
+    return wrapper
+
+def instrument(module, force=False):
+    """Wraps every function defined in a loaded script. Does nothing unless profiling is enabled."""
+    if not (ENABLED or force) or getattr(module, '_instrumented', False):
+        return module
+    script = os.path.basename(getattr(module, '__file__', '') or module.__name__)
+    for name, value in list(vars(module).items()):
+        if inspect.isfunction(value) and value.__module__ == module.__name__:
+            setattr(module, name, wrap(value, script))
+    module._instrumented = True
+    return module
+
+def take_records():
+    """Returns the records collected so far as a list of rows and clears them (e.g. to send them to another process)."""
+    with _lock:
+        rows = [dict(zip(FIELDS[:3], key), **values) for key, values in _records.items()]
+        _records.clear()
+    return rows
+
+def merge_records(rows):
+    with _lock:
+        for row in rows:
+            record = _records.setdefault((row['script'], row['function'], row['recording']), dict.fromkeys(FIELDS[3:], 0))
+            for field in FIELDS[3:]:
+                record[field] = max(record[field], row[field]) if field == 'peak_rss_mb' else record[field] + row[field]
+
+def summarize(rows):
+    """Totals per script function over all recordings, sorted by wall time."""
+    totals = {}
+    for row in rows:
+        total = totals.setdefault((row['script'], row['function']), dict.fromkeys(FIELDS[3:], 0))
+        total['recordings'] = total.get('recordings', 0) + bool(row['recording'])
+        for field in FIELDS[3:]:
+            total[field] = max(total[field], row[field]) if field == 'peak_rss_mb' else total[field] + row[field]
+    return sorted(totals.items(), key=lambda item: -item[1]['wall_s'])
+
+def print_summary(rows):
+    print(f"{'Script function':<60} {'calls':>7} {'rec.':>4} {'wall s':>8} {'cpu s':>8} {'RSS MB':>8} {'read MB':>8} {'write MB':>8} {'Mcell*fr/s':>10}")
+    for (script, function), total in summarize(rows)[:SUMMARY_ROWS]:
+        throughput = total['cells_x_frames'] / total['wall_s'] / 1e6 if total['wall_s'] and total['cells_x_frames'] else float('nan')
+        label = f"{os.path.splitext(script)[0][:38]}: {function}"
+        print(f"{label[:60]:<60} {total['calls']:>7} {total['recordings']:>4} {total['wall_s']:>8.2f} {total['cpu_s']:>8.2f} "
+              f"{total['peak_rss_mb']:>8.0f} {total['read_mb']:>8.1f} {total['written_mb']:>8.1f} {throughput:>10.2f}")
+
+def write_report(base=None, rows=None):
+    """Writes the collected records (or the given rows) to <base>.json and <base>.csv and prints the summary."""
+    import pandas as pd
+    base = base or report_base()
+    rows = take_records() if rows is None else rows
+    with open(f'{base}.json', 'w') as f:
+        json.dump(rows, f, indent=1)
+    pd.DataFrame(rows, columns=FIELDS).sort_values(['script', 'function', 'recording']).to_csv(f'{base}.csv', index=False)
+    print_summary(rows)
+    print(f"Profile saved to {base}.json and {base}.csv")
+
+def is_main_guard(node):
+    return (isinstance(node, ast.If) and isinstance(node.test, ast.Compare)
+            and isinstance(node.test.left, ast.Name) and node.test.left.id == '__name__')
+
+def run_script(path, argv=()):
+    """Runs a script as __main__ with its functions instrumented: the module body first, then the __main__ block."""
+    path = os.path.abspath(path)
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    main_blocks = [node for node in tree.body if is_main_guard(node)]
+    definitions = ast.Module([node for node in tree.body if node not in main_blocks], type_ignores=[])
+
+    module = types.ModuleType('__main__')
+    module.__file__ = path
+    previous_main, previous_argv = sys.modules['__main__'], sys.argv
+    sys.modules['__main__'], sys.argv = module, [path, *argv]
+    sys.path.insert(0, os.path.dirname(path))
+    try:
+        exec(compile(definitions, path, 'exec'), module.__dict__)
+        instrument(module, force=True)
+        exec(compile(ast.Module(main_blocks, type_ignores=[]), path, 'exec'), module.__dict__)
+    finally:
+        sys.modules['__main__'], sys.argv = previous_main, previous_argv
+        sys.path.remove(os.path.dirname(path))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run an analysis script with per-function timing and resource use.')
+    parser.add_argument('script')
+    parser.add_argument('--report', default=None, help='Report path without extension (default: PIPELINE_PROFILE or pipeline_profile)')
+    parser.add_argument('--merge', nargs='*', metavar='JSON', help='Instead of running a script, combine saved JSON reports with this one')
+    options, script_args = parser.parse_known_args()
+    if options.merge is not None:
+        for report in [options.script, *options.merge]:
+            with open(report) as f:
+                merge_records(json.load(f))
+    else:
+        run_script(options.script, script_args)
+    write_report(options.report)
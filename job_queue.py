@@ -0,0 +1,290 @@
+"""File-lock job queue for processing one data directory from several processes or machines.
+
+The jobs are the tasks of pipeline_runner.py. They are stored on the data directory itself, so
+any number of workers on hosts that share the drive can take part without a separate server:
+
+    <directory>/.queue/jobs/<job>.json     job description and the jobs it depends on
+    <directory>/.queue/locks/<job>.lock    claimed by a worker (created with O_EXCL)
+    <directory>/.queue/done/<job>.json     finished
+    <directory>/.queue/failed/<job>.json   failed, with the error
+
+A worker claims a job once all its dependencies are done and runs it in a child process. While the
+job runs the worker touches the lock file every HEARTBEAT_INTERVAL seconds. A lock that has not been
+touched for STALE_AFTER seconds belongs to a worker that died, and the next worker that sees it
+takes the job over. A worker that finds its lock taken over stops its job and records nothing.
+
+Paths are stored relative to the data directory, so hosts may mount the drive at different paths.
+
+Usage:
+    python job_queue.py submit <directory> [--stages normalize,auc,...] [--reset]
+    python job_queue.py worker <directory> [--processes N]
+    python job_queue.py status <directory>
+"""
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import socket
+import time
+import traceback
+
+import instrumentation
+import pipeline_runner
+
+# === Configuration Parameters ===
+QUEUE_DIRECTORY = '.queue'
+HEARTBEAT_INTERVAL = 10  # Seconds between touches of the lock file of a running job
+STALE_AFTER = 120  # Seconds without a heartbeat after which a lock is taken over
+POLL_INTERVAL = 2  # Seconds to wait when every remaining job is running or waiting for a dependency
+
+def queue_path(directory, *parts):
+    return os.path.join(directory, QUEUE_DIRECTORY, *parts)
+
+def job_id(key):
+    # Readable and safe as a file name on every platform, with a hash to keep distinct keys apart
+    return f"{re.sub(r'[^A-Za-z0-9_.-]+', '_', key)}-{hashlib.sha1(key.encode()).hexdigest()[:8]}"
+
+def write_json(file_path, content):
+    # Written to a temporary file and renamed, so other workers never read a partial file
+    temporary_path = f'{file_path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump(content, f, indent=1)
+    os.replace(temporary_path, file_path)
+
+def read_json(file_path):
+    try:
+        with open(file_path) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+def to_relative(value, directory):
+    if isinstance(value, str) and os.path.isabs(value) and os.path.commonpath([value, directory]) == directory:
+        return {'path': os.path.relpath(value, directory)}
+    return value
+
+def to_absolute(value, directory):
+    if isinstance(value, dict) and set(value) == {'path'}:
+        return os.path.join(directory, value['path'])
+    return value
+
+def submit(directory, stages=pipeline_runner.STAGES, reset=False):
+    """Writes one job per pipeline task. With reset, finished and failed jobs are queued again."""
+    directory = os.path.abspath(directory)
+    for part in ['jobs', 'locks', 'done', 'failed']:
+        os.makedirs(queue_path(directory, part), exist_ok=True)
+
+    tasks = [task for task in pipeline_runner.build_tasks(directory) if task.stage in stages]
+    dependencies = pipeline_runner.task_dependencies(tasks)
+    for task in tasks:
+        name = job_id(task.key)
+        if reset:
+            for part in ['done', 'failed']:
+                if os.path.exists(queue_path(directory, part, f'{name}.json')):
+                    os.remove(queue_path(directory, part, f'{name}.json'))
+        write_json(queue_path(directory, 'jobs', f'{name}.json'), {
+            'key': task.key,
+            'script': task.script,
+            'function': task.function,
+            'args': [to_relative(arg, directory) for arg in task.args],
+            'settings': {setting: to_relative(value, directory) for setting, value in task.settings.items()},
+            'dependencies': sorted(job_id(key) for key in dependencies[task.key]),
+        })
+    print(f"Submitted {len(tasks)} jobs to {queue_path(directory)}")
+
+def shared_clock(directory):
+    """Current time according to the file server, so lock ages are not affected by clock differences between hosts."""
+    probe_path = queue_path(directory, 'locks', f'.clock.{socket.gethostname()}.{os.getpid()}')
+    with open(probe_path, 'w'):
+        pass
+    now = os.stat(probe_path).st_mtime
+    os.remove(probe_path)
+    return now
+
+def try_claim(directory, name, worker):
+    """Creates the lock file of a job. Returns a token identifying this claim, or None if another worker holds it."""
+    token = f'{worker}:{time.time()}'
+    try:
+        descriptor = os.open(queue_path(directory, 'locks', f'{name}.lock'), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    with os.fdopen(descriptor, 'w') as f:
+        f.write(token)
+    return token
+
+def lock_token(lock_path):
+    try:
+        with open(lock_path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+def break_stale_lock(directory, name, worker):
+    """Removes the lock of a job whose worker stopped sending heartbeats. Returns True if the lock was removed."""
+    lock_path = queue_path(directory, 'locks', f'{name}.lock')
+    # The token and the age are read from one open file, so they belong to the same claim
+    try:
+        with open(lock_path) as f:
+            token = f.read()
+            lock_stat = os.fstat(f.fileno())
+        age = shared_clock(directory) - lock_stat.st_mtime
+        if age < STALE_AFTER or os.stat(lock_path).st_ino != lock_stat.st_ino:
+            return False
+    except FileNotFoundError:
+        return False
+    # Renaming is atomic, so only one of several workers that see the same stale lock succeeds
+    stale_path = f'{lock_path}.stale.{worker.replace(":", "_")}'
+    try:
+        os.rename(lock_path, stale_path)
+    except FileNotFoundError:
+        return False
+    if os.stat(stale_path).st_ino != lock_stat.st_ino or lock_token(stale_path) != token:
+        # Another worker replaced the stale lock in the meantime; put its fresh lock back
+        try:
+            os.link(stale_path, lock_path)
+        except FileExistsError:
+            pass
+        os.remove(stale_path)
+        return False
+    os.remove(stale_path)
+    print(f"{worker}: took over {name} (no heartbeat for {age:.0f} s, was {token})")
+    return True
+
+def job_state(directory, name):
+    for part in ['done', 'failed']:
+        if os.path.exists(queue_path(directory, part, f'{name}.json')):
+            return part
+    return 'pending'
+
+def job_process(connection, directory, script, function, args, settings):
+    """Runs one job in the child process and sends back ('done', (seconds, records)) or ('failed', (error, traceback))."""
+    pipeline_runner.initialize_worker(directory)
+    try:
+        connection.send(('done', pipeline_runner.run_task(script, function, args, settings)))
+    except Exception as e:
+        connection.send(('failed', (repr(e), traceback.format_exc())))
+
+def run_job(directory, name, job, token, worker):
+    """Runs a job in a child process while touching its lock file. The job is stopped as soon as another
+    worker has taken the lock over, so a job is never finished by two workers."""
+    lock_path = queue_path(directory, 'locks', f'{name}.lock')
+    args = [to_absolute(arg, directory) for arg in job['args']]
+    settings = {setting: to_absolute(value, directory) for setting, value in job['settings'].items()}
+    print(f"{worker}: running {job['key']}")
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=job_process, args=(sender, directory, job['script'], job['function'], args, settings), daemon=True)
+    process.start()
+    sender.close()
+    # poll also returns when the child exits without sending anything
+    while not receiver.poll(HEARTBEAT_INTERVAL):
+        if lock_token(lock_path) != token:
+            process.terminate()
+            process.join()
+            print(f"{worker}: lost the lock of {job['key']} to another worker; stopped the job without recording it")
+            return
+        os.utime(lock_path)
+    try:
+        part, outcome = receiver.recv()
+    except EOFError:
+        part, outcome = 'failed', None
+    process.join()
+    if outcome is None:
+        outcome = (f'the job process exited with code {process.exitcode}', '')
+
+    if part == 'done':
+        elapsed, records = outcome
+        instrumentation.merge_records(records)
+        result = {'worker': worker, 'seconds': elapsed}
+    else:
+        result = {'worker': worker, 'error': outcome[0], 'traceback': outcome[1]}
+    if lock_token(lock_path) != token:
+        print(f"{worker}: lost the lock of {job['key']} to another worker; its result is not recorded")
+        return
+    write_json(queue_path(directory, part, f'{name}.json'), result)
+    os.remove(lock_path)
+    print(f"{worker}: {part} {job['key']}" + (f" ({result['seconds']:.1f} s)" if part == 'done' else f": {result['error']}"))
+
+def worker_loop(directory):
+    """Claims and runs jobs until every job is done, failed or blocked by a failed dependency."""
+    directory = os.path.abspath(directory)
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    pipeline_runner.initialize_worker(directory)
+
+    while True:
+        jobs = {os.path.basename(path)[:-len('.json')]: read_json(path)
+                for path in sorted(glob.glob(queue_path(directory, 'jobs', '*.json')))}
+        states = {name: job_state(directory, name) for name in jobs}
+        remaining = False
+        for name, job in jobs.items():
+            if job is None or states[name] != 'pending':
+                continue
+            if any(states.get(dependency) == 'failed' for dependency in job['dependencies']):
+                write_json(queue_path(directory, 'failed', f'{name}.json'), {'worker': worker, 'error': 'an upstream job failed'})
+                states[name] = 'failed'
+                continue
+            remaining = True
+            if any(states.get(dependency) != 'done' for dependency in job['dependencies']):
+                continue
+            token = try_claim(directory, name, worker)
+            if token is None and break_stale_lock(directory, name, worker):
+                token = try_claim(directory, name, worker)
+            if token is None:
+                continue
+            # The job may have finished between listing the states and taking the lock
+            if job_state(directory, name) == 'pending':
+                run_job(directory, name, job, token, worker)
+            else:
+                os.remove(queue_path(directory, 'locks', f'{name}.lock'))
+            break
+        else:
+            if not remaining:
+                print(f"{worker}: no jobs left")
+                if instrumentation.ENABLED:
+                    # One report per worker; combine them with instrumentation.py --merge
+                    instrumentation.write_report(f"{instrumentation.report_base(directory)}_{worker.replace(':', '_')}")
+                return
+            time.sleep(POLL_INTERVAL)
+
+def run_workers(directory, processes=1):
+    """Starts worker processes on this machine and waits for them to finish."""
+    if processes == 1:
+        worker_loop(directory)
+        return
+    workers = [multiprocessing.Process(target=worker_loop, args=(directory,)) for _ in range(processes)]
+    for process in workers:
+        process.start()
+    for process in workers:
+        process.join()
+
+def status(directory):
+    directory = os.path.abspath(directory)
+    names = [os.path.basename(path)[:-len('.json')] for path in glob.glob(queue_path(directory, 'jobs', '*.json'))]
+    states = [job_state(directory, name) for name in names]
+    now = shared_clock(directory)
+    print(f"{len(names)} jobs: {states.count('done')} done, {states.count('failed')} failed, {states.count('pending')} pending")
+    for lock_path in sorted(glob.glob(queue_path(directory, 'locks', '*.lock'))):
+        age = now - os.stat(lock_path).st_mtime
+        print(f"  running {os.path.basename(lock_path)[:-len('.lock')]} on {lock_token(lock_path)}, last heartbeat {age:.0f} s ago"
+              + (" (stale)" if age >= STALE_AFTER else ""))
+    for name in sorted(names):
+        failure = read_json(queue_path(directory, 'failed', f'{name}.json'))
+        if failure:
+            print(f"  failed {name}: {failure['error']}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Shared file-lock job queue for the analysis pipeline.')
+    parser.add_argument('command', choices=['submit', 'worker', 'status'])
+    parser.add_argument('directory', nargs='?', default=pipeline_runner.DATA_DIRECTORY)
+    parser.add_argument('--stages', default=','.join(pipeline_runner.STAGES))
+    parser.add_argument('--reset', action='store_true', help='Queue finished and failed jobs again')
+    parser.add_argument('--processes', type=int, default=1, help='Number of worker processes to start on this machine')
+    options = parser.parse_args()
+    if options.command == 'submit':
+        submit(options.directory, options.stages.split(','), options.reset)
+    elif options.command == 'worker':
+        run_workers(options.directory, options.processes)
+    else:
+        status(options.directory)
@@ -0,0 +1,149 @@
+"""Command-line entry point for the analysis stages.
+
+Each subcommand runs one stage on a data directory, so the paths and parameters no longer need to
+be edited in the scripts. Any setting at the top of the stage's script can be overridden with
+--set NAME=VALUE (Python literals; other values are taken as text):
+
+    python pipeline.py normalize <directory> [--glia]
+    python pipeline.py heatmaps <directory> --set renderer="'direct'" --set sort_by="'Avg Peak Loom'"
+    python pipeline.py pca <directory> --set POOLED_PCA=True
+    python pipeline.py run <directory> --stages normalize,auc --workers 4
+
+Only argparse and the standard library are imported at start-up. The script of the chosen stage is
+loaded afterwards, and the scripts import matplotlib, seaborn, scipy and scikit-learn only in the
+functions that need them, so e.g. `pca --set POOLED_PCA=True` never loads matplotlib.
+"""
+import argparse
+import ast
+import os
+import sys
+
+NORMALIZE_SCRIPTS = {'neurons': '1 normalize traces tectal neurons.py', 'glia': '1 normalize traces radial astrocytes.py'}
+AUC_SCRIPTS = {'neurons': '2 count traces AUC tectal neurons.py', 'glia': '2 count traces AUC radial astrocytes.py'}
+PROPERTIES_SCRIPTS = {
+    'no-plots': '3 extract neuronal response properties from normalized traces (dots loom) no plots.py',
+    'plots': '3 extract neuronal response properties from normalized traces (dots loom).py',
+    '5-HT': '3 extract neuronal response properties from normalized traces (dots loom) no plots (5-HT A1,A2)py.py',
+}
+
+def parse_assignments(assignments):
+    """Turns ["renderer='direct'", "NUM_CLUSTERS=3"] into {'renderer': 'direct', 'NUM_CLUSTERS': 3}."""
+    settings = {}
+    for assignment in assignments:
+        name, _, value = assignment.partition('=')
+        try:
+            settings[name.strip()] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            settings[name.strip()] = value
+    return settings
+
+def load(script, settings):
+    from pipeline_scripts import load_script
+    import instrumentation
+    return instrumentation.instrument(load_script(script, settings))
+
+def normalize(directory, options, settings):
+    from pipeline_runner import find_recordings
+    module = load(NORMALIZE_SCRIPTS['glia' if options.glia else 'neurons'], settings)
+    # Only the raw recordings; earlier outputs in the same directory are not normalized again
+    for name, raw_file in find_recordings(directory).items():
+        if raw_file is not None:
+            module.process_file(raw_file)
+            print(f"Normalized {os.path.basename(raw_file)}")
+
+def auc(directory, options, settings):
+    load(AUC_SCRIPTS['glia' if options.glia else 'neurons'], settings).main(directory)
+
+def heatmaps(directory, options, settings):
+    load('2 heatmaps of normalized traces.py', settings).main(directory)
+
+def stimulus(directory, options, settings):
+    # The script saves its outputs relative to its DATA_DIRECTORY
+    load('2 find stimulus positions from normalized traces.py', {'DATA_DIRECTORY': directory, **settings}).process_all_files(directory)
+
+def stage2(directory, options, settings):
+    load('2 fused single-read runner.py', settings).process_all_files(directory)
+
+def properties(directory, options, settings):
+    load(PROPERTIES_SCRIPTS[options.variant], settings).process_all_files(directory)
+
+def correlation(directory, options, settings):
+    load('3 correlation analysis from normalized traces.py', settings).main(directory)
+
+def pca(directory, options, settings):
+    load('4 PCA.py', settings).main(directory, options.start, options.end)
+
+def histograms(directory, options, settings):
+    load('4 generate histograms of neuronal response amplitudes.py', settings).main(
+        directory, os.path.join(directory, options.output))
+
+def group(directory, options, settings):
+    module = load('4 group average neuronal properties by animal.py', settings)
+    module.main(directory, options.conditions or module.CONDITIONS)
+
+def sort(directory, options, settings):
+    if options.sort_option:
+        settings = {'sort_option': options.sort_option, **settings}
+    load('4 sort normalized traces by average neuronal properties.py', settings).main(directory)
+
+def run(directory, options, settings):
+    import pipeline_runner
+    if settings:
+        raise SystemExit('--set is not supported by run; set the stage settings in the scripts or use benchmark.py --set')
+    stages = options.stages.split(',') if options.stages else pipeline_runner.STAGES
+    failed = pipeline_runner.run_pipeline(directory, stages, options.workers, options.force)
+    if failed:
+        raise SystemExit(1)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Run a stage of the calcium imaging analysis on a data directory.')
+    commands = parser.add_subparsers(dest='command', required=True, metavar='command')
+
+    def command(name, function, help):
+        subparser = commands.add_parser(name, help=help, description=help)
+        subparser.add_argument('directory', nargs='?', default='.', help='Data directory (default: the current directory)')
+        subparser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='Override a script setting')
+        subparser.add_argument('--profile', action='store_true', help='Write a timing report (see instrumentation.py)')
+        subparser.set_defaults(function=function)
+        return subparser
+
+    command('normalize', normalize, 'Stage 1: normalize the raw recordings').add_argument('--glia', action='store_true', help='Use the radial astrocyte parameters')
+    command('auc', auc, 'Stage 2: count traces and compute the AUC').add_argument('--glia', action='store_true', help='Use the radial astrocyte script')
+    command('heatmaps', heatmaps, 'Stage 2: plot a heatmap of every normalized recording')
+    command('stimulus', stimulus, 'Stage 2: find the stimulus onsets and peaks')
+    command('stage2', stage2, 'Stage 2: AUC, heatmaps and stimulus positions from a single read of each file')
+    command('properties', properties, 'Stage 3: extract the neuronal response properties').add_argument(
+        '--variant', choices=sorted(PROPERTIES_SCRIPTS), default='no-plots', help='Which of the stage 3 scripts to run')
+    command('correlation', correlation, 'Stage 3: correlation analysis')
+    pca_parser = command('pca', pca, 'Stage 4: principal component analysis')
+    pca_parser.add_argument('--start', type=int, default=0, help='First timepoint')
+    pca_parser.add_argument('--end', type=int, default=4500, help='Last timepoint')
+    command('histograms', histograms, 'Stage 4: histograms of the response amplitudes').add_argument(
+        '--output', default='ResponseAmplitudesNeurons.csv', help='Output file name in the data directory')
+    command('group', group, 'Stage 4: average the response properties by animal and condition').add_argument(
+        '--conditions', nargs='+', help='Conditions to compare, e.g. Baseline Serotonin')
+    command('sort', sort, 'Stage 4: sort the normalized traces by their response properties').add_argument(
+        '--sort-option', help='Key of sort_options in the sorting script')
+    run_parser = command('run', run, 'Stages 1-4 as a dependency graph (pipeline_runner.py)')
+    run_parser.add_argument('--stages', help='Comma-separated stages to run (default: all)')
+    run_parser.add_argument('--workers', type=int, default=None)
+    run_parser.add_argument('--force', action='store_true', help='Run every task even if its inputs are unchanged')
+    return parser
+
+def main(argv=None):
+    options = build_parser().parse_args(argv)
+    directory = os.path.abspath(options.directory)
+    if options.profile:
+        # Read by instrumentation when it is first imported
+        os.environ.setdefault('PIPELINE_PROFILE', '1')
+    # Scripts are loaded from this directory; some of them write their outputs to the working directory
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    os.chdir(directory)
+    options.function(directory, options, parse_assignments(options.set))
+    if options.profile and options.command not in ('stage2', 'run'):
+        import instrumentation
+        instrumentation.write_report(instrumentation.report_base(directory))
+
+if __name__ == '__main__':
+    main()
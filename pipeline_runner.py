@@ -0,0 +1,228 @@
+"""Runs stages 1-4 of the analysis as one dependency graph.
+
+Every step is a task: per-recording tasks (normalize, AUC, heatmap, stimulus positions) and
+per-directory tasks that combine all recordings (cell counts, response properties, correlations,
+PCA, histograms, grouping, sorting). A task depends on the tasks that write its input files, and
+independent tasks run concurrently in a process pool.
+
+Content hashes of every task's inputs and script are kept in .pipeline_state.json in the data
+directory. On the next run a task is skipped when its inputs, its script and its outputs are
+unchanged, so editing or adding one recording only re-runs the tasks downstream of it.
+
+Usage: python pipeline_runner.py [directory] [--workers N] [--stages normalize,auc,...] [--force]
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import instrumentation
+from pipeline_scripts import SCRIPT_DIRECTORY, load_script
+
+# === Configuration Parameters ===
+DATA_DIRECTORY = '/Users/nbenfey/Desktop/PythonProcessing'  # Update with your directory path
+NORMALIZE_SCRIPT = '1 normalize traces tectal neurons.py'  # Use '1 normalize traces radial astrocytes.py' for glia
+AUC_SCRIPT = '2 count traces AUC tectal neurons.py'  # Use '2 count traces AUC radial astrocytes.py' for glia
+PROPERTIES_SCRIPT = '3 extract neuronal response properties from normalized traces (dots loom) no plots.py'
+GROUPING_SCRIPT = '4 group average neuronal properties by animal.py'
+HEATMAP_SCRIPT = '2 heatmaps of normalized traces.py'
+CELL_COUNTS_FILE = 'CellCountsNeurons.csv'  # 'CellCountsGlia.csv' with the radial astrocyte AUC script
+WORKERS = None  # Number of worker processes, None uses all CPUs
+STATE_FILE = '.pipeline_state.json'
+STAGES = ['normalize', 'auc', 'heatmap', 'stimulus', 'cell_counts', 'properties', 'correlation',
+          'pca', 'histograms', 'grouping', 'sorting']
+
+# Files written by the pipeline itself (including the instrumentation reports); every other CSV in the directory is a raw recording
+DERIVED_FILE_PATTERN = re.compile(
+    r'_normalized|_pca_|_cluster_scores|_sort_index|_sorted_by_|'
+    r'^(pipeline_profile|CellCounts|auc_bin_counts|peak_bin_counts|PCAVariance|ResponseAmplitudes|Averages|CumulativeProbability|SelectivityStatistics)'
+)
+
+# key: unique task name, script/function/args: what to call, settings: script settings to override,
+# inputs/outputs: file paths used to wire the dependencies and to detect changes
+Task = namedtuple('Task', ['key', 'stage', 'script', 'function', 'args', 'settings', 'inputs', 'outputs'])
+
+def find_recordings(directory):
+    """Returns {recording name: raw file path or None}. Normalized files without a raw file are used as they are."""
+    recordings = {}
+    for file_path in sorted(glob.glob(os.path.join(directory, '*.csv'))):
+        name = os.path.splitext(os.path.basename(file_path))[0]
+        if name.endswith('_normalized'):
+            recordings.setdefault(name[:-len('_normalized')], None)
+        elif not DERIVED_FILE_PATTERN.search(name):
+            recordings[name] = file_path
+    return recordings
+
+def build_tasks(directory):
+    """Lists every task of the pipeline with the files it reads and writes."""
+    recordings = find_recordings(directory)
+    path = lambda name: os.path.join(directory, name)
+    normalized = {name: path(f'{name}_normalized.csv') for name in recordings}
+    properties = [path(f'{name}_normalized_average_neuronal_properties.csv') for name in recordings]
+    # Heatmaps with sort_by set read the sort index too, so a new row order makes them run again
+    sort_heatmaps = bool(load_script(HEATMAP_SCRIPT).sort_by)
+    tasks = []
+
+    for name, raw_file in recordings.items():
+        if raw_file is not None:
+            tasks.append(Task(f'normalize:{name}', 'normalize', NORMALIZE_SCRIPT, 'process_file', (raw_file,), {},
+                              [raw_file], [normalized[name]]))
+        tasks.append(Task(f'auc:{name}', 'auc', AUC_SCRIPT, 'process_file', (normalized[name],), {},
+                          [normalized[name]], [path(f'{name}_normalized_AUC.csv')]))
+        # The heatmap file name depends on the renderer settings, so no output is tracked
+        tasks.append(Task(f'heatmap:{name}', 'heatmap', HEATMAP_SCRIPT, 'process_file', (normalized[name],), {},
+                          [normalized[name]] + ([path(f'{name}_sort_index.csv')] if sort_heatmaps else []), []))
+        tasks.append(Task(f'stimulus:{name}', 'stimulus', '2 find stimulus positions from normalized traces.py',
+                          'process_file', (normalized[name],), {'DATA_DIRECTORY': directory}, [normalized[name]],
+                          [path(f'{name}_normalized_stimulus_onsets.csv'), path(f'{name}_normalized_stimulus_peaks.csv')]))
+
+    all_normalized = list(normalized.values())
+    tasks.append(Task('cell_counts', 'cell_counts', AUC_SCRIPT, 'count_traces', (directory,), {},
+                      [path(f'{name}_normalized_AUC.csv') for name in recordings], [path(CELL_COUNTS_FILE)]))
+    tasks.append(Task('properties', 'properties', PROPERTIES_SCRIPT, 'process_all_files', (directory,), {},
+                      all_normalized, properties + [path('auc_bin_counts.csv'), path('peak_bin_counts.csv')]))
+    tasks.append(Task('correlation', 'correlation', '3 correlation analysis from normalized traces.py', 'main',
+                      (directory,), {}, all_normalized, [path(os.path.join('CorrelationsNeurons', 'average_correlations.csv'))]))
+    tasks.append(Task('pca', 'pca', '4 PCA.py', 'main', (directory,), {}, all_normalized, []))
+    tasks.append(Task('histograms', 'histograms', '4 generate histograms of neuronal response amplitudes.py', 'main',
+                      (directory, path('ResponseAmplitudesNeurons.csv')), {}, properties, [path('ResponseAmplitudesNeurons.csv')]))
+    tasks.append(Task('grouping', 'grouping', GROUPING_SCRIPT, 'main', (directory,), {}, properties,
+                      [path('AveragesPerAnimal.csv'), path('CumulativeProbability.csv')]))
+    # The smoothed property files are prepared by hand, so sorting only runs for recordings that have one
+    smoothed = [file_path for file_path in (path(f'{name}_normalized_smoothed.csv') for name in recordings) if os.path.exists(file_path)]
+    if smoothed:
+        tasks.append(Task('sorting', 'sorting', '4 sort normalized traces by average neuronal properties.py', 'main',
+                          (directory,), {}, all_normalized + smoothed,
+                          [path(f'{name}_sort_index.csv') for name in recordings if path(f'{name}_normalized_smoothed.csv') in smoothed]))
+    return tasks
+
+def task_dependencies(tasks):
+    """Maps each task key to the keys of the tasks that write one of its inputs."""
+    producers = {output: task.key for task in tasks for output in task.outputs}
+    return {task.key: {producers[file_path] for file_path in task.inputs if file_path in producers} - {task.key}
+            for task in tasks}
+
+def file_digest(file_path, cache):
+    """SHA-1 of a file, reused from the previous run while its size and modification time are unchanged."""
+    if not os.path.exists(file_path):
+        return None
+    stat = os.stat(file_path)
+    cached = cache.get(file_path)
+    if cached and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime_ns:
+        return cached['digest']
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    cache[file_path] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'digest': sha1.hexdigest()}
+    return cache[file_path]['digest']
+
+def task_fingerprint(task, digests):
+    return {
+        'script': file_digest(os.path.join(SCRIPT_DIRECTORY, task.script), digests),
+        'function': task.function,
+        'args': [str(arg) for arg in task.args],
+        'settings': {name: str(value) for name, value in task.settings.items()},
+        'inputs': {file_path: file_digest(file_path, digests) for file_path in task.inputs},
+    }
+
+def load_state(directory):
+    state_path = os.path.join(directory, STATE_FILE)
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            return json.load(f)
+    return {'tasks': {}, 'digests': {}}
+
+def save_state(directory, state):
+    # Written to a temporary file first so an interrupted run never leaves a truncated state file
+    state_path = os.path.join(directory, STATE_FILE)
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(state_path + '.tmp', state_path)
+
+def initialize_worker(directory):
+    # The response property script writes its outputs to the working directory
+    os.chdir(directory)
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+def run_task(script, function, args, settings):
+    """Runs one task in a worker process and returns its run time and profiling records (empty unless enabled).
+    Scripts are passed by file name because the loaded modules cannot be pickled."""
+    start = time.perf_counter()
+    module = instrumentation.instrument(load_script(script, settings))
+    getattr(module, function)(*args)
+    return time.perf_counter() - start, instrumentation.take_records()
+
+def run_pipeline(directory, stages=STAGES, workers=WORKERS, force=False):
+    """Runs the selected stages, skipping tasks whose inputs are unchanged since their last successful run.
+    Tasks of stages that are not selected are not run; their output files are used as they are."""
+    directory = os.path.abspath(directory)
+    tasks = [task for task in build_tasks(directory) if task.stage in stages]
+    dependencies = task_dependencies(tasks)
+    state = load_state(directory)
+    pending = {task.key: task for task in tasks}
+    done, failed, running = set(), set(), {}
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=initialize_worker, initargs=(directory,)) as executor:
+        while pending or running:
+            progress = True
+            while progress:
+                progress = False
+                for key, task in list(pending.items()):
+                    if dependencies[key] & failed:
+                        print(f"Skipping {key}: an upstream task failed")
+                        failed.add(key)
+                    elif dependencies[key] <= done:
+                        fingerprint = task_fingerprint(task, state['digests'])
+                        if not force and state['tasks'].get(key) == fingerprint and all(os.path.exists(f) for f in task.outputs):
+                            print(f"Up to date: {key}")
+                            done.add(key)
+                        else:
+                            print(f"Running: {key}")
+                            future = executor.submit(run_task, task.script, task.function, task.args, task.settings)
+                            running[future] = (task, fingerprint)
+                    else:
+                        continue
+                    del pending[key]
+                    progress = True
+
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task, fingerprint = running.pop(future)
+                try:
+                    elapsed, records = future.result()
+                    instrumentation.merge_records(records)
+                except Exception as e:
+                    print(f"Failed: {task.key}: {e}")
+                    state['tasks'].pop(task.key, None)
+                    failed.add(task.key)
+                else:
+                    print(f"Finished: {task.key} ({elapsed:.1f} s)")
+                    missing = [f for f in task.outputs if not os.path.exists(f)]
+                    if missing:
+                        print(f"Warning: {task.key} did not write {missing}")
+                    state['tasks'][task.key] = fingerprint
+                    done.add(task.key)
+                save_state(directory, state)
+
+    print(f"{len(done)} tasks up to date, {len(failed)} failed")
+    if instrumentation.ENABLED:
+        instrumentation.write_report(instrumentation.report_base(directory))
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the analysis stages as a dependency graph, re-running only what changed.')
+    parser.add_argument('directory', nargs='?', default=DATA_DIRECTORY)
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--stages', default=','.join(STAGES), help='Comma-separated subset of: ' + ', '.join(STAGES))
+    parser.add_argument('--force', action='store_true', help='Re-run every selected task')
+    options = parser.parse_args()
+    failed = run_pipeline(options.directory, options.stages.split(','), options.workers, options.force)
+    raise SystemExit(1 if failed else 0)
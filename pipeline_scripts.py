@@ -0,0 +1,59 @@
+"""Loads the numbered analysis scripts as modules.
+
+The script file names contain spaces and parentheses, so they cannot be imported with a regular import
+statement. Loading them by path runs their configuration and function definitions but not their
+__main__ block, so their functions can be reused by the runners in this directory.
+
+Settings can be overridden while loading. The new values replace the top-level assignments of the
+script before it runs, so they also reach the default arguments and the values derived from them.
+"""
+import ast
+import importlib.util
+import os
+import re
+import sys
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SETTINGS_NAME = '__pipeline_settings__'
+
+def module_name(filename):
+    return 'pipeline_' + re.sub(r'\W+', '_', os.path.splitext(os.path.basename(filename))[0]).strip('_')
+
+def apply_settings(tree, settings, filename):
+    """Makes every top-level assignment to one of the settings read the new value instead."""
+    found = set()
+    for node in tree.body:
+        targets = node.targets if isinstance(node, ast.Assign) else [node.target] if isinstance(node, ast.AnnAssign) and node.value else []
+        if len(targets) == 1 and isinstance(targets[0], ast.Name) and targets[0].id in settings:
+            node.value = ast.Subscript(ast.Name(SETTINGS_NAME, ast.Load()), ast.Constant(targets[0].id), ast.Load())
+            found.add(targets[0].id)
+    missing = sorted(set(settings) - found)
+    if missing:
+        raise ValueError(f"{filename} has no setting named {', '.join(missing)}")
+    return ast.fix_missing_locations(tree)
+
+def load_script(filename, settings=None):
+    """Imports one of the analysis scripts by file name and returns it as a module.
+    The module is loaded once per process, and again only when different settings are requested."""
+    settings = dict(settings or {})
+    name = module_name(filename)
+    module = sys.modules.get(name)
+    if module is not None and getattr(module, SETTINGS_NAME) == settings:
+        return module
+
+    path = os.path.join(SCRIPT_DIRECTORY, filename)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    setattr(module, SETTINGS_NAME, settings)
+    sys.modules[name] = module
+    try:
+        if settings:
+            with open(path) as f:
+                tree = apply_settings(ast.parse(f.read(), path), settings, filename)
+            exec(compile(tree, path, 'exec'), module.__dict__)
+        else:
+            spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[name]
+        raise
+    return module
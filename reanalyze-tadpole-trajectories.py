@@ -0,0 +1,177 @@
+"""Computes the escape data again from the trajectories saved by working-tadpole-tracker.py (save_trajectory = True).
+
+Every metric is computed for the whole trajectory at once with NumPy, in the same way as the tracking loop, so the
+default values below give the same data as the tracker. Change them to see their effect without decoding the videos:
+
+    python reanalyze-tadpole-trajectories.py <folder> --set ellipse_quality=1.4 --set angle_seconds=0.8
+
+The trajectory has to cover the frames the metrics use (the whole video, or 4 s before the stimulus to the end of
+the loom with analysis_window_only). Distances use the whole-pixel positions the tracker saved (center_x, center_y),
+and the ellipse fields hold fitEllipse's single-precision values, so the ratios and angles are the tracker's too.
+Trajectories saved before center_x and center_y were added fall back to truncating the float centroid x, y.
+"""
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from pipeline import parse_assignments
+
+## folder with the .traj and .json files of the tracker
+trajectory_folder = 'output_trajectories'
+
+# values to play with; the defaults are those of working-tadpole-tracker.py
+## only ellipses more elliptical than ellipse_quality are used to calculate angle
+ellipse_quality = 1.2
+## any |change| in heading greater than crossover_angle is taken as a crossover through the 0/180 vertical line
+crossover_angle = 70
+## escape angle window after the stimulus in seconds; None uses 0.6 s for 'darkloom' and 1.2 s for 'brightloom'
+angle_seconds = None
+## escape distance and maximum velocity window after the stimulus in seconds
+loom_seconds = 5
+## petri dish diameter in mm; None uses the one the video was tracked with
+diameter = None
+
+## outputs, saved in the folder the trajectories are read from
+output_file = 'reanalysis.csv'
+speed_file = 'reanalysis_speed.csv'
+
+def read_trajectory(path):
+    """Rows and metadata of <path>.traj and <path>.json."""
+    with open(path + '.json') as f:
+        metadata = json.load(f)
+    rows = np.fromfile(path + '.traj', np.dtype([tuple(field) for field in metadata['dtype']]))
+    return rows, metadata
+
+def positions(rows):
+    """Detection flags and the whole-pixel positions the tracker works with."""
+    detected = rows['detected'].astype(bool)
+    x, y = ('center_x', 'center_y') if 'center_x' in rows.dtype.names else ('x', 'y')
+    return detected, np.where(detected, rows[x], 0).astype(int), np.where(detected, rows[y], 0).astype(int)
+
+def velocities(rows, fps, scale):
+    """Velocity of every frame where the tracker measures one, else NaN, and the distance it is measured over.
+    As in the tracker, the tadpole position on the previous frame is compared with the 10th oldest of the last
+    second of positions (the 20th frame back once a whole second has been tracked)."""
+    detected, x, y = positions(rows)
+    k = np.arange(len(rows))
+    oldest = k - (np.minimum(k + 1, int(fps)) - 10)
+    measured = k >= 9
+    measured[measured] &= detected[measured] & detected[k[measured] - 1] & detected[oldest[measured]]
+    previous = np.maximum(k - 1, 0)
+    distance = np.sqrt((x[oldest.clip(0)] - x[previous]) ** 2.0 + (y[oldest.clip(0)] - y[previous]) ** 2.0) / scale
+    velocity = np.where(measured, distance / (10 / fps), np.nan)
+    return velocity, np.where(measured, distance, np.nan)
+
+def carried_forward(values, initial):
+    """Each NaN replaced by the last value before it, or initial."""
+    index = np.maximum.accumulate(np.where(np.isnan(values), -1, np.arange(len(values))))
+    return np.where(index >= 0, values[index.clip(0)], initial)
+
+def escape_distance(rows, stim_frame, buffer_2, scale, frame_count):
+    """Distance between the last two points of contrail 2 added up over every frame. The tracker adds each position
+    twice while contrail 2 fills up and once on the frame after, so only that frame moves it; afterwards the last
+    step is added again on every frame until the end of the video."""
+    frames = rows['frame']
+    detected, x, y = positions(rows)
+    fill_start = max(stim_frame, frames[0])
+    counts = ((frames >= stim_frame) & (frames - fill_start < buffer_2)).astype(int) + ((frames >= stim_frame) & (frames <= stim_frame + buffer_2))
+    appended = np.repeat(np.arange(len(rows)), counts)
+    total = np.cumsum(counts)
+    steps = np.zeros(len(rows))
+    has_two = total >= 2
+    newest, before = appended[total[has_two] - 1], appended[total[has_two] - 2]
+    valid = detected[newest] & detected[before]
+    step = np.sqrt((x[newest] - x[before]) ** 2.0 + (y[newest] - y[before]) ** 2.0) / scale
+    steps[np.flatnonzero(has_two)[valid]] = step[valid]
+    totaldis = np.cumsum(steps)[-1] if len(steps) else 0.0
+    # a window-only trajectory ends with the loom; the whole video would have added the same step on every remaining frame
+    if len(rows) and frames[-1] >= stim_frame + buffer_2:
+        totaldis += steps[-1] * (frame_count - 1 - frames[-1])
+    return totaldis
+
+def heading_deviation(rows, stim_frame, buffer_3):
+    """Sum of the changes of the ellipse angle over the escape angle window, unwrapped at crossover_angle.
+    Frames without the tadpole keep the last ellipse, as in the tracker."""
+    frames = rows['frame']
+    detected = rows['detected'].astype(bool)
+    last_seen = np.maximum.accumulate(np.where(detected, np.arange(len(rows)), -1))
+    width = np.where(last_seen >= 0, rows['ellipse_width'][last_seen.clip(0)].astype(float), np.nan)
+    height = np.where(last_seen >= 0, rows['ellipse_height'][last_seen.clip(0)].astype(float), np.nan)
+    angle = np.where(last_seen >= 0, rows['ellipse_angle'][last_seen.clip(0)].astype(float), np.nan)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        used = (frames >= stim_frame) & (frames <= stim_frame + buffer_3) & (height / width > ellipse_quality)
+    change = np.diff(angle[used])
+    change = np.where(np.abs(change) < crossover_angle, change, np.where(change >= crossover_angle, change - 180, change + 180))
+    return np.cumsum(change)[-1] if len(change) else 0.0
+
+def speed_table(rows, velocity, fps, stim_frame):
+    """The speed every 0.1 s from 3 s before to 3 s after the stimulus. The tracker saves at most one entry per frame,
+    on the first frame at or after each time, so an entry that falls on the same frame as the one before moves on."""
+    times = [-3]
+    while round(times[-1] + 0.1, 1) <= 3:
+        times.append(round(times[-1] + 0.1, 1))
+    frames = rows['frame']
+    due = np.maximum(np.ceil(np.array(times) * fps + stim_frame).astype(int), frames[0])
+    order = np.arange(len(times))
+    saved = np.maximum.accumulate(due - order) + order
+    saved = saved[saved <= frames[-1]]
+    speed = carried_forward(velocity, 0)[saved - frames[0]]
+    return {time: round(float(value), 1) for time, value in zip(times, speed)}
+
+def analyze(rows, metadata):
+    """Escape data by data.csv column and the speed table of one trajectory."""
+    fps, stim_frame = metadata['fps'], metadata['stim_frame']
+    scale = metadata['pixels'] / (diameter if diameter is not None else metadata['diameter'])
+    buffer_2 = int(fps * loom_seconds)
+    buffer_3 = int(fps * (angle_seconds if angle_seconds is not None else 0.6 if metadata['exp_type'] == 'darkloom' else 1.2))
+    velocity, distance = velocities(rows, fps, scale)
+    frames = rows['frame']
+    in_loom = (frames > stim_frame) & (frames < stim_frame + buffer_2)
+    metrics = {
+        'Esc Dis': escape_distance(rows, stim_frame, buffer_2, scale, metadata['frame_count']),
+        'Esc Vel': np.nanmax(velocity[in_loom], initial=0),
+        'Esc Ang': abs(heading_deviation(rows, stim_frame, buffer_3)),
+    }
+    if frames[0] == 1:
+        measured = distance[~np.isnan(distance)]
+        metrics['Total Dist'] = np.cumsum(measured)[-1] if len(measured) else 0.0
+        before = distance[(frames < stim_frame) & ~np.isnan(distance)]
+        metrics['Pre-loom Dist'] = np.cumsum(before)[-1] if len(before) else 0.0
+    return metrics, speed_table(rows, velocity, fps, stim_frame)
+
+def main(directory):
+    data, speeds = [], {}
+    for metadata_path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        path = metadata_path[:-len('.json')]
+        if not os.path.exists(path + '.traj'):
+            continue
+        rows, metadata = read_trajectory(path)
+        if not metadata['complete']:
+            print(f"Skipping {metadata['filename']}: its tracking did not finish")
+            continue
+        if len(rows) == 0:
+            print(f"Skipping {metadata['filename']}: its trajectory has no frames")
+            continue
+        metrics, speed = analyze(rows, metadata)
+        animalID, timepoint, treatment, trial = metadata['filename'].split("_")
+        data.append({'Animal ID': animalID, 'Timepoint': timepoint, 'Treatment': treatment, 'Trial #': trial[-1:],
+                     **{column: round(float(value), 1) for column, value in metrics.items()}})
+        speeds[metadata['filename']] = pd.Series(speed)
+    pd.DataFrame(data).to_csv(os.path.join(directory, output_file), index=False)
+    pd.DataFrame(speeds).rename_axis('Time').to_csv(os.path.join(directory, speed_file))
+    print(f"{len(data)} trajectories saved to {os.path.join(directory, output_file)}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compute the escape data again from saved tadpole trajectories.')
+    parser.add_argument('directory', nargs='?', default=trajectory_folder, help='Folder with the .traj and .json files')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='Override a value above, e.g. ellipse_quality=1.4')
+    options = parser.parse_args()
+    for name, value in parse_assignments(options.set).items():
+        if name not in ('ellipse_quality', 'crossover_angle', 'angle_seconds', 'loom_seconds', 'diameter'):
+            parser.error('unknown setting ' + name)
+        globals()[name] = value
+    main(options.directory)
@@ -0,0 +1,146 @@
+"""Generates synthetic raw fluorescence recordings in the format read by the normalization scripts.
+
+Each recording is a CSV with one y1..yN column per cell plus a rightmost background column, which
+the normalization scripts drop. Every trace has a slow baseline drift, photon-like noise, sparse
+spontaneous transients and transients locked to the Dots and Loom presentations in
+STIMULUS_POSITIONS, with a per-cell preference for one of the two stimuli. The columns carry the
+same stacking offsets that apply_scaling_factor removes.
+
+Recordings are written in blocks of frames, so tens of thousands of cells never need to be held in
+memory at once. File names follow the <animal>_<timepoint>_<condition> pattern of the grouping script.
+
+Usage: python synthetic_data.py <directory> [--cells 1000] [--frames 4500] [--animals 2] [--seed 0] [--workers N]
+"""
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# === Configuration Parameters ===
+CONDITIONS = ['Baseline', 'Norepinephrine']
+FRAMES = 4500
+BLOCK_FRAMES = 250  # Frames generated and written at a time
+BASELINE_RANGE = (200.0, 800.0)  # Resting fluorescence of a cell
+DRIFT_FRACTION = 0.05  # Peak slow drift relative to the resting fluorescence
+NOISE_FRACTION = 0.02  # Standard deviation of the frame noise relative to the resting fluorescence
+RESPONSIVE_FRACTION = 0.6  # Cells that respond to the stimuli
+RESPONSE_AMPLITUDE = (0.1, 1.5)  # Range of the peak dF/F of a stimulus-locked response
+SPONTANEOUS_RATE = 0.0005  # Spontaneous transients per cell and frame
+RISE_FRAMES = 5
+DECAY_FRAMES = 40
+ONSET_DELAY = 8  # Frames between the stimulus position and the response onset
+
+# Stimulus positions in frames, as used by the response property scripts
+STIMULUS_POSITIONS = {
+    "Dots": [235, 836, 1456, 2066, 2679, 3294, 3901],
+    "Loom": [537, 1150, 1763, 2361, 2967, 3595, 4208]
+}
+
+def transient_kernel(length):
+    """Calcium transient with an exponential rise and decay, normalized to a peak of 1."""
+    t = np.arange(length, dtype=float)
+    kernel = (1 - np.exp(-t / RISE_FRAMES)) * np.exp(-t / DECAY_FRAMES)
+    return kernel / kernel.max()
+
+def cell_parameters(n_cells, rng, condition_gain=1.0):
+    """Resting fluorescence, drift and stimulus response amplitude of every cell."""
+    responsive = rng.random(n_cells) < RESPONSIVE_FRACTION
+    # Preference between 0 (Dots only) and 1 (Loom only); most tectal cells prefer the looming stimulus
+    preference = rng.beta(2.5, 1.5, n_cells)
+    amplitude = rng.uniform(*RESPONSE_AMPLITUDE, n_cells) * responsive * condition_gain
+    return {
+        'baseline': rng.uniform(*BASELINE_RANGE, n_cells),
+        'drift_amplitude': rng.uniform(-DRIFT_FRACTION, DRIFT_FRACTION, n_cells),
+        'drift_period': rng.uniform(2, 6, n_cells) * FRAMES,
+        'drift_phase': rng.uniform(0, 2 * np.pi, n_cells),
+        'Dots': amplitude * (1 - preference),
+        'Loom': amplitude * preference,
+    }
+
+def event_list(n_cells, n_frames, parameters, rng, stimulus_positions=STIMULUS_POSITIONS):
+    """All transients of a recording as (onset frame, cell index, dF/F amplitude) arrays."""
+    frames, cells, amplitudes = [], [], []
+    for stimulus, positions in stimulus_positions.items():
+        for position in positions:
+            onset = position + ONSET_DELAY
+            if onset >= n_frames:
+                continue
+            # Trial-to-trial variability of the response
+            trial_amplitude = parameters[stimulus] * rng.gamma(8.0, 1 / 8.0, n_cells)
+            responding = np.flatnonzero(trial_amplitude > 0)
+            frames.append(np.full(len(responding), onset))
+            cells.append(responding)
+            amplitudes.append(trial_amplitude[responding])
+    n_spontaneous = rng.poisson(SPONTANEOUS_RATE * n_cells * n_frames)
+    frames.append(rng.integers(0, n_frames, n_spontaneous))
+    cells.append(rng.integers(0, n_cells, n_spontaneous))
+    amplitudes.append(rng.uniform(0.05, 0.4, n_spontaneous))
+    return np.concatenate(frames), np.concatenate(cells), np.concatenate(amplitudes)
+
+def generate_block(start, stop, parameters, events, kernel, rng):
+    """dF/F-shaped fluorescence of frames start..stop for every cell, as a (frames, cells) array."""
+    n_cells = len(parameters['baseline'])
+    t = np.arange(start, stop, dtype=float)[:, None]
+    drift = parameters['drift_amplitude'] * np.sin(2 * np.pi * t / parameters['drift_period'] + parameters['drift_phase'])
+    dff = np.zeros((stop - start, n_cells))
+
+    # Only the events whose kernel overlaps this block contribute
+    onsets, cells, amplitudes = events
+    overlapping = (onsets < stop) & (onsets + len(kernel) > start)
+    for onset, cell, amplitude in zip(onsets[overlapping], cells[overlapping], amplitudes[overlapping]):
+        first, last = max(onset, start), min(onset + len(kernel), stop)
+        dff[first - start:last - start, cell] += amplitude * kernel[first - onset:last - onset]
+
+    fluorescence = parameters['baseline'] * (1 + drift + dff)
+    fluorescence += rng.normal(0, 1, fluorescence.shape) * parameters['baseline'] * NOISE_FRACTION
+    return fluorescence
+
+def generate_recording(file_path, n_cells, n_frames=FRAMES, seed=0, condition_gain=1.0):
+    """Writes one raw recording with n_cells cell columns plus the background column."""
+    rng = np.random.default_rng(seed)
+    parameters = cell_parameters(n_cells, rng, condition_gain)
+    events = event_list(n_cells, n_frames, parameters, rng)
+    kernel = transient_kernel(6 * DECAY_FRAMES)
+    n_columns = n_cells + 1
+    # The normalization scripts subtract (columns - (i + 1)) * 0.5 from column i
+    offsets = (n_columns - np.arange(1, n_columns + 1)) * 0.5
+    row_format = ','.join(['%d'] + ['%.3f'] * n_columns)
+
+    with open(file_path, 'w') as f:
+        f.write(','.join(['x'] + [f'y{i + 1}' for i in range(n_columns)]) + '\n')
+        for start in range(0, n_frames, BLOCK_FRAMES):
+            stop = min(start + BLOCK_FRAMES, n_frames)
+            block = generate_block(start, stop, parameters, events, kernel, rng)
+            background = rng.normal(BASELINE_RANGE[0] / 2, 2.0, (stop - start, 1))
+            values = np.hstack([np.arange(start, stop)[:, None], block, background]) + np.concatenate([[0], offsets])
+            np.savetxt(f, values, fmt=row_format)
+
+def generate_dataset(directory, n_cells, n_frames=FRAMES, animals=2, conditions=CONDITIONS, seed=0, workers=None):
+    """Writes one recording per animal and condition, e.g. A1_T2_Norepinephrine.csv, in parallel processes
+    (formatting the CSV text takes most of the time). Returns the file paths."""
+    os.makedirs(directory, exist_ok=True)
+    jobs = []
+    for animal in range(animals):
+        for timepoint, condition in enumerate(conditions):
+            file_path = os.path.join(directory, f'A{animal + 1}_T{timepoint + 1}_{condition}.csv')
+            # Later conditions get a modest change in response strength so the comparisons are not trivial
+            jobs.append((file_path, seed * 1000 + animal * len(conditions) + timepoint, 1.0 + 0.25 * timepoint))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(generate_recording, file_path, n_cells, n_frames, job_seed, gain) for file_path, job_seed, gain in jobs]
+        for future, (file_path, _, _) in zip(futures, jobs):
+            future.result()
+            print(f"Generated {file_path} ({n_cells} cells, {n_frames} frames)")
+    return [file_path for file_path, _, _ in jobs]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic raw calcium imaging recordings.')
+    parser.add_argument('directory')
+    parser.add_argument('--cells', type=int, default=1000)
+    parser.add_argument('--frames', type=int, default=FRAMES)
+    parser.add_argument('--animals', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=None, help='Recordings written in parallel (default: all CPUs)')
+    options = parser.parse_args()
+    generate_dataset(options.directory, options.cells, options.frames, options.animals, seed=options.seed, workers=options.workers)
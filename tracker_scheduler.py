@@ -0,0 +1,180 @@
+"""Tracks every trial of a folder of tadpole videos in parallel.
+
+Every <animal>_<timepoint>_<treatment>_timings.csv in the folder is matched with the videos
+<animal>_<timepoint>_<treatment>_trial<N>.avi, where N is the row of the trial in the timings file.
+Each video is one headless job of working-tadpole-tracker.py, and the jobs run in a process pool.
+
+Each job logs to tracker_logs/<filename>.log. A job that fails is reported and leaves the others
+running. The results are saved by this process as each job finishes, so the shared data.csv and
+output_speed files are only written by one process. Finished trials are kept in .tracker_state.json
+with the size and modification time of their video, the settings they were tracked with and the
+contents of their timings file and of the tracker script, and the next run skips them unless one of
+these changed, so an interrupted batch picks up where it stopped.
+
+Usage: python tracker_scheduler.py [directory] [--workers N] [--set NAME=VALUE ...] [--force]
+"""
+import argparse
+import contextlib
+import csv
+import glob
+import json
+import os
+import re
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from pipeline import parse_assignments
+from pipeline_runner import file_digest
+from pipeline_scripts import SCRIPT_DIRECTORY, load_script
+
+# === Configuration Parameters ===
+TRACKER_SCRIPT = 'working-tadpole-tracker.py'
+WORKERS = None  # Number of worker processes, None uses all CPUs
+LOG_DIRECTORY = 'tracker_logs'
+STATE_FILE = '.tracker_state.json'
+
+def find_trials(directory):
+    """Video names (without .avi) of every trial with a row in its timings file, and the problems found on the way."""
+    trials, problems = [], []
+    for timings_path in sorted(glob.glob(os.path.join(glob.escape(directory), '*_timings.csv'))):
+        prefix = os.path.basename(timings_path)[:-len('_timings.csv')]
+        # the tracker splits the video name into <animal>_<timepoint>_<treatment>_<trial>
+        if len(prefix.split('_')) != 3:
+            problems.append(f"{os.path.basename(timings_path)}: the tracker expects <animal>_<timepoint>_<treatment>_timings.csv")
+            continue
+        with open(timings_path, newline='') as f:
+            rows = len(list(csv.DictReader(f)))
+        found, rejected = set(), set()
+        for video_path in sorted(glob.glob(os.path.join(glob.escape(directory), glob.escape(prefix) + '_*.avi'))):
+            filename = os.path.basename(video_path)[:-len('.avi')]
+            trial = filename[len(prefix) + 1:]
+            number = re.search(r'\d+$', trial)
+            if '_' in trial or number is None:
+                continue
+            row = int(number.group())
+            # the tracker reads the trial number from the last character of the name only
+            if row > 9:
+                problems.append(f"{filename}: the tracker cannot track trial numbers above 9")
+                rejected.add(row)
+                continue
+            if row >= rows:
+                problems.append(f"{filename}: no row {row} in {os.path.basename(timings_path)}")
+                continue
+            trials.append(filename)
+            found.add(row)
+        for row in sorted(set(range(rows)) - found - rejected):
+            problems.append(f"{prefix}: no video for row {row} of the timings file")
+    return trials, problems
+
+def fingerprint(directory, filename, settings, digests):
+    """What a trial's results depend on. digests caches the file digests during one run."""
+    stat = os.stat(os.path.join(directory, filename + '.avi'))
+    timings_path = os.path.join(directory, filename.rsplit('_', 1)[0] + '_timings.csv')
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'settings': {name: str(value) for name, value in settings.items()},
+            'timings': file_digest(timings_path, digests), 'tracker': file_digest(os.path.join(SCRIPT_DIRECTORY, TRACKER_SCRIPT), digests)}
+
+def load_state(directory):
+    state_path = os.path.join(directory, STATE_FILE)
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            return json.load(f)
+    return {'trials': {}}
+
+def save_state(directory, state):
+    # Written to a temporary file first so an interrupted run never leaves a truncated state file
+    state_path = os.path.join(directory, STATE_FILE)
+    with open(state_path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(state_path + '.tmp', state_path)
+
+def run_trial(directory, filename, settings):
+    """Tracks one trial in a worker process with its output in its log file.
+    Returns the results of the tracker's measure_trial, or the error as text."""
+    os.makedirs(os.path.join(directory, LOG_DIRECTORY), exist_ok=True)
+    with open(os.path.join(directory, LOG_DIRECTORY, filename + '.log'), 'w') as log:
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            start = time.perf_counter()
+            try:
+                tracker = load_script(TRACKER_SCRIPT)
+                results = tracker.run_job({'filename': filename, 'directory': directory, 'settings': settings}, save=False)
+            except Exception:
+                traceback.print_exc()
+                return None, traceback.format_exc().strip().splitlines()[-1]
+            print(f"Tracked in {time.perf_counter() - start:.1f} s")
+            return results, None
+
+def save_results(directory, filename, settings, results):
+    """Saves the data of a finished trial with the tracker's save_data, from this process only."""
+    data_to_save, speed_dict, img_output, start_frame, end_frame = results
+    tracker = load_script(TRACKER_SCRIPT)
+    defaults = {name: getattr(tracker, name) for name in settings}
+    working_directory = os.getcwd()
+    # save_data reads the data columns and save_speed of the job
+    for name, value in settings.items():
+        setattr(tracker, name, value)
+    try:
+        os.chdir(directory)
+        tracker.save_data(filename, data_to_save, speed_dict, img_output)
+    finally:
+        os.chdir(working_directory)
+        for name, value in defaults.items():
+            setattr(tracker, name, value)
+
+def run_trials(directory, workers=WORKERS, settings=None, force=False):
+    """Tracks every trial of the directory that is not up to date and returns the names of the trials that failed."""
+    directory = os.path.abspath(directory)
+    settings = settings or {}
+    tracker = load_script(TRACKER_SCRIPT)
+    unknown = [name for name in settings if not hasattr(tracker, name) or callable(getattr(tracker, name))]
+    if unknown:
+        raise ValueError("Unknown tracker settings: " + ", ".join(unknown))
+    trials, problems = find_trials(directory)
+    for problem in problems:
+        print(f"Warning: {problem}")
+    state = load_state(directory)
+    digests = {}
+    pending = []
+    for filename in trials:
+        if not force and state['trials'].get(filename) == fingerprint(directory, filename, settings, digests):
+            print(f"Up to date: {filename}")
+        else:
+            pending.append(filename)
+
+    done, failed = 0, []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        running = {executor.submit(run_trial, directory, filename, settings): filename for filename in pending}
+        print(f"Tracking {len(pending)} trials")
+        while running:
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                filename = running.pop(future)
+                try:
+                    results, error = future.result()
+                    if error is None:
+                        save_results(directory, filename, settings, results)
+                except Exception as e:
+                    # e.g. a worker that crashed and took the pool down
+                    error = f"{type(e).__name__}: {e}"
+                if error is not None:
+                    print(f"Failed: {filename}: {error} (see {os.path.join(LOG_DIRECTORY, filename + '.log')})")
+                    state['trials'].pop(filename, None)
+                    failed.append(filename)
+                else:
+                    print(f"Finished: {filename}")
+                    state['trials'][filename] = fingerprint(directory, filename, settings, digests)
+                    done += 1
+                save_state(directory, state)
+
+    print(f"{done} trials tracked, {len(trials) - len(pending)} up to date, {len(failed)} failed")
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Track every trial listed in the timings files of a folder in parallel.')
+    parser.add_argument('directory', nargs='?', default='.', help='Folder with the videos and their timings csv files')
+    parser.add_argument('--workers', type=int, default=WORKERS)
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE', help='Override a tracker setting, e.g. write_video=False')
+    parser.add_argument('--force', action='store_true', help='Track every trial again')
+    options = parser.parse_args()
+    failed = run_trials(options.directory, options.workers, parse_assignments(options.set), options.force)
+    raise SystemExit(1 if failed else 0)
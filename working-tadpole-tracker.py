@@ -1,12 +1,9 @@
 
 import cv2, sys, time, math, numpy, imutils, csv, os
+import argparse, json, queue, threading
 from datetime import datetime
-from psychopy import gui
 import numpy as np
 from collections import deque
-import tkinter as tk
-from tkinter import messagebox
-import glob
 import pandas as pd
 
 ## Video filename in format: name_timepoint_treatment_trial#
@@ -14,7 +11,7 @@ filename = "A3__Control Cap_trial9"
 
 # values to play with to improve tracking if required
 ## increase alpha to increase automatic thresholding
-## decrease alpha to decrease automatic thresholding 
+## decrease alpha to decrease automatic thresholding
 alpha = 2
 
 ## beta has a minimal impact on tracking. Sets the "floor" of thresholding algorhythm
@@ -23,7 +20,7 @@ beta = 0
 # if escape angle doesn't seem right, change these numbers to improve escape angle extraction
 ## only ellipses more elliptical than the value set in ellipse_quality are used to calculate angle
 ellipse_quality = 1.2
-## vertical is 0 or 180, so when the tadpole heading crosses from 5 degrees to 175 degrees the actual change in heading was 10 degrees.  
+## vertical is 0 or 180, so when the tadpole heading crosses from 5 degrees to 175 degrees the actual change in heading was 10 degrees.
 ## Any |change| greater than the crossover_angle assumes a crossover through the 0/180 vertical line occured
 crossover_angle = 70
 
@@ -35,178 +32,501 @@ diameter = 52
 ## if petri dish detection is not working properly, increase pdmaxrad slighly if circle is too small, and decrease slightly if circle is too large
 pdmaxrad = 260
 
-# filename processing
-animalID, timepoint, treatment, trial = filename.split("_")
-trial_num = int(trial[-1:])
-timingscsvlist = glob.glob(f'{animalID}_{timepoint}_{treatment}_timings.csv')
-splitcsv = timingscsvlist[0].split("_")
-exp_type = splitcsv[3]
-
-# data to save
-capture_data = []
-
-# open the csv file associated with thie video and save it  
-with open(animalID + '_' + timepoint + '_' + treatment + '_timings.csv', newline='') as csvfile:
-    reader = csv.DictReader(csvfile)
-    for row in reader:
-        capture_data.append(row)
-
-# timing data 
-stim_start = float(capture_data[trial_num]['stim begin'])
-trial_start = float(capture_data[trial_num]['start'])
-stim_time = stim_start-trial_start
-videofps = float(capture_data[trial_num]['fps'])
-stim_frame = int(stim_time*videofps)
-stim_end = float(capture_data[trial_num]['stim end'])
-stim_end_time = stim_end-trial_start
-stim_end_frame = int(stim_end_time*videofps)
-
+## experiment type, 'darkloom' or 'brightloom'. Sets the subtraction frames and the escape angle window
 exp_type = 'darkloom'
 
-# angle timing
-if exp_type == 'darkloom':
-    buffer_3 = int(videofps * 0.6)
-if exp_type == 'brightloom':
-    buffer_3 = int(videofps * 1.2)
-
-# Read video 
-video = cv2.VideoCapture(filename + ".avi")
-
-# Exit if video not opened
-if not video.isOpened():
-        print("Could not open video")
-        sys.exit()
-
-# Read first frame
-ok, frame = video.read()
-if not ok:
-    print('Cannot read video file')
-    sys.exit()
-   
-# determine subtraction frames
-frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
-if exp_type == 'darkloom':
-    subframe1 = 0
-    subframe2 = frame_count-1
-if exp_type == 'brightloom':
-    subframe1 = stim_end_frame + 3
-    subframe2 = stim_end_frame + 47
-video.set(cv2.CAP_PROP_POS_FRAMES, subframe1) 
-ok, frame = video.read()
-first_frame = frame.copy()
-video.set(cv2.CAP_PROP_POS_FRAMES, subframe2)
-ok, frame = video.read()
-last_frame = frame.copy()
-
-# Retrieve frame width and height from the video object
-frame_width = int(video.get(cv2.CAP_PROP_FRAME_WIDTH))
-frame_height = int(video.get(cv2.CAP_PROP_FRAME_HEIGHT))
-
-img_output = np.zeros((frame_height, frame_width, 3), np.uint8)
-
-# set scale
-scale = frame.copy()
-petri_dish = 560
-gray_scale = cv2.cvtColor(scale, cv2.COLOR_BGR2GRAY)
-circles = cv2.HoughCircles(gray_scale, cv2.HOUGH_GRADIENT, 1.2, 800, param1=50,param2=30,minRadius=80,maxRadius=pdmaxrad)
-
-# determine scale using detected petri dish size
-if circles is not None:
-    # grab circle properties
-    circles = np.round(circles[0, :]).astype("int")
-    largest_r = 0
-    # loop over the circles
-    for (x, y, r) in circles:
-        # draw the circle in the output image
-        cv2.circle(scale, (x, y), r, (0, 255, 0), 4)
-        cv2.rectangle(scale, (x - 5, y - 5), (x + 5, y + 5), (0, 128, 255), -1)
-        if largest_r < r:
-            largest_r = r
-    petri_dish = r * 2
-    # show the output image
-    cv2.imshow("Circle detection", scale)
-    cv2.waitKey(0)
-cv2.destroyWindow("Circle detection")
-
-# Tadpole ROI
-print("Select the tadpole and press SPACE or ENTER.")
-tad_ROI = cv2.selectROI(last_frame, False)
-last_frame[tad_ROI[1]:tad_ROI[1]+tad_ROI[3], tad_ROI[0]:tad_ROI[0]+tad_ROI[2]] = first_frame[tad_ROI[1]:tad_ROI[1]+tad_ROI[3], tad_ROI[0]:tad_ROI[0]+tad_ROI[2]]
-cv2.destroyWindow("ROI selector")  
-cv2.imshow("Subtraction frame", last_frame)
-
-# confirm successful removal of tadpole
-my_w = tk.Tk()
-my_var=messagebox.askyesno("Prompt", "Has the tadpole been removed from the image?")
-if my_var == True:
-    bg_img = last_frame
-    cv2.destroyWindow("Subtraction frame")
-    my_w.destroy()
-if my_var == False:
-    print("Select a bright area of background and press SPACE or ENTER.")
-    bg_ROI =  cv2.selectROI(first_frame, False)
-    bg_img = last_frame[tad_ROI[1]:tad_ROI[1] + tad_ROI[3], tad_ROI[0]:tad_ROI[0] + tad_ROI[2]].copy()
-    bg_av = bg_img.mean(axis=0).mean(axis=0)
-    cv2.rectangle(last_frame, (tad_ROI[0], tad_ROI[1]), (tad_ROI[0] + tad_ROI[2] , tad_ROI[1] + tad_ROI[3]), bg_av, -1)
-    cv2.destroyWindow("ROI selector")
-    my_w.destroy()
-my_w.mainloop()
-
-# thresholding
-ret, last_frame = cv2.threshold(last_frame, 230, 255,cv2.THRESH_TRUNC)
-last_frame = last_frame + 25
-
-# save tracked video
-fourcc = cv2.VideoWriter_fourcc(*'XVID')  
-out = cv2.VideoWriter('output_videos/' + filename + '_tracked.avi',fourcc, 30, (frame_width,frame_height))
-
-# return to beginning of video
-video.set(cv2.CAP_PROP_POS_FRAMES, 0)
-ok, frame = video.read()
-
-# subtraction
-subtracted = cv2.subtract(frame, last_frame)
-blurred = cv2.GaussianBlur(subtracted, (11, 11), cv2.BORDER_DEFAULT)
-contrast = cv2.addWeighted(blurred, alpha, np.zeros(blurred.shape, frame.dtype), 0, beta)
-bw = cv2.cvtColor(contrast, cv2.COLOR_BGR2GRAY)
-
-# masking  
-ret,mask = cv2.threshold(bw,50,255,cv2.THRESH_BINARY)
-mask = cv2.erode(mask, None, iterations=1)
-mask = cv2.dilate(mask, None, iterations=3)
-
-# contrail 1
-buffer = int(videofps * 1)  
-pts = deque(maxlen= buffer )
-
-# contrail 2
-buffer_2 = int(videofps * 5)
-pts2 = deque(maxlen= buffer_2 )
-
-# location and heading data
-counter = 0
-counter2 = 0
-(dX, dY) = (0, 0)
-direction = ""
-frame_num = 0
-totaldis = 0
-max_v = 0
-curr_vel = 0
-last_head = None
-ellipse = None
-stim_angle_start = None
-deviation = 0
-pixels = petri_dish 
-# speed data
-speed_dict = {}
-speed_time = -3
-
-while True:
-    # Read a new frame
+# headless mode (--headless or --job) never opens a window or waits for a key, and saves the data without asking
+## the petri dish is the largest detected circle, and the tadpole is removed from the subtraction frame automatically,
+## or as chosen in an earlier interactive run of the same video (saved in params_folder)
+params_folder = 'output_params'
+## margin in pixels around the automatically detected tadpole
+tadpole_margin = 10
+## set to False to skip writing the tracked video
+write_video = True
+
+# subtraction frame
+## 'roi': paste the tadpole area of the first subtraction frame into the last one (selected by hand, or found automatically in headless mode)
+## 'median': per-pixel percentile over background_samples frames spread over the whole video, needs no selection
+background_model = 'roi'
+background_samples = 25
+## 50 is the median; lower values keep a tadpole that rests in one place out of the background, as it is brighter than the dish
+background_percentile = 50
+## save the 'median' background in params_folder and reuse it until the video changes
+cache_background = True
+
+## decode, track and encode in separate threads; queue_size frames are buffered between them
+threaded = True
+queue_size = 8
+
+## only process a window around the last tadpole position; the whole frame is used after a frame without
+## a tadpole, or when the tadpole reaches the edge of the window
+tracking_window = False
+## the window reaches window_min pixels, or 3 times the tadpole's radius plus twice its last step, from its center
+window_min = 40
+## pixels added around the window so the blur, erosion and dilation inside it match the whole-frame result
+window_padding = 10
+
+## convert frames to gray before the subtraction and reuse the same buffers for every frame; gives the same contours
+## for grayscale videos, and nearly the same when compression leaves small differences between the colour channels
+fast_preprocessing = False
+
+## decode only the frames the escape data depend on: from 3 s before the stimulus (the first speed entry), with 1 s more
+## for the velocity, to the end of the loom. The tracked video only shows this span. The data match the whole-video run
+## unless the tadpole is lost for all of the first second.
+analysis_window_only = False
+
+# data to save
+## columns of data.csv between the trial number and the timestamp, computed in the same pass over the video:
+## 'Esc Dis', 'Esc Vel', 'Esc Ang', and the path length over the whole video ('Total Dist') or before the stimulus ('Pre-loom Dist')
+data_columns = ['Esc Dis', 'Esc Vel', 'Esc Ang']
+## save the speed every 0.1 s from 3 s before to 3 s after the stimulus to output_speed
+save_speed = True
+## save the tadpole of every tracked frame to output_trajectories/<filename>.traj, with the frame rate, stimulus and scale
+## in <filename>.json, so the metrics can be computed again without the video; rows are written trajectory_block at a time
+save_trajectory = False
+trajectory_folder = 'output_trajectories'
+trajectory_block = 256
+
+def parse_filename(filename):
+    # filename processing
+    animalID, timepoint, treatment, trial = filename.split("_")
+    trial_num = int(trial[-1:])
+    return animalID, timepoint, treatment, trial, trial_num
+
+def read_timings(animalID, timepoint, treatment, trial_num):
+    """Frame rate and stimulus frames of a trial from the timings csv of its video."""
+    # data to save
+    capture_data = []
+
+    # open the csv file associated with thie video and save it
+    with open(animalID + '_' + timepoint + '_' + treatment + '_timings.csv', newline='') as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row in reader:
+            capture_data.append(row)
+
+    # timing data
+    stim_start = float(capture_data[trial_num]['stim begin'])
+    trial_start = float(capture_data[trial_num]['start'])
+    stim_time = stim_start-trial_start
+    videofps = float(capture_data[trial_num]['fps'])
+    stim_frame = int(stim_time*videofps)
+    stim_end = float(capture_data[trial_num]['stim end'])
+    stim_end_time = stim_end-trial_start
+    stim_end_frame = int(stim_end_time*videofps)
+    return videofps, stim_frame, stim_end_frame
+
+def analysis_frames(videofps, stim_frame):
+    """First and last frame the escape data depend on."""
+    first = max(math.floor(stim_frame - 3 * videofps) - int(videofps * 1), 1)
+    last = stim_frame + int(videofps * 5)
+    return first, last
+
+def angle_frames(videofps):
+    """Length of the escape angle window after the stimulus in frames."""
+    if exp_type == 'darkloom':
+        return int(videofps * 0.6)
+    if exp_type == 'brightloom':
+        return int(videofps * 1.2)
+
+class Metric:
+    """Accumulator the tracking loop feeds in its one pass over the video. On each frame the loop calls velocity() when it
+    measures the velocity (the displacement over the last 10 frames in mm, and the velocity in mm/s), escape_step() for
+    the last step of contrail 2 in mm, heading() with the last fitted ellipse, and frame() with the current velocity.
+    finish() is called after the last frame. value is the result."""
+    value = 0
+
+    def velocity(self, frame_num, distance, velocity):
+        pass
+
+    def escape_step(self, frame_num, distance):
+        pass
+
+    def heading(self, frame_num, ellipse):
+        pass
+
+    def frame(self, frame_num, velocity):
+        pass
+
+    def finish(self, frame_num, frame_range):
+        pass
+
+class EscapeDistance(Metric):
+    """Adds up the steps of contrail 2, the distance travelled from the stimulus."""
+    def __init__(self):
+        self.value = 0
+        self.last_step = self.last_step_frame = None
+
+    def escape_step(self, frame_num, distance):
+        self.value += distance
+        self.last_step, self.last_step_frame = distance, frame_num
+
+    def finish(self, frame_num, frame_range):
+        # contrail 2 is full after the loom, so the whole-video run adds its last step again on every remaining frame
+        if frame_range is not None and frame_num == frame_range[1] and self.last_step_frame == frame_num:
+            self.value += self.last_step * (frame_range[2] - 1 - frame_num)
+
+class EscapeVelocity(Metric):
+    """Maximum velocity during the loom."""
+    def __init__(self, stim_frame, loom_frames):
+        self.stim_frame, self.loom_frames = stim_frame, loom_frames
+        self.value = 0
+
+    def velocity(self, frame_num, distance, velocity):
+        if frame_num > self.stim_frame and frame_num < self.stim_frame + self.loom_frames:
+            if velocity > self.value:
+                self.value = velocity
+
+class HeadingDeviation(Metric):
+    """Sum of the changes in heading over the escape angle window, from the ellipses more elliptical than ellipse_quality.
+    value is its size, deviation keeps the sign."""
+    def __init__(self, stim_frame, angle_frames):
+        self.stim_frame, self.angle_frames = stim_frame, angle_frames
+        self.deviation = 0
+        self.stim_angle_start = self.last_head = None
+
+    @property
+    def value(self):
+        return abs(self.deviation)
+
+    def heading(self, frame_num, ellipse):
+        if frame_num >= self.stim_frame and frame_num <= self.stim_frame + self.angle_frames:
+            if ellipse != None:
+                if ellipse[1][1] / ellipse[1][0]  > ellipse_quality:
+                    if self.stim_angle_start == None:
+                        self.stim_angle_start = ellipse[2]
+                        self.last_head = ellipse[2]
+                    else:
+                        if abs(ellipse[2] - self.last_head) < crossover_angle:
+                            self.deviation += ellipse[2] - self.last_head
+                            self.last_head = ellipse[2]
+                        elif ellipse[2] - self.last_head >= crossover_angle:
+                            self.deviation +=  ellipse[2] - self.last_head - 180
+                            self.last_head = ellipse[2]
+                        elif ellipse[2] - self.last_head <= (-1 * crossover_angle):
+                            self.deviation +=  ellipse[2] - self.last_head + 180
+                            self.last_head = ellipse[2]
+
+class PathLength(Metric):
+    """Adds up the distance of every velocity measurement (the displacement over the last 10 frames), up to a frame."""
+    def __init__(self, before_frame=None):
+        self.before_frame = before_frame
+        self.value = 0
+
+    def velocity(self, frame_num, distance, velocity):
+        if self.before_frame is None or frame_num < self.before_frame:
+            self.value += distance
+
+class SpeedTrace(Metric):
+    """The speed every 0.1 s from 3 s before to 3 s after the stimulus, by time; at most one entry is saved per frame."""
+    def __init__(self, videofps, stim_frame):
+        self.videofps, self.stim_frame = videofps, stim_frame
+        self.value = {}
+        self.time = -3
+
+    def frame(self, frame_num, velocity):
+        if self.time <= 3 and frame_num >= self.time * self.videofps + self.stim_frame:
+            self.value[self.time] = round(velocity,1)
+            self.time += 0.1
+            self.time = round(self.time, 1)
+
+## metrics by data.csv column, made from the frame rate and the stimulus frame of the trial
+METRICS = {
+    'Esc Dis': lambda videofps, stim_frame: EscapeDistance(),
+    'Esc Vel': lambda videofps, stim_frame: EscapeVelocity(stim_frame, int(videofps * 5)),
+    'Esc Ang': lambda videofps, stim_frame: HeadingDeviation(stim_frame, angle_frames(videofps)),
+    'Total Dist': lambda videofps, stim_frame: PathLength(),
+    'Pre-loom Dist': lambda videofps, stim_frame: PathLength(before_frame=stim_frame),
+}
+## the escape metrics are shown on the tracked video, so they are always computed
+ESCAPE_COLUMNS = ['Esc Dis', 'Esc Vel', 'Esc Ang']
+## columns that need the whole video, so they turn off analysis_window_only
+WHOLE_VIDEO_COLUMNS = ['Total Dist', 'Pre-loom Dist']
+
+def subtraction_frames(video, stim_end_frame):
+    """The two frames the subtraction frame is built from: the tadpole is cut out of the second one."""
+    # determine subtraction frames
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    if exp_type == 'darkloom':
+        subframe1 = 0
+        subframe2 = frame_count-1
+    if exp_type == 'brightloom':
+        subframe1 = stim_end_frame + 3
+        subframe2 = stim_end_frame + 47
+    video.set(cv2.CAP_PROP_POS_FRAMES, subframe1)
     ok, frame = video.read()
-    if not ok:
-        break
-    # preprocess the read frame
+    first_frame = frame.copy()
+    video.set(cv2.CAP_PROP_POS_FRAMES, subframe2)
+    ok, frame = video.read()
+    last_frame = frame.copy()
+    return first_frame, last_frame
+
+def sample_frames(video, count):
+    """count frames spread evenly over the video."""
+    frame_count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames = []
+    for index in np.unique(np.linspace(0, frame_count - 1, min(count, frame_count)).astype(int)):
+        video.set(cv2.CAP_PROP_POS_FRAMES, int(index))
+        ok, frame = video.read()
+        if ok:
+            frames.append(frame)
+    return frames
+
+def median_background(filename, video):
+    """Per-pixel background_percentile of sampled frames. The tadpole moves, so it is only in a few samples of each pixel."""
+    cache_path = os.path.join(params_folder, f'{filename}_background_p{background_percentile}_n{background_samples}.png')
+    if cache_background and os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(filename + ".avi"):
+        return cv2.imread(cache_path)
+    stack = np.stack(sample_frames(video, background_samples))
+    # nearest-rank percentile; np.partition keeps uint8 and is much faster than np.percentile
+    rank = int(round(background_percentile / 100 * (len(stack) - 1)))
+    background = np.partition(stack, rank, axis=0)[rank]
+    if cache_background:
+        os.makedirs(params_folder, exist_ok=True)
+        cv2.imwrite(cache_path, background)
+    return background
+
+def detect_petri_dish(frame, headless=False):
+    """Diameter of the petri dish in pixels, from the largest detected circle (560 when none is found)."""
+    # set scale
+    scale = frame.copy()
+    petri_dish = 560
+    gray_scale = cv2.cvtColor(scale, cv2.COLOR_BGR2GRAY)
+    circles = cv2.HoughCircles(gray_scale, cv2.HOUGH_GRADIENT, 1.2, 800, param1=50,param2=30,minRadius=80,maxRadius=pdmaxrad)
+
+    # determine scale using detected petri dish size
+    if circles is not None:
+        # grab circle properties
+        circles = np.round(circles[0, :]).astype("int")
+        largest_r = 0
+        # loop over the circles
+        for (x, y, r) in circles:
+            # draw the circle in the output image
+            cv2.circle(scale, (x, y), r, (0, 255, 0), 4)
+            cv2.rectangle(scale, (x - 5, y - 5), (x + 5, y + 5), (0, 128, 255), -1)
+            if largest_r < r:
+                largest_r = r
+        petri_dish = largest_r * 2
+        if not headless:
+            # show the output image
+            cv2.imshow("Circle detection", scale)
+            cv2.waitKey(0)
+    if not headless:
+        cv2.destroyWindow("Circle detection")
+    return petri_dish
+
+def remove_tadpole(first_frame, last_frame, tad_ROI, removed=True):
+    """Pastes the tadpole ROI of first_frame into last_frame. When that did not remove the tadpole,
+    the ROI is filled with its average colour instead."""
+    last_frame[tad_ROI[1]:tad_ROI[1]+tad_ROI[3], tad_ROI[0]:tad_ROI[0]+tad_ROI[2]] = first_frame[tad_ROI[1]:tad_ROI[1]+tad_ROI[3], tad_ROI[0]:tad_ROI[0]+tad_ROI[2]]
+    if not removed:
+        bg_img = last_frame[tad_ROI[1]:tad_ROI[1] + tad_ROI[3], tad_ROI[0]:tad_ROI[0] + tad_ROI[2]].copy()
+        bg_av = bg_img.mean(axis=0).mean(axis=0)
+        cv2.rectangle(last_frame, (tad_ROI[0], tad_ROI[1]), (tad_ROI[0] + tad_ROI[2] , tad_ROI[1] + tad_ROI[3]), bg_av, -1)
+    return last_frame
+
+def select_tadpole(first_frame, last_frame):
+    """Asks for the tadpole ROI and whether pasting it from first_frame removed the tadpole."""
+    import tkinter as tk
+    from tkinter import messagebox
+
+    # Tadpole ROI
+    print("Select the tadpole and press SPACE or ENTER.")
+    tad_ROI = cv2.selectROI(last_frame, False)
+    preview = remove_tadpole(first_frame, last_frame.copy(), tad_ROI)
+    cv2.destroyWindow("ROI selector")
+    cv2.imshow("Subtraction frame", preview)
+
+    # confirm successful removal of tadpole
+    my_w = tk.Tk()
+    my_var=messagebox.askyesno("Prompt", "Has the tadpole been removed from the image?")
+    if my_var == True:
+        cv2.destroyWindow("Subtraction frame")
+        my_w.destroy()
+    if my_var == False:
+        print("Select a bright area of background and press SPACE or ENTER.")
+        bg_ROI =  cv2.selectROI(first_frame, False)
+        cv2.destroyWindow("ROI selector")
+        my_w.destroy()
+    my_w.mainloop()
+    return [int(v) for v in tad_ROI], bool(my_var)
+
+def find_tadpole(first_frame, last_frame):
+    """ROI of the tadpole in last_frame: the largest area that is brighter than in first_frame, plus tadpole_margin.
+    None when the tadpole is at the same place in both frames."""
+    moved = cv2.cvtColor(cv2.subtract(last_frame, first_frame), cv2.COLOR_BGR2GRAY)
+    moved = cv2.GaussianBlur(moved, (11, 11), 0)
+    ret, moved = cv2.threshold(moved, 25, 255, cv2.THRESH_BINARY)
+    contours = imutils.grab_contours(cv2.findContours(moved, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE))
+    if len(contours) == 0:
+        return None
+    x, y, w, h = cv2.boundingRect(max(contours, key=cv2.contourArea))
+    x0, y0 = max(x - tadpole_margin, 0), max(y - tadpole_margin, 0)
+    x1, y1 = min(x + w + tadpole_margin, last_frame.shape[1]), min(y + h + tadpole_margin, last_frame.shape[0])
+    return [x0, y0, x1 - x0, y1 - y0]
+
+def params_path(filename):
+    return os.path.join(params_folder, filename + '.json')
+
+def load_params(filename):
+    if os.path.exists(params_path(filename)):
+        with open(params_path(filename)) as f:
+            return json.load(f)
+    return None
+
+def save_params(filename, params):
+    os.makedirs(params_folder, exist_ok=True)
+    with open(params_path(filename), 'w') as f:
+        json.dump(params, f, indent=1)
+
+def subtraction_frame(filename, video, stim_end_frame, headless=False):
+    """Builds the frame subtracted from every video frame, and returns it with the petri dish size in pixels.
+    Interactive runs save their choices, which later headless runs of the same video reuse."""
+    saved = (load_params(filename) or {}) if headless else {}
+    if background_model == 'median':
+        last_frame = median_background(filename, video)
+    else:
+        first_frame, last_frame = subtraction_frames(video, stim_end_frame)
+    params = {'petri_dish': saved['petri_dish'] if 'petri_dish' in saved else int(detect_petri_dish(last_frame, headless))}
+    if background_model != 'median':
+        if 'tadpole_roi' in saved:
+            params['tadpole_roi'], params['tadpole_removed'] = saved['tadpole_roi'], saved['tadpole_removed']
+        elif headless:
+            params['tadpole_roi'], params['tadpole_removed'] = find_tadpole(first_frame, last_frame), True
+            if params['tadpole_roi'] is None:
+                print("Tadpole did not move between the subtraction frames; it stays in the subtraction frame.")
+        else:
+            params['tadpole_roi'], params['tadpole_removed'] = select_tadpole(first_frame, last_frame)
+        if params['tadpole_roi'] is not None:
+            last_frame = remove_tadpole(first_frame, last_frame, params['tadpole_roi'], params['tadpole_removed'])
+    if not headless:
+        save_params(filename, {**(load_params(filename) or {}), **params})
+
+    # thresholding
+    ret, last_frame = cv2.threshold(last_frame, 230, 255,cv2.THRESH_TRUNC)
+    last_frame = last_frame + 25
+    return last_frame, params['petri_dish']
+
+class FrameReader(threading.Thread):
+    """Decodes the video ahead of the tracking loop. read() works like VideoCapture.read(), and raises the decoder's error.
+    OpenCV releases the GIL while decoding, so this runs alongside the tracking."""
+    def __init__(self, video, size):
+        super().__init__(daemon=True)
+        self.video = video
+        self.frames = queue.Queue(maxsize=size)
+        self.stopped = threading.Event()
+        self.error = None
+        self.start()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                ok, frame = self.video.read()
+            except Exception as e:
+                # The end-of-video marker below is still queued, so read() never waits for a frame that will not come
+                self.error = e
+                ok, frame = False, None
+            # A full queue blocks the decoder until the tracking loop catches up
+            while not self.stopped.is_set():
+                try:
+                    self.frames.put(frame if ok else None, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            if not ok:
+                return
+
+    def read(self):
+        frame = self.frames.get()
+        if frame is None and self.error is not None:
+            raise self.error
+        return frame is not None, frame
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+class FrameWriter(threading.Thread):
+    """Encodes the tracked frames in the background. write() works like VideoWriter.write(), and raises the encoder's error."""
+    def __init__(self, out, size):
+        super().__init__(daemon=True)
+        self.out = out
+        self.frames = queue.Queue(maxsize=size)
+        self.error = None
+        self.start()
+
+    def run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                return
+            try:
+                self.out.write(frame)
+            except Exception as e:
+                self.error = e
+
+    def write(self, frame):
+        if self.error is not None:
+            raise self.error
+        self.frames.put(frame)
+
+    def close(self):
+        self.frames.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+# One row per tracked frame. x, y is the centroid of the largest contour and center_x, center_y the whole-pixel position the
+# tracker measures distances with, area is the contour area, and the ellipse fitted to it is NaN when it has fewer than 5 points
+# (fitEllipse works in single precision, so float32 keeps its values unchanged). Only frame and timestamp are set when detected is 0.
+TRAJECTORY_DTYPE = np.dtype([('frame', '<i4'), ('timestamp', '<f8'), ('detected', 'u1'), ('x', '<f8'), ('y', '<f8'),
+                             ('center_x', '<i4'), ('center_y', '<i4'), ('area', '<f4'),
+                             ('ellipse_x', '<f4'), ('ellipse_y', '<f4'), ('ellipse_width', '<f4'), ('ellipse_height', '<f4'), ('ellipse_angle', '<f4')])
+
+class TrajectoryWriter:
+    """Writes the trajectory rows to a raw file as the tracking goes, and their dtype and the trial metadata to a json file.
+    Read it back with np.fromfile(path, np.dtype([tuple(field) for field in metadata['dtype']]))."""
+    def __init__(self, path, metadata):
+        self.path = path
+        self.metadata = dict(metadata, dtype=TRAJECTORY_DTYPE.descr, rows=0, complete=False)
+        self.rows = np.zeros(trajectory_block, TRAJECTORY_DTYPE)
+        self.count = 0
+        self.file = open(path + '.traj', 'wb')
+        self.write_metadata()
+
+    def write_metadata(self):
+        with open(self.path + '.json', 'w') as f:
+            json.dump(self.metadata, f, indent=1)
+
+    def add(self, frame_num, videofps, center=None, pixel=None, area=0, ellipse=None):
+        row = self.rows[self.count]
+        row['frame'], row['timestamp'], row['detected'] = frame_num, frame_num / videofps, center is not None
+        row['x'], row['y'] = center if center is not None else (np.nan, np.nan)
+        row['center_x'], row['center_y'] = pixel if pixel is not None else (0, 0)
+        row['area'] = area
+        (row['ellipse_x'], row['ellipse_y']), (row['ellipse_width'], row['ellipse_height']), row['ellipse_angle'] = (
+            ellipse if ellipse is not None else ((np.nan, np.nan), (np.nan, np.nan), np.nan))
+        self.count += 1
+        if self.count == len(self.rows):
+            self.flush()
+
+    def flush(self):
+        self.rows[:self.count].tofile(self.file)
+        self.file.flush()
+        self.metadata['rows'] += self.count
+        self.count = 0
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        self.metadata['complete'] = True
+        self.write_metadata()
+
+def find_contours(frame, last_frame, window=None):
+    """Contours of the tadpole mask in frame coordinates. window = (x0, y0, x1, y1) limits the work to that part of the frame."""
+    x0, y0 = 0, 0
+    if window is not None:
+        x0, y0, x1, y1 = window
+        frame, last_frame = frame[y0:y1, x0:x1], last_frame[y0:y1, x0:x1]
     subtracted = cv2.subtract(frame, last_frame)
     blurred = cv2.GaussianBlur(subtracted, (11, 11), cv2.BORDER_DEFAULT)
     contrast = cv2.addWeighted(blurred, alpha, np.zeros(blurred.shape, frame.dtype), 0, beta)
@@ -215,188 +535,425 @@ while True:
     mask = cv2.erode(mask, None, iterations=1)
     mask = cv2.dilate(mask, None, iterations=3)
     # find contours
-    contours = cv2.findContours(mask.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-    contours = imutils.grab_contours(contours)
-    # increment frame counter
-    frame_num += 1
-    # draw contours
-    if len(contours) > 0:
-        # largest contour
-        c = max(contours, key=cv2.contourArea)
-        ((x, y), radius) = cv2.minEnclosingCircle(c)
-        M = cv2.moments(c)
-        contour_center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
-        areas = [cv2.contourArea(c) for c in contours]
-        max_index = np.argmax(areas)
-        cv2.drawContours(frame, contours, max_index, (255, 0, 0),2)
-        pts.appendleft(contour_center)
-        # fit to ellipse
-        if len(contours[max_index]) > 4:
-            ellipse = cv2.fitEllipse(contours[max_index])
-        else:
-            ellipse = None
-        # contrail 2
-        if frame_num >= stim_frame and counter2 < buffer_2:
-            pts2.appendleft(contour_center)
-            counter2 += 1
+    contours = cv2.findContours(mask.copy(), cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+    return imutils.grab_contours(contours)
+
+class GrayPreprocessor:
+    """Fast path of find_contours: gray first, one lookup table for the contrast and threshold, and
+    preallocated buffers for every step (window crops use views of them). Only outer contours are returned;
+    the largest contour is always an outer one."""
+    def __init__(self, last_frame):
+        self.background = cv2.cvtColor(last_frame, cv2.COLOR_BGR2GRAY)
+        self.gray, self.subtracted, self.blurred, self.mask, self.eroded = (np.empty_like(self.background) for _ in range(5))
+        # 255 for the blurred values that addWeighted(alpha, beta) lifts above the threshold of 50
+        levels = np.arange(256, dtype=np.uint8).reshape(1, -1)
+        contrast = cv2.addWeighted(levels, alpha, np.zeros_like(levels), 0, beta)
+        self.threshold_table = np.where(contrast > 50, 255, 0).astype(np.uint8)
+
+    def find_contours(self, frame, window=None):
+        x0, y0, x1, y1 = window if window is not None else (0, 0, frame.shape[1], frame.shape[0])
+        gray, subtracted, blurred, mask, eroded = (buffer[y0:y1, x0:x1] for buffer in
+                                                   (self.gray, self.subtracted, self.blurred, self.mask, self.eroded))
+        cv2.cvtColor(frame[y0:y1, x0:x1], cv2.COLOR_BGR2GRAY, dst=gray)
+        cv2.subtract(gray, self.background[y0:y1, x0:x1], dst=subtracted)
+        cv2.GaussianBlur(subtracted, (11, 11), cv2.BORDER_DEFAULT, dst=blurred)
+        cv2.LUT(blurred, self.threshold_table, dst=mask)
+        cv2.erode(mask, None, dst=eroded, iterations=1)
+        cv2.dilate(eroded, None, dst=mask, iterations=3)
+        return imutils.grab_contours(cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0)))
+
+def tracking_window_around(center, half_width, shape):
+    return (max(center[0] - half_width, 0), max(center[1] - half_width, 0),
+            min(center[0] + half_width, shape[1]), min(center[1] + half_width, shape[0]))
+
+def inside_window(contour, window, shape):
+    """True when the contour is clear of the padding at the window edges that are not frame edges."""
+    x, y, w, h = cv2.boundingRect(contour)
+    x0, y0, x1, y1 = window
+    return ((x0 == 0 or x >= x0 + window_padding) and (y0 == 0 or y >= y0 + window_padding)
+            and (x1 == shape[1] or x + w <= x1 - window_padding) and (y1 == shape[0] or y + h <= y1 - window_padding))
+
+def track(video, last_frame, petri_dish, videofps, stim_frame, out=None, headless=False, frame_range=None, trajectory=None):
+    """Tracks the tadpole through the rest of the video. Returns the values of the METRICS by data.csv column (the escape
+    columns and those in data_columns), the speed every 0.1 s around the stimulus, the contrail image and the frames at
+    the start and end of the escape angle window.
+    frame_range = (first, last, frame count) tracks only the first to last frame; the video has to be at the first one.
+    Every tracked frame is added to the trajectory (a TrajectoryWriter) when one is given."""
+    frame_height, frame_width = last_frame.shape[:2]
+
+    img_output = np.zeros((frame_height, frame_width, 3), np.uint8)
+
+    # angle timing
+    buffer_3 = angle_frames(videofps)
+
+    # contrail 1
+    buffer = int(videofps * 1)
+    pts = deque(maxlen= buffer )
+
+    # contrail 2
+    buffer_2 = int(videofps * 5)
+    pts2 = deque(maxlen= buffer_2 )
+
+    # location and heading data
+    counter = 0
+    counter2 = 0
+    (dX, dY) = (0, 0)
+    direction = ""
+    first, last = frame_range[:2] if frame_range is not None else (1, None)
+    frame_num = first - 1
+    curr_vel = 0
+    ellipse = None
+    pixels = petri_dish
+    start_frame = end_frame = None
+    window_half_width = None
+    if fast_preprocessing:
+        contours_in = GrayPreprocessor(last_frame).find_contours
     else:
-        pts.appendleft(None)
-        if frame_num >= stim_frame and counter2 < buffer_2:
-            pts2.appendleft(None)
-            counter2 += 1
-    # location and speed        
-    for i in np.arange(1, len(pts)):
-        if pts[i - 1] is None or pts[i] is None:
-            continue
-        if frame_num >= 10 and i == 1 and pts[-10] is not None:
-            dX = pts[-10][0] - pts[i][0]
-            dY = pts[-10][1] - pts[i][1]
-            (dirX, dirY) = ("", "")
-            dxy = math.sqrt(dX**2 + dY**2)
-            curr_vel = (dxy / (pixels / diameter)) / (10 / videofps)
-            if frame_num > stim_frame and frame_num < stim_frame + buffer_2:
-                if curr_vel > max_v:
-                    max_v = curr_vel
-            if np.abs(dX) > 20:
-                dirX = "East" if np.sign(dX) == 1 else "West"
-            if np.abs(dY) > 20:
-                dirY = "North" if np.sign(dY) == 1 else "South"
-            if dirX != "" and dirY != "":
-                direction = "{}-{}".format(dirY, dirX)
-            else:
-                direction = dirX if dirX != "" else dirY
-        # draw contrail 1
-        thickness = int(np.sqrt( buffer / float(i + 1)) * 2)
-        cv2.line(frame, pts[i - 1], pts[i], (0, 0, 255), thickness)
-    # draw contrail 2 and calculate distance
-    if frame_num >= stim_frame and frame_num <= stim_frame + buffer_2:
-    # Append the current center if a contour is detected
+        contours_in = lambda frame, window=None: find_contours(frame, last_frame, window)
+    # escape data and speed data
+    metrics = {column: METRICS[column](videofps, stim_frame) for column in ESCAPE_COLUMNS + data_columns}
+    speed = SpeedTrace(videofps, stim_frame)
+    accumulators = list(metrics.values()) + [speed]
+    escape_distance, escape_velocity, heading = (metrics[column] for column in ESCAPE_COLUMNS)
+
+    while last is None or frame_num < last:
+        # Read a new frame
+        ok, frame = video.read()
+        if not ok:
+            break
+        # preprocess the read frame and find contours
+        contours = None
+        if tracking_window and len(pts) > 0 and pts[0] is not None:
+            window = tracking_window_around(pts[0], window_half_width, frame.shape)
+            contours = contours_in(frame, window)
+            if len(contours) == 0 or not inside_window(max(contours, key=cv2.contourArea), window, frame.shape):
+                contours = None
+        if contours is None:
+            contours = contours_in(frame)
+        # increment frame counter
+        frame_num += 1
+        # draw contours
         if len(contours) > 0:
-            c = max(contours, key=cv2.contourArea)
+            # largest contour
+            areas = [cv2.contourArea(contour) for contour in contours]
+            max_index = int(np.argmax(areas))
+            c = contours[max_index]
+            ((x, y), radius) = cv2.minEnclosingCircle(c)
             M = cv2.moments(c)
-            if M["m00"] != 0:  # Avoid division by zero
-                contour_center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
+            contour_center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
+            cv2.drawContours(frame, contours, max_index, (255, 0, 0),2)
+            pts.appendleft(contour_center)
+            if tracking_window:
+                step = math.dist(pts[0], pts[1]) if len(pts) > 1 and pts[1] is not None else 0
+                window_half_width = int(max(window_min, 3 * radius + 2 * step)) + window_padding
+            # fit to ellipse
+            if len(contours[max_index]) > 4:
+                ellipse = cv2.fitEllipse(contours[max_index])
+            else:
+                ellipse = None
+            if trajectory is not None:
+                trajectory.add(frame_num, videofps, (M["m10"] / M["m00"], M["m01"] / M["m00"]), contour_center, areas[max_index], ellipse)
+            # contrail 2
+            if frame_num >= stim_frame and counter2 < buffer_2:
                 pts2.appendleft(contour_center)
+                counter2 += 1
+        else:
+            pts.appendleft(None)
+            if trajectory is not None:
+                trajectory.add(frame_num, videofps)
+            if frame_num >= stim_frame and counter2 < buffer_2:
+                pts2.appendleft(None)
+                counter2 += 1
+        # location and speed
+        for i in np.arange(1, len(pts)):
+            if pts[i - 1] is None or pts[i] is None:
+                continue
+            # pts[-10] exists from the tenth tracked frame on
+            if frame_num >= first + 9 and i == 1 and pts[-10] is not None:
+                dX = pts[-10][0] - pts[i][0]
+                dY = pts[-10][1] - pts[i][1]
+                (dirX, dirY) = ("", "")
+                dxy = math.sqrt(dX**2 + dY**2)
+                curr_vel = (dxy / (pixels / diameter)) / (10 / videofps)
+                for metric in accumulators:
+                    metric.velocity(frame_num, dxy / (pixels / diameter), curr_vel)
+                if np.abs(dX) > 20:
+                    dirX = "East" if np.sign(dX) == 1 else "West"
+                if np.abs(dY) > 20:
+                    dirY = "North" if np.sign(dY) == 1 else "South"
+                if dirX != "" and dirY != "":
+                    direction = "{}-{}".format(dirY, dirX)
+                else:
+                    direction = dirX if dirX != "" else dirY
+            # draw contrail 1
+            thickness = int(np.sqrt( buffer / float(i + 1)) * 2)
+            cv2.line(frame, pts[i - 1], pts[i], (0, 0, 255), thickness)
+        # draw contrail 2 and calculate distance
+        if frame_num >= stim_frame and frame_num <= stim_frame + buffer_2:
+        # Append the current center if a contour is detected (M holds the moments of the largest contour from above)
+            if len(contours) > 0:
+                if M["m00"] != 0:  # Avoid division by zero
+                    contour_center = (int(M["m10"] / M["m00"]), int(M["m01"] / M["m00"]))
+                    pts2.appendleft(contour_center)
+                else:
+                    pts2.appendleft(None)
             else:
                 pts2.appendleft(None)
-        else:
-            pts2.appendleft(None)
-                
-    # Calculate the distance if there are enough points
-    if len(pts2) > 1 and pts2[0] is not None and pts2[1] is not None:
-        distance = math.sqrt((pts2[0][0] - pts2[1][0])**2 + (pts2[0][1] - pts2[1][1])**2) / (pixels / diameter)  
-        totaldis += distance
-
-    # Draw the contrail for visualization
-    for i in range(1, len(pts2)):
-        if pts2[i - 1] is None or pts2[i] is None:
-            continue
-        thickness2 = int(np.sqrt(buffer_2 / float(i + 1)) * 2)
-        cv2.line(frame, pts2[i - 1], pts2[i], (0, 255, 0), thickness2)
-        cv2.line(img_output, pts2[i - 1], pts2[i], (255, 255, 255), thickness2)
-
-    # angle analysis    
-    if frame_num >= stim_frame and frame_num <= stim_frame + buffer_3:
+
+        # Calculate the distance if there are enough points
+        if len(pts2) > 1 and pts2[0] is not None and pts2[1] is not None:
+            distance = math.sqrt((pts2[0][0] - pts2[1][0])**2 + (pts2[0][1] - pts2[1][1])**2) / (pixels / diameter)
+            for metric in accumulators:
+                metric.escape_step(frame_num, distance)
+
+        # Draw the contrail for visualization
+        for i in range(1, len(pts2)):
+            if pts2[i - 1] is None or pts2[i] is None:
+                continue
+            thickness2 = int(np.sqrt(buffer_2 / float(i + 1)) * 2)
+            cv2.line(frame, pts2[i - 1], pts2[i], (0, 255, 0), thickness2)
+            cv2.line(img_output, pts2[i - 1], pts2[i], (255, 255, 255), thickness2)
+
+        # angle analysis
+        for metric in accumulators:
+            metric.heading(frame_num, ellipse)
+        # start and end frames for escape angle
+        if frame_num == stim_frame:
+            start_frame = frame.copy()
+        if frame_num == stim_frame + buffer_3:
+            end_frame = frame.copy()
+        # heading data
         if ellipse != None:
-            if ellipse[1][1] / ellipse[1][0]  > ellipse_quality:
-                if stim_angle_start == None:
-                    stim_angle_start = ellipse[2]
-                    last_head = ellipse[2]
-                else:
-                    if abs(ellipse[2] - last_head) < crossover_angle:
-                        deviation += ellipse[2] - last_head
-                        last_head = ellipse[2]
-                    elif ellipse[2] - last_head >= crossover_angle:
-                        deviation +=  ellipse[2] - last_head - 180
-                        last_head = ellipse[2]
-                    elif ellipse[2] - last_head <= (-1 * crossover_angle):
-                        deviation +=  ellipse[2] - last_head + 180
-                        last_head = ellipse[2]
-                    else:
-                        pass
+            cv2.putText(frame, "Current Heading: {}".format(round(ellipse[2], 1)),
+            (10, 30), cv2.FONT_HERSHEY_SIMPLEX,
+            0.65, (0, 255, 255), 2)
+        elif heading.last_head != None:
+            cv2.putText(frame, "Current Heading: {}".format(round(heading.last_head, 1)),
+            (10, 30), cv2.FONT_HERSHEY_SIMPLEX,
+            0.65, (0, 255, 255), 2)
         else:
-            pass
-    # start and end frames for escape angle
-    if frame_num == stim_frame:
-        start_frame = frame.copy()
-    if frame_num == stim_frame + buffer_3:
-        end_frame = frame.copy()
-    # heading data
-    if ellipse != None:
-        cv2.putText(frame, "Current Heading: {}".format(round(ellipse[2], 1)),
-        (10, 30), cv2.FONT_HERSHEY_SIMPLEX,
-        0.65, (0, 255, 255), 2)
-    elif last_head != None:
-        cv2.putText(frame, "Current Heading: {}".format(round(last_head, 1)),
-        (10, 30), cv2.FONT_HERSHEY_SIMPLEX,
-        0.65, (0, 255, 255), 2)
-    else:
-        cv2.putText(frame, "Current Heading: N/A",
-        (10, 30), cv2.FONT_HERSHEY_SIMPLEX,
-        0.65, (0, 255, 255), 2)
-    cv2.putText(frame, "Deviation: {}".format(round(deviation,1)),
-        (10, 55), cv2.FONT_HERSHEY_SIMPLEX,
-        0.65, (0, 255, 255), 2)
-    # looming text  
-    if frame_num > stim_frame and frame_num < stim_frame + buffer_2:
-        cv2.putText(frame, "LOOMING", (frame.shape[1] - 180, 40), cv2.FONT_HERSHEY_SIMPLEX, 
-        1.2, (255, 0, 0), 4)
-    # display velocity
-    cv2.putText(frame, "Vel: " + str(round(curr_vel,1)) ,
-    (int(frame.shape[1]-140), frame.shape[0]-70), cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 255, 255), 2)
-    # instantaneous velocity data  
-    if speed_time <= 3 and frame_num >= speed_time * videofps + stim_frame:
-        speed_dict[speed_time] = round(curr_vel,1)
-        speed_time += 0.1
-        speed_time = round(speed_time, 1)
-    # display distance travelled during loom  
-    cv2.putText(frame, "Dist: " + str(round(totaldis,1)),
-    (int(frame.shape[1]-140), frame.shape[0]-40), cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 255, 0), 2)
-    # display max velocity
-    cv2.putText(frame, "Vmax: " + str(round(max_v,1)),
-    (int(frame.shape[1]-140), frame.shape[0]-10), cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 255, 0), 2)
-    # display frame number
-    cv2.putText(frame, "Frame: " + str(frame_num),
-    (int(10), frame.shape[0]-10), cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 255, 0), 2)
-    # write video  
-    cv2.imshow("Video", frame)
-    out.write(frame)
-    k = cv2.waitKey(playback_speed) & 0xff
-    if k == 27 : break
-
-# display the pre and post loom frames  
-cv2.imshow("Start and End", np.vstack([start_frame, end_frame]))
-
-# save data
-now = datetime.now()
-print('Animal ID. Timepoint, Treatment, Trial #, Esc Dis, Esc Vel, Esc Ang, Timestamp')
-data_to_save = [ animalID, timepoint, treatment, trial[-1:], round(totaldis,1), round(max_v,1), abs(round(deviation,1)), now.strftime("%y/%m/%d %H:%M") ]
-print(data_to_save)
-save_or_not = gui.Dlg()
-save_or_not.addText('Save data?')
-save_or_not.show()
-if save_or_not.OK:
+            cv2.putText(frame, "Current Heading: N/A",
+            (10, 30), cv2.FONT_HERSHEY_SIMPLEX,
+            0.65, (0, 255, 255), 2)
+        cv2.putText(frame, "Deviation: {}".format(round(heading.deviation,1)),
+            (10, 55), cv2.FONT_HERSHEY_SIMPLEX,
+            0.65, (0, 255, 255), 2)
+        # looming text
+        if frame_num > stim_frame and frame_num < stim_frame + buffer_2:
+            cv2.putText(frame, "LOOMING", (frame.shape[1] - 180, 40), cv2.FONT_HERSHEY_SIMPLEX,
+            1.2, (255, 0, 0), 4)
+        # display velocity
+        cv2.putText(frame, "Vel: " + str(round(curr_vel,1)) ,
+        (int(frame.shape[1]-140), frame.shape[0]-70), cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 255, 255), 2)
+        # instantaneous velocity data
+        for metric in accumulators:
+            metric.frame(frame_num, curr_vel)
+        # display distance travelled during loom
+        cv2.putText(frame, "Dist: " + str(round(escape_distance.value,1)),
+        (int(frame.shape[1]-140), frame.shape[0]-40), cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 255, 0), 2)
+        # display the other columns above the velocity
+        for row, column in enumerate(column for column in data_columns if column not in ESCAPE_COLUMNS):
+            cv2.putText(frame, column + ": " + str(round(metrics[column].value,1)),
+            (int(frame.shape[1]-140), frame.shape[0]-100-30*row), cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 255, 0), 2)
+        # display max velocity
+        cv2.putText(frame, "Vmax: " + str(round(escape_velocity.value,1)),
+        (int(frame.shape[1]-140), frame.shape[0]-10), cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 255, 0), 2)
+        # display frame number
+        cv2.putText(frame, "Frame: " + str(frame_num),
+        (int(10), frame.shape[0]-10), cv2.FONT_HERSHEY_SIMPLEX, 0.65, (0, 255, 0), 2)
+        # write video
+        if out is not None:
+            out.write(frame)
+        if not headless:
+            cv2.imshow("Video", frame)
+            k = cv2.waitKey(playback_speed) & 0xff
+            if k == 27 : break
+
+    for metric in accumulators:
+        metric.finish(frame_num, frame_range)
+    return {column: metric.value for column, metric in metrics.items()}, speed.value, img_output, start_frame, end_frame
+
+def save_data(filename, data_to_save, speed_dict, img_output):
+    animalID, timepoint, treatment, trial, trial_num = parse_filename(filename)
+    os.makedirs('output_contrails', exist_ok=True)
     cv2.imwrite('output_contrails/' + filename + '.jpg',img_output)
     if os.path.exists('data.csv') == False:
         with open ('data.csv', 'w', newline='') as datafileinit:
             datafileinitwriter = csv.writer(datafileinit)
-            datafileinitwriter.writerow( [ 'Animal ID', 'Timepoint', 'Treatment', 'Trial #', 'Esc Dis', 'Esc Vel', 'Esc Ang', 'Timestamp' ] )
+            datafileinitwriter.writerow( [ 'Animal ID', 'Timepoint', 'Treatment', 'Trial #' ] + data_columns + [ 'Timestamp' ] )
     with open('data.csv', 'a', newline='') as datafile:
         datafilewriter = csv.writer(datafile)
         datafilewriter.writerow( data_to_save )
         print("Data saved to: data.csv")
-    if os.path.exists('output_speed/' + animalID + '_' + timepoint + '_' + treatment + '.csv') == False:   
+    if not save_speed:
+        return
+    os.makedirs('output_speed', exist_ok=True)
+    if os.path.exists('output_speed/' + animalID + '_' + timepoint + '_' + treatment + '.csv') == False:
         with open ('output_speed/' + animalID + '_' + timepoint + '_' + treatment + '.csv', 'w', newline='') as datafileinit:
             datafileinitwriter = csv.writer(datafileinit)
             datafileinitwriter.writerow( [ 'Time'] )
             for key, value in speed_dict.items():
                 datafileinitwriter.writerow([key])
     speed_df = pd.read_csv('output_speed/' + animalID + '_' + timepoint + '_' + treatment + '.csv')
-    speed_list = []  
+    speed_list = []
     for key, value in speed_dict.items():
         speed_list.append(value)
     speed_df[trial] = speed_list
     speed_df.to_csv('output_speed/' + animalID + '_' + timepoint + '_' + treatment + '.csv', index=False)
-else:
-    print("Data not saved.")
-cv2.destroyAllWindows()
+
+def measure_trial(filename, headless=False):
+    """Tracks one trial video (<filename>.avi in the working directory). Returns the data.csv row, the speed table,
+    the contrail image and the frames at the start and end of the escape angle window."""
+    animalID, timepoint, treatment, trial, trial_num = parse_filename(filename)
+    unknown = [column for column in data_columns if column not in METRICS]
+    if unknown:
+        raise ValueError("Unknown data columns: " + ", ".join(unknown))
+    videofps, stim_frame, stim_end_frame = read_timings(animalID, timepoint, treatment, trial_num)
+
+    # Read video
+    video = cv2.VideoCapture(filename + ".avi")
+
+    # Exit if video not opened
+    if not video.isOpened():
+        raise IOError("Could not open video " + filename + ".avi")
+
+    # Read first frame
+    ok, frame = video.read()
+    if not ok:
+        raise IOError("Cannot read video file " + filename + ".avi")
+
+    last_frame, petri_dish = subtraction_frame(filename, video, stim_end_frame, headless)
+
+    # save tracked video
+    out = None
+    if write_video:
+        os.makedirs('output_videos', exist_ok=True)
+        fourcc = cv2.VideoWriter_fourcc(*'XVID')
+        out = cv2.VideoWriter('output_videos/' + filename + '_tracked.avi',fourcc, 30, (last_frame.shape[1],last_frame.shape[0]))
+
+    frame_range = None
+    whole_video = [column for column in data_columns if column in WHOLE_VIDEO_COLUMNS]
+    if analysis_window_only and whole_video:
+        print("Decoding the whole video for " + ", ".join(whole_video))
+    if analysis_window_only and not whole_video:
+        first, last = analysis_frames(videofps, stim_frame)
+        frame_range = (first, last, int(video.get(cv2.CAP_PROP_FRAME_COUNT)))
+        video.set(cv2.CAP_PROP_POS_FRAMES, first)
+    else:
+        # return to beginning of video; tracking starts at the second frame
+        video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        ok, frame = video.read()
+
+    trajectory = None
+    if save_trajectory:
+        os.makedirs(trajectory_folder, exist_ok=True)
+        trajectory = TrajectoryWriter(os.path.join(trajectory_folder, filename), {
+            'filename': filename, 'fps': videofps, 'stim_frame': stim_frame, 'stim_end_frame': stim_end_frame,
+            'frame_count': int(video.get(cv2.CAP_PROP_FRAME_COUNT)), 'pixels': int(petri_dish), 'diameter': diameter,
+            'exp_type': exp_type, 'alpha': alpha, 'beta': beta, 'background_model': background_model,
+            'tracking_window': tracking_window, 'fast_preprocessing': fast_preprocessing})
+
+    frames, writer = video, out
+    if threaded:
+        frames = FrameReader(video, queue_size)
+        writer = FrameWriter(out, queue_size) if out is not None else None
+    close_error = None
+    try:
+        metrics, speed_dict, img_output, start_frame, end_frame = track(
+            frames, last_frame, petri_dish, videofps, stim_frame, writer, headless, frame_range, trajectory)
+    finally:
+        if trajectory is not None:
+            trajectory.close()
+        if threaded:
+            frames.stop()
+            if writer is not None:
+                try:
+                    writer.close()
+                except Exception as e:
+                    close_error = e
+        video.release()
+        if out is not None:
+            out.release()
+    # An encoder error is only raised here, once tracking succeeded, so it never hides the error that stopped the tracking
+    if close_error is not None:
+        raise close_error
+
+    # save data
+    now = datetime.now()
+    print('Animal ID. Timepoint, Treatment, Trial #, ' + ', '.join(data_columns + ['Timestamp']))
+    data_to_save = [ animalID, timepoint, treatment, trial[-1:] ] + [ round(metrics[column],1) for column in data_columns ] + [ now.strftime("%y/%m/%d %H:%M") ]
+    print(data_to_save)
+    return data_to_save, speed_dict, img_output, start_frame, end_frame
+
+def track_trial(filename, headless=False):
+    """Tracks one trial video (<filename>.avi in the working directory) and saves its escape data.
+    Interactive runs show every step and ask before saving; headless runs open no windows."""
+    data_to_save, speed_dict, img_output, start_frame, end_frame = measure_trial(filename, headless)
+    if headless:
+        save_data(filename, data_to_save, speed_dict, img_output)
+        return data_to_save
+
+    # display the pre and post loom frames
+    from psychopy import gui
+    cv2.imshow("Start and End", np.vstack([start_frame, end_frame]))
+    save_or_not = gui.Dlg()
+    save_or_not.addText('Save data?')
+    save_or_not.show()
+    if save_or_not.OK:
+        save_data(filename, data_to_save, speed_dict, img_output)
+    else:
+        print("Data not saved.")
+    cv2.destroyAllWindows()
+    return data_to_save
+
+def run_job(job, save=True):
+    """Runs one headless job: {"filename": ..., "directory": ..., "settings": {"alpha": 3, ...}}.
+    The directory (default: the working directory) holds the video and its timings csv; settings override the values above.
+    Without save, the results of measure_trial are returned instead of saved."""
+    settings = job.get('settings', {})
+    unknown = [name for name in settings if name not in globals() or callable(globals()[name])]
+    if unknown:
+        raise ValueError("Unknown tracker settings: " + ", ".join(unknown))
+    defaults = {name: globals()[name] for name in settings}
+    working_directory = os.getcwd()
+    globals().update(settings)
+    try:
+        os.chdir(job.get('directory', working_directory))
+        if not save:
+            return measure_trial(job['filename'], headless=True)
+        return track_trial(job['filename'], headless=True)
+    finally:
+        os.chdir(working_directory)
+        globals().update(defaults)
+
+def main(argv=None):
+    global write_video, background_model, analysis_window_only, data_columns
+    parser = argparse.ArgumentParser(description='Track a tadpole and extract its escape response.')
+    parser.add_argument('filename', nargs='?', default=filename, help='Video name without .avi, e.g. A3__Control Cap_trial9')
+    parser.add_argument('--headless', action='store_true', help='Open no windows and save the data without asking')
+    parser.add_argument('--directory', default='.', help='Folder with the video and its timings csv')
+    parser.add_argument('--job', help='JSON file with one job or a list of jobs, each {"filename", "directory", "settings"}; implies --headless')
+    parser.add_argument('--no-video', action='store_true', help='Do not write the tracked video')
+    parser.add_argument('--window-only', action='store_true', help='Decode only the frames around the stimulus the data depend on')
+    parser.add_argument('--background', choices=['roi', 'median'], default=background_model, help='How the subtraction frame is built')
+    parser.add_argument('--columns', help='Comma-separated data.csv columns, e.g. "Esc Dis,Esc Vel,Esc Ang,Total Dist,Pre-loom Dist"')
+    options = parser.parse_args(argv)
+    if options.no_video:
+        write_video = False
+    background_model = options.background
+    if options.window_only:
+        analysis_window_only = True
+    if options.columns:
+        data_columns = [column.strip() for column in options.columns.split(',')]
+
+    if options.job:
+        with open(options.job) as f:
+            jobs = json.load(f)
+        for job in jobs if isinstance(jobs, list) else [jobs]:
+            run_job(job)
+    else:
+        os.chdir(options.directory)
+        track_trial(options.filename, options.headless)
+
+if __name__ == '__main__':
+    main()